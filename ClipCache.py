@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import *
+
+from discord.oggparse import OggStream
+
+from config import SOUND_TARGET_LUFS
+
+log = logging.getLogger(__name__)
+
+CLIP_CACHE_DIR = "./cache/opus/"
+LOUDNESS_INDEX_PATH = "./cache/loudness.json"
+# Normalization never boosts or cuts a clip by more than this
+MAX_GAIN_DB = 12.0
+# A loudness pass saves the index after this many measurements, so a long one keeps its progress if it's cut short
+LOUDNESS_SAVE_EVERY = 20
+# Upper bound on the Opus data kept in memory across all clips
+CLIP_CACHE_BYTES = 32 * 1024 * 1024
+# Opus stream headers aren't audio and must not be sent to Discord
+OPUS_HEADERS = (b"OpusHead", b"OpusTags")
+
+
+class OpusClip:
+    """
+    A sound transcoded to the 20ms, 48kHz stereo Opus packets Discord expects.
+    """
+
+    __slots__ = ("packets", "size")
+
+    def __init__(self, packets: List[bytes]):
+        self.packets = packets
+        self.size = sum(len(packet) for packet in packets)
+
+
+class LoudnessIndex:
+    """
+    Integrated loudness of every sound, measured once with ffmpeg's ebur128 filter and stored in a sidecar file keyed
+    by the sound's content hash. Files are only re-hashed when their size or mtime changes and only re-measured when
+    their hash is new, so renaming or copying a sound costs nothing. update() is slow and belongs in an executor;
+    the lookups are cheap and safe from the event loop.
+    """
+
+    def __init__(self, path: str = LOUDNESS_INDEX_PATH, target_lufs: float = SOUND_TARGET_LUFS, ffmpeg: str = "ffmpeg"):
+        self.path = path
+        self.target_lufs = target_lufs
+        self.ffmpeg = ffmpeg
+        # sound path -> [size, mtime_ns, sha1]
+        self._files: Dict[str, list] = {}
+        # sha1 -> integrated loudness in LUFS, None if it couldn't be measured
+        self._loudness: Dict[str, Optional[float]] = {}
+        self._update_lock = threading.Lock()
+        self._stopped = threading.Event()
+        if os.path.exists(path):
+            with open(path, mode="r") as file:
+                data = json.load(file)
+            self._files = data["files"]
+            self._loudness = data["loudness"]
+
+    def content_id(self, path: str, stat: os.stat_result) -> Optional[str]:
+        """
+        Returns the content hash of the sound at path if it has been hashed since it last changed.
+        """
+        entry = self._files.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def gain_db(self, content_id: Optional[str]) -> float:
+        """
+        Returns the gain that brings a sound to the target loudness, or 0 if it hasn't been measured.
+        """
+        lufs = self._loudness.get(content_id)
+        if lufs is None:
+            return 0.0
+        return max(-MAX_GAIN_DB, min(MAX_GAIN_DB, self.target_lufs - lufs))
+
+    def update(self, paths: Iterable[str]) -> int:
+        """
+        Hashes and measures every sound in paths that is new or changed, saving the index every LOUDNESS_SAVE_EVERY
+        measurements and at the end, when sounds no longer in paths are dropped from it. Each measurement is usable
+        as soon as it's made. When nothing changed this is only a stat per sound, and nothing is written, so it's
+        cheap enough to run on every library refresh. Returns the number of sounds that had to be measured.
+        :param paths: Iterable[str]
+        :return: int
+        """
+        with self._update_lock:
+            measured = 0
+            changed = False
+            seen = set()
+            for path in paths:
+                if self._stopped.is_set():
+                    if changed:
+                        self._save()
+                    return measured
+                try:
+                    stat = os.stat(path)
+                    content_id = self.content_id(path, stat)
+                    if content_id is None:
+                        content_id = self._hash(path)
+                        self._files[path] = [stat.st_size, stat.st_mtime_ns, content_id]
+                        changed = True
+                except OSError:
+                    continue
+                seen.add(path)
+                if content_id not in self._loudness:
+                    self._loudness[content_id] = self._measure(path)
+                    measured += 1
+                    if measured % LOUDNESS_SAVE_EVERY == 0:
+                        self._save()
+            if self._files.keys() - seen:
+                self._files = {path: entry for path, entry in self._files.items() if path in seen}
+                changed = True
+            if changed:
+                self._save()
+            return measured
+
+    def stop(self):
+        """
+        Makes a running update() save what it has measured and return once it's done with the current sound, and
+        any later one return straight away.
+        """
+        self._stopped.set()
+
+    @staticmethod
+    def _hash(path: str) -> str:
+        digest = hashlib.sha1()
+        with open(path, mode="rb") as file:
+            for block in iter(lambda: file.read(1 << 16), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _measure(self, path: str) -> Optional[float]:
+        result = subprocess.run(
+            [self.ffmpeg, "-nostdin", "-hide_banner", "-i", path, "-af", "ebur128=framelog=quiet", "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        # The summary at the end holds the integrated loudness of the whole clip
+        matches = re.findall(r"I:\s+(-?[0-9.]+) LUFS", result.stderr.decode(errors="replace"))
+        if result.returncode != 0 or not matches:
+            log.warning("Couldn't measure the loudness of %s", path)
+            return None
+        return float(matches[-1])
+
+    def _save(self):
+        live = {entry[2] for entry in self._files.values()}
+        data = {
+            "files": self._files,
+            "loudness": {content_id: lufs for content_id, lufs in self._loudness.items() if content_id in live},
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Per-process, since sharded workers share the cache directory
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
+
+
+class ClipCache:
+    """
+    Transcodes each sound to Opus once with ffmpeg and keeps the result on disk and, up to max_bytes, in memory.
+    The loudness normalization gain is applied during the transcode, so playback does no volume work at all.
+    Cache entries are keyed by the sound's content (its hash once measured, its path, size and mtime before that)
+    and gain, so editing a sound or finishing its analysis transcodes it again, and prune() removes the files left
+    behind.
+    """
+
+    def __init__(self, cache_dir: str = CLIP_CACHE_DIR, max_bytes: int = CLIP_CACHE_BYTES, ffmpeg: str = "ffmpeg"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ffmpeg = ffmpeg
+        self.loudness = LoudnessIndex(ffmpeg=ffmpeg)
+        # path -> (cache key, clip), least recently played first
+        self._clips: "OrderedDict[str, Tuple[str, OpusClip]]" = OrderedDict()
+        self._bytes = 0
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    def _key(self, path: str) -> Tuple[str, float]:
+        stat = os.stat(path)
+        content_id = self.loudness.content_id(path, stat)
+        gain = self.loudness.gain_db(content_id)
+        if content_id is None:
+            content_id = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha1(f"{content_id}:{gain:.1f}".encode()).hexdigest(), gain
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.ogg")
+
+    async def get(self, path: str) -> OpusClip:
+        """
+        Returns the clip for the sound at path, transcoding it if it has never been played.
+        Raises RuntimeError if ffmpeg fails and OSError if the sound can't be read.
+        :param path: str
+        :return: OpusClip
+        """
+        key, gain = await asyncio.get_running_loop().run_in_executor(None, self._key, path)
+        cached = self._clips.get(path)
+        if cached is not None and cached[0] == key:
+            self._clips.move_to_end(path)
+            return cached[1]
+
+        # Several plays of a new sound at once share one transcode
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, path, gain))
+            self._loading[key] = future
+            future.add_done_callback(lambda _: self._loading.pop(key, None))
+        clip = await asyncio.shield(future)
+        self._remember(path, key, clip)
+        return clip
+
+    async def prune(self, paths: Iterable[str]) -> int:
+        """
+        Deletes the cached files of every sound that is no longer in paths or has changed since it was transcoded.
+        Should run after the loudness index is updated, since the keys depend on it. Returns the number deleted.
+        :param paths: Iterable[str]
+        :return: int
+        """
+        # Transcodes still running are kept even if their sound has changed since
+        loading = set(self._loading)
+        return await asyncio.get_running_loop().run_in_executor(None, self._prune, list(paths), loading)
+
+    def _prune(self, paths: List[str], keep: Set[str]) -> int:
+        for path in paths:
+            try:
+                keep.add(self._key(path)[0])
+            except OSError:
+                continue
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except FileNotFoundError:
+            return 0
+        pruned = 0
+        for entry in entries:
+            # Temporary files belong to transcodes in progress, possibly in another process
+            key, extension = os.path.splitext(entry.name)
+            if extension != ".ogg" or key in keep:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Pruned by another process sharing the directory
+                continue
+            pruned += 1
+        return pruned
+
+    async def _load(self, key: str, path: str, gain: float) -> OpusClip:
+        loop = asyncio.get_running_loop()
+        cache_path = self._cache_path(key)
+        if not await loop.run_in_executor(None, os.path.exists, cache_path):
+            await self._transcode(path, cache_path, gain)
+        return await loop.run_in_executor(None, self._read_packets, cache_path)
+
+    async def _transcode(self, path: str, cache_path: str, gain: float):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        process = await asyncio.create_subprocess_exec(
+            self.ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", path,
+            "-vn", "-map_metadata", "-1", "-af", f"volume={gain:.1f}dB", "-ac", "2", "-ar", "48000",
+            "-c:a", "libopus", "-b:a", "96k", "-frame_duration", "20", "-application", "audio",
+            "-f", "ogg", tmp_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg couldn't transcode {path}: {stderr.decode(errors='replace').strip()}")
+        os.replace(tmp_path, cache_path)
+        log.info("Transcoded %s to %s", path, cache_path)
+
+    @staticmethod
+    def _read_packets(cache_path: str) -> OpusClip:
+        with open(cache_path, mode="rb") as file:
+            packets = [packet for packet in OggStream(file).iter_packets() if not packet.startswith(OPUS_HEADERS)]
+        return OpusClip(packets)
+
+    def _remember(self, path: str, key: str, clip: OpusClip):
+        previous = self._clips.pop(path, None)
+        if previous is not None:
+            self._bytes -= previous[1].size
+        self._clips[path] = (key, clip)
+        self._bytes += clip.size
+        while self._bytes > self.max_bytes and len(self._clips) > 1:
+            _, (_, evicted) = self._clips.popitem(last=False)
+            self._bytes -= evicted.size
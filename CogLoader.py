@@ -0,0 +1,158 @@
+import ast
+import asyncio
+import logging
+import os
+import time
+from typing import *
+
+from discord.ext import commands
+
+log = logging.getLogger(__name__)
+
+COG_DIR = "./cogs"
+
+
+class CommandStub(NamedTuple):
+    name: str
+    aliases: List[str]
+    brief: Optional[str]
+
+
+def discover_commands(path: str) -> List[CommandStub]:
+    """
+    Finds the commands a cog module defines by reading its source, without importing it. Only the name, aliases and
+    brief given as literals to @commands.command(...) or @commands.group(...) are picked up.
+    :param path: str
+    :return: List[CommandStub]
+    """
+    with open(path, encoding="utf-8") as file:
+        tree = ast.parse(file.read(), filename=path)
+    stubs = []
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for decorator in node.decorator_list:
+            if not (
+                isinstance(decorator, ast.Call)
+                and isinstance(decorator.func, ast.Attribute)
+                and decorator.func.attr in ("command", "group")
+            ):
+                continue
+            options = {}
+            for keyword in decorator.keywords:
+                try:
+                    options[keyword.arg] = ast.literal_eval(keyword.value)
+                except ValueError:
+                    pass
+            stubs.append(
+                CommandStub(options.get("name", node.name), list(options.get("aliases", [])), options.get("brief"))
+            )
+    return stubs
+
+
+class CogLoader:
+    """
+    Loads the extensions in ./cogs, either right away or lazily. A lazy extension isn't imported at startup; stand-in
+    commands with its commands' names and aliases are registered instead, and the first time one of them is used the
+    stand-ins are swapped for the real extension and the message is dispatched again. Listeners of a lazy cog only
+    start running once it's loaded, so cogs that must see events from the start have to be loaded eagerly.
+    How long each extension took to load is kept in timings.
+
+    reload() keeps a cog's warm state across a reload. A cog opts in by defining export_state, a coroutine that
+    flushes whatever is pending and returns the state, and import_state(state), which the new instance gets called
+    with right after it's constructed, before the event loop runs anything it scheduled in __init__. While handing
+    off, the old instance's handing_off is True so its cog_unload leaves the exported resources alone.
+    """
+
+    def __init__(self, client: commands.Bot, lazy: Iterable[str] = ()):
+        self.client = client
+        self.lazy = set(lazy)
+        self.timings: Dict[str, float] = {}
+        self._stubs: Dict[str, List[commands.Command]] = {}
+        self._lock = asyncio.Lock()
+
+    def load_all(self, directory: str = COG_DIR):
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".py"):
+                continue
+            name = filename[:-3]
+            if name in self.lazy:
+                self._register_stubs(name, os.path.join(directory, filename))
+            else:
+                self.load(name)
+
+    def load(self, name: str):
+        start = time.perf_counter()
+        self.client.load_extension(f"cogs.{name}")
+        self.timings[name] = time.perf_counter() - start
+
+    async def reload(self, name: str) -> float:
+        """
+        Reloads an extension, handing its cogs' state over to the new instances. A lazy extension that hasn't been
+        used yet is just loaded. Returns how long it took.
+        :param name: str
+        :return: float
+        """
+        start = time.perf_counter()
+        extension = f"cogs.{name}"
+        async with self._lock:
+            stubs = self._stubs.pop(name, None)
+            if stubs is not None:
+                for command in stubs:
+                    self.client.remove_command(command.name)
+                self.load(name)
+                return self.timings[name]
+
+            exported = {}
+            for cog in list(self.client.cogs.values()):
+                if type(cog).__module__ == extension and hasattr(cog, "export_state"):
+                    exported[cog.qualified_name] = (cog, await cog.export_state())
+                    cog.handing_off = True
+            try:
+                self.client.reload_extension(extension)
+            finally:
+                # Even if the reload failed: discord.py then runs the old module's setup again, making new instances
+                for cog_name, (old, state) in exported.items():
+                    cog = self.client.get_cog(cog_name)
+                    if cog is old:
+                        # It was never unloaded
+                        old.handing_off = False
+                    elif hasattr(cog, "import_state"):
+                        cog.import_state(state)
+                    else:
+                        log.warning("Nothing took over the state of %s after reloading %s", cog_name, extension)
+        self.timings[name] = time.perf_counter() - start
+        log.info("Reloaded %s in %.3fs", name, self.timings[name])
+        return self.timings[name]
+
+    def _register_stubs(self, name: str, path: str):
+        start = time.perf_counter()
+        stubs = [
+            commands.Command(self._load_and_dispatch(name), name=stub.name, aliases=stub.aliases, brief=stub.brief)
+            for stub in discover_commands(path)
+        ]
+        for command in stubs:
+            self.client.add_command(command)
+        self._stubs[name] = stubs
+        self.timings[f"{name} (lazy)"] = time.perf_counter() - start
+
+    def _load_and_dispatch(self, name: str):
+        async def load_and_dispatch(ctx, *args):
+            async with self._lock:
+                # Another command may have loaded it while this one waited
+                stubs = self._stubs.pop(name, None)
+                if stubs is not None:
+                    for command in stubs:
+                        self.client.remove_command(command.name)
+                    try:
+                        self.load(name)
+                    except Exception:
+                        # Put the stand-ins back so the next use tries again
+                        for command in stubs:
+                            self.client.add_command(command)
+                        self._stubs[name] = stubs
+                        raise
+                    log.info("Loaded %s on first use in %.3fs", name, self.timings[name])
+            await self.client.invoke(await self.client.get_context(ctx.message))
+
+        return load_and_dispatch
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import *
+
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# The event loop counts as stalled once a callback due now hasn't run for this many seconds
+LOOP_STALL_THRESHOLD = 0.25
+PROFILE_DIR = "./profiles/"
+# Seconds between the profiler's samples of every thread's stack
+PROFILE_INTERVAL = 0.005
+
+
+class LoopWatchdog:
+    """
+    Catches whatever blocks the event loop. The loop bumps a heartbeat every quarter threshold; a separate thread
+    checks it just as often, and when it has gone stale for longer than threshold the thread logs the loop thread's
+    stack as it is at that moment, which is inside the blocking call. Each stall is reported once, with its length
+    logged when the loop recovers.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float = LOOP_STALL_THRESHOLD):
+        self.loop = loop
+        self.threshold = threshold
+        self._last_beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self._beat)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _beat(self):
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        if not self._stopped.is_set():
+            self.loop.call_later(self.threshold / 4, self._beat)
+
+    def _watch(self):
+        worst = None
+        while not self._stopped.wait(self.threshold / 4):
+            if self._loop_thread is None or not self.loop.is_running():
+                continue
+            late = time.monotonic() - self._last_beat
+            if late <= self.threshold:
+                if worst is not None:
+                    log.warning("Event loop recovered after being blocked for at least %.0fms", worst * 1000)
+                    worst = None
+                continue
+            if worst is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable\n"
+                log.warning("Event loop blocked for %.0fms, currently in:\n%s", late * 1000, stack)
+                metrics.inc("bananabot_loop_stalls_total")
+            worst = late
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread every interval seconds for a while and writes the counts as folded stacks
+    ("thread;outer;...;inner count" per line), which flamegraph.pl, speedscope and inferno all read. Sampling happens
+    on its own thread, so a blocked event loop shows up in the profile instead of stopping it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.loop = loop
+        self.directory = directory
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self, duration: float) -> "asyncio.Future[Tuple[str, int]]":
+        """
+        Profiles for duration seconds, or until stop() is called. Returns a future of the path of the profile and
+        the number of samples in it. Raises RuntimeError if the profiler is already running.
+        :param duration: float
+        :return: asyncio.Future[Tuple[str, int]]
+        """
+        if self.running:
+            raise RuntimeError("The profiler is already running")
+        done = self.loop.create_future()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, args=(duration, done), name="profiler", daemon=True)
+        self._thread.start()
+        return done
+
+    def stop(self):
+        self._stopped.set()
+
+    def _sample(self, duration: float, done: asyncio.Future):
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {}
+        samples = 0
+        deadline = time.monotonic() + duration
+        while not self._stopped.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+
+        try:
+            path = self._write(stacks)
+        except OSError as e:
+            self.loop.call_soon_threadsafe(done.set_exception, e)
+            return
+        log.info("Wrote %d profile samples to %s", samples, path)
+        self.loop.call_soon_threadsafe(done.set_result, (path, samples))
+
+    def _write(self, stacks: Counter) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, mode="w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        return path
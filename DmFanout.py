@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from typing import *
+
+import discord
+
+from Outbound import BUCKET_CONCURRENCY, outbound
+
+log = logging.getLogger(__name__)
+
+# Users being DMed at once, as many as the dispatcher lets the "dm" bucket have in flight; the bucket's limit
+# decides how fast they actually go out
+DM_WORKERS = BUCKET_CONCURRENCY["dm"]
+# Tries per DM before it counts as failed, waiting 1, 2, 4... seconds in between
+DM_ATTEMPTS = 3
+# Seconds between progress reports
+DM_PROGRESS_INTERVAL = 5.0
+
+
+class FanoutProgress:
+    __slots__ = ("total", "sent", "skipped", "failed", "started")
+
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        # Users who don't accept DMs from the bot
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def describe(self) -> str:
+        text = f"{self.sent}/{self.total} DMs sent"
+        if self.skipped:
+            text += f", {self.skipped} skipped (DMs closed)"
+        if self.failed:
+            text += f", {self.failed} failed"
+        return text
+
+
+class DmFanout:
+    """
+    Sends the same DM to many users with a fixed number of workers, so even a sub of thousands only has workers DMs in
+    the outbound dispatcher at a time, where they run side by side, paced by its "dm" bucket and behind the replies to
+    commands. DMs that fail with a server error or a rate limit are retried; users who don't accept DMs from the bot are
+    skipped, and no single user stops the rest. on_progress, if given, is awaited with the progress every
+    progress_interval seconds while the DMs go out.
+    """
+
+    def __init__(
+        self,
+        users: Collection[discord.abc.User],
+        content: str,
+        workers: int = DM_WORKERS,
+        attempts: int = DM_ATTEMPTS,
+        on_progress: Optional[Callable[[FanoutProgress], Awaitable]] = None,
+        progress_interval: float = DM_PROGRESS_INTERVAL,
+    ):
+        self.users = users
+        self.content = content
+        self.workers = workers
+        self.attempts = attempts
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.progress = FanoutProgress(len(users))
+
+    async def run(self) -> FanoutProgress:
+        """
+        Sends every DM and returns the final progress. Logs the throughput once done.
+        :return: FanoutProgress
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        for user in self.users:
+            queue.put_nowait(user)
+        workers = [loop.create_task(self._work(queue)) for _ in range(min(self.workers, queue.qsize()))]
+        reporter = loop.create_task(self._report()) if self.on_progress is not None else None
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if reporter is not None:
+                reporter.cancel()
+
+        progress = self.progress
+        seconds = progress.elapsed
+        log.info(
+            "DM fan-out to %d users: %d sent, %d skipped, %d failed in %.2fs (%.1f DMs/s)",
+            progress.total, progress.sent, progress.skipped, progress.failed, seconds,
+            progress.sent / seconds if seconds > 0 else 0.0,
+        )
+        return progress
+
+    async def _work(self, queue: asyncio.Queue):
+        while not queue.empty():
+            await self._deliver(queue.get_nowait())
+
+    async def _deliver(self, user: discord.abc.User):
+        for attempt in range(self.attempts):
+            try:
+                await outbound.send_dm(user, self.content)
+            except discord.Forbidden:
+                self.progress.skipped += 1
+                return
+            except discord.HTTPException as e:
+                # Anything but a server error or a rate limit would fail the same way again
+                if e.status < 500 and e.status != 429:
+                    log.warning("Couldn't DM %s: %s", user.id, e)
+                    break
+                if attempt + 1 < self.attempts:
+                    await asyncio.sleep(2 ** attempt)
+            else:
+                self.progress.sent += 1
+                return
+        self.progress.failed += 1
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await self.on_progress(self.progress)
+            except discord.HTTPException as e:
+                log.warning("Couldn't report DM fan-out progress: %s", e)
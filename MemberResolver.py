@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from typing import *
+
+import discord
+
+log = logging.getLogger(__name__)
+
+# The gateway accepts at most this many user ids per member query
+QUERY_BATCH_SIZE = 100
+
+
+class MemberResolver:
+    """
+    Turns user ids into guild members with as few round-trips as possible. The gateway member cache is checked first,
+    then a short-lived cache of earlier lookups, and whatever is left is requested through gateway member queries
+    (falling back to concurrent REST fetches with bounded concurrency if the query is unavailable).
+    """
+
+    def __init__(self, ttl: float = 300, concurrency: int = 8, max_cached: int = 10000):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.max_cached = max_cached
+        self._cache: Dict[Tuple[int, int], Tuple[float, discord.Member]] = {}
+
+    async def resolve(
+        self, guild: discord.Guild, user_ids: Iterable[int]
+    ) -> Tuple[List[discord.Member], List[int]]:
+        """
+        Resolves user_ids in guild. Returns the members found, in the order of user_ids, and the ids of users that are
+        no longer in the guild. Ids that failed for any other reason are in neither list.
+        :param guild: discord.Guild
+        :param user_ids: Iterable[int]
+        :return: Tuple[List[discord.Member], List[int]]
+        """
+        user_ids = list(user_ids)
+        now = time.monotonic()
+        found: Dict[int, discord.Member] = {}
+        misses = []
+        for user_id in user_ids:
+            member = guild.get_member(user_id)
+            if member is None:
+                cached = self._cache.get((guild.id, user_id))
+                if cached is not None and cached[0] > now:
+                    member = cached[1]
+            if member is None:
+                misses.append(user_id)
+            else:
+                found[user_id] = member
+
+        gone = []
+        if misses:
+            fetched, gone = await self._fetch(guild, misses)
+            expires = now + self.ttl
+            for member in fetched:
+                found[member.id] = member
+                self._cache[(guild.id, member.id)] = (expires, member)
+            self._evict(now)
+
+        return [found[user_id] for user_id in user_ids if user_id in found], gone
+
+    async def _fetch(self, guild: discord.Guild, user_ids: List[int]) -> Tuple[List[discord.Member], List[int]]:
+        try:
+            members = []
+            for start in range(0, len(user_ids), QUERY_BATCH_SIZE):
+                batch = user_ids[start:start + QUERY_BATCH_SIZE]
+                members += await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            log.debug("Member query failed in guild %s (%s), fetching members individually", guild.id, e)
+            return await self._fetch_each(guild, user_ids)
+        # A query by id is authoritative, so anyone it didn't return has left
+        returned = {member.id for member in members}
+        return members, [user_id for user_id in user_ids if user_id not in returned]
+
+    async def _fetch_each(self, guild: discord.Guild, user_ids: List[int]) -> Tuple[List[discord.Member], List[int]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        members = []
+        gone = []
+
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    members.append(await guild.fetch_member(user_id))
+                except discord.NotFound:
+                    gone.append(user_id)
+                except discord.HTTPException as e:
+                    log.warning("Couldn't fetch member %s in guild %s: %s", user_id, guild.id, e)
+
+        await asyncio.gather(*(fetch(user_id) for user_id in user_ids))
+        return members, gone
+
+    def _evict(self, now: float):
+        if len(self._cache) <= self.max_cached:
+            return
+        for key in [key for key, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[key]
+        # Still too big: drop the oldest entries (dicts keep insertion order)
+        while len(self._cache) > self.max_cached:
+            del self._cache[next(iter(self._cache))]
@@ -0,0 +1,280 @@
+import asyncio
+import bisect
+import logging
+import math
+import time
+from collections import Counter
+from typing import *
+
+import discord
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, fine enough to tell a cache hit from a REST round-trip from a stall
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# How often the event loop lag and gateway latency are sampled
+LOOP_LAG_INTERVAL = 0.5
+# Guilds per shard are counted every this many samples, since it means walking every guild
+SHARD_GUILDS_EVERY = 20
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus sense. observe() is a bisect and two additions.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts[i] is the number of observations in (buckets[i - 1], buckets[i]]; the last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the q-quantile by interpolating within the bucket it falls in, like Prometheus' histogram_quantile.
+        :param q: float
+        :return: float
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    A small registry of labelled counters, gauges and histograms that renders itself in the Prometheus text format.
+    Metrics are declared once with their type and help text; recording to one is a dict lookup and an update.
+    """
+
+    def __init__(self):
+        # name -> (type, help)
+        self._declared: Dict[str, Tuple[str, str]] = {}
+        # name -> labels -> float or Histogram
+        self._values: Dict[str, Dict[Labels, Union[float, Histogram]]] = {}
+
+    def declare(self, name: str, kind: str, help_text: str):
+        self._declared[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        values = self._values[name]
+        key = tuple(labels.items())
+        values[key] = values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        self._values[name][tuple(labels.items())] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        values = self._values[name]
+        key = tuple(labels.items())
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = Histogram()
+        histogram.observe(value)
+
+    def get(self, name: str) -> Dict[Labels, Union[float, Histogram]]:
+        return self._values[name]
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        :return: str
+        """
+        lines = []
+        for name, (kind, help_text) in self._declared.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in list(self._values[name].items()):
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip((*value.buckets, math.inf), value.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+metrics.declare("bananabot_command_seconds", "histogram", "Time taken by each command, labelled by command and cog.")
+metrics.declare("bananabot_command_errors_total", "counter", "Commands that raised, labelled by command and error.")
+metrics.declare("bananabot_rest_requests_total", "counter", "Discord REST requests, labelled by route and status.")
+metrics.declare("bananabot_rest_seconds", "histogram", "Time taken by Discord REST requests, labelled by route.")
+metrics.declare("bananabot_loop_lag_seconds", "histogram", "How late the event loop ran a timer due now.")
+metrics.declare("bananabot_gateway_latency_seconds", "gauge", "Gateway heartbeat latency.")
+metrics.declare("bananabot_shard_latency_seconds", "gauge", "Gateway heartbeat latency of each shard.")
+metrics.declare("bananabot_shard_guilds", "gauge", "Guilds on each shard.")
+metrics.declare("bananabot_loop_stalls_total", "counter", "Times the event loop was blocked past the stall threshold.")
+metrics.declare("bananabot_outbound_queue_depth", "gauge", "Outbound requests waiting to be sent, labelled by priority.")
+metrics.declare("bananabot_outbound_wait_seconds", "histogram", "Time outbound requests spent queued, by priority.")
+metrics.declare("bananabot_outbound_coalesced_total", "counter", "Queued requests replaced by a newer one, by kind.")
+
+
+def summary() -> str:
+    """
+    Returns a short human-readable digest of the metrics, for the stats command.
+    :return: str
+    """
+    commands: Dict[str, Histogram] = {}
+    cogs: Dict[str, Histogram] = {}
+    for labels, histogram in metrics.get("bananabot_command_seconds").items():
+        labels = dict(labels)
+        commands.setdefault(labels["command"], Histogram()).merge(histogram)
+        cogs.setdefault(labels["cog"], Histogram()).merge(histogram)
+
+    def describe(histogram: Histogram) -> str:
+        return (
+            f"{histogram.count} calls, p50 {histogram.quantile(0.5) * 1000:.0f}ms, "
+            f"p99 {histogram.quantile(0.99) * 1000:.0f}ms"
+        )
+
+    lines = ["Commands:"]
+    lines += [f"  {name}: {describe(histogram)}" for name, histogram in sorted(commands.items())] or ["  none yet"]
+    lines.append("Cogs:")
+    lines += [f"  {name}: {describe(histogram)}" for name, histogram in sorted(cogs.items())] or ["  none yet"]
+
+    errors = sum(metrics.get("bananabot_command_errors_total").values())
+    requests = metrics.get("bananabot_rest_requests_total")
+    failed = sum(count for labels, count in requests.items() if dict(labels)["status"] != "ok")
+    lines.append(f"Errors: {errors:.0f}")
+    lines.append(f"REST requests: {sum(requests.values()):.0f} ({failed:.0f} failed)")
+
+    depth = metrics.get("bananabot_outbound_queue_depth")
+    if depth:
+        queued = ", ".join(f"{dict(labels)['priority']} {count:.0f}" for labels, count in depth.items())
+        coalesced = sum(metrics.get("bananabot_outbound_coalesced_total").values())
+        lines.append(f"Outbound queue: {queued} ({coalesced:.0f} coalesced)")
+
+    lag = Histogram()
+    for histogram in metrics.get("bananabot_loop_lag_seconds").values():
+        lag.merge(histogram)
+    if lag.count:
+        lines.append(f"Loop lag: p50 {lag.quantile(0.5) * 1000:.1f}ms, p99 {lag.quantile(0.99) * 1000:.1f}ms")
+    for latency in metrics.get("bananabot_gateway_latency_seconds").values():
+        lines.append(f"Gateway latency: {latency * 1000:.0f}ms")
+    latencies = metrics.get("bananabot_shard_latency_seconds")
+    guilds = metrics.get("bananabot_shard_guilds")
+    for labels in sorted(latencies, key=lambda labels: int(dict(labels)["shard"])):
+        shard = dict(labels)["shard"]
+        lines.append(f"Shard {shard}: {latencies[labels] * 1000:.0f}ms, {guilds.get(labels, 0):.0f} guilds")
+    return "\n".join(lines)
+
+
+def command_started(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+
+def command_finished(ctx, error: Optional[Exception] = None):
+    """
+    Records how long the command in ctx took, and the error it raised if any.
+    """
+    started = getattr(ctx, "metrics_started", None)
+    command = ctx.command.qualified_name if ctx.command is not None else "unknown"
+    if started is not None:
+        cog = ctx.cog.qualified_name if ctx.cog is not None else "none"
+        metrics.observe("bananabot_command_seconds", time.perf_counter() - started, command=command, cog=cog)
+    if error is not None:
+        metrics.inc("bananabot_command_errors_total", command=command, error=type(error).__name__)
+
+
+def instrument_http(http):
+    """
+    Wraps the client's HTTP client so every REST request is counted and timed by route.
+    """
+    request = http.request
+
+    async def instrumented_request(route, **kwargs):
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        finally:
+            # The unformatted path keeps ids out of the labels
+            name = f"{route.method} {route.path}"
+            metrics.observe("bananabot_rest_seconds", time.perf_counter() - start, route=name)
+            metrics.inc("bananabot_rest_requests_total", route=name, status=status)
+
+    http.request = instrumented_request
+
+
+async def watch_loop(client: discord.Client, interval: float = LOOP_LAG_INTERVAL):
+    """
+    Samples the event loop's lag and the gateway latency every interval seconds, forever. A sharded client also has
+    each shard's latency and guild count sampled, to show when shards need rebalancing.
+    """
+    samples = 0
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        metrics.observe("bananabot_loop_lag_seconds", max(0.0, time.perf_counter() - expected))
+        if math.isfinite(client.latency):
+            metrics.set("bananabot_gateway_latency_seconds", client.latency)
+
+        if not isinstance(client, discord.AutoShardedClient):
+            continue
+        for shard_id, latency in client.latencies:
+            if math.isfinite(latency):
+                metrics.set("bananabot_shard_latency_seconds", latency, shard=str(shard_id))
+        if samples % SHARD_GUILDS_EVERY == 0:
+            counts = Counter(guild.shard_id for guild in client.guilds)
+            for shard_id in client.shards:
+                metrics.set("bananabot_shard_guilds", counts[shard_id], shard=str(shard_id))
+        samples += 1
+
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    """
+    Serves the metrics at http://host:port/metrics. Returns the runner, which stops the server on cleanup().
+    """
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return runner
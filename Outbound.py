@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from enum import IntEnum
+from typing import *
+
+import discord
+
+from Metrics import metrics
+
+# (requests, per seconds) Discord allows in each kind of bucket, per channel unless noted
+BUCKET_LIMITS = {
+    "send": (5, 5.0),
+    "edit": (5, 5.0),
+    "reaction": (1, 0.25),
+    # All DMs share one bucket: Discord doesn't publish a limit, but bots that DM quickly get flagged as spam
+    "dm": (5, 1.0),
+    # Presence goes over the gateway and is limited per connection
+    "presence": (5, 20.0),
+}
+# Requests a bucket may have in flight at once, 1 unless listed; one at a time keeps a channel's messages in order,
+# but DMs to different users have no order to keep
+BUCKET_CONCURRENCY = {
+    "dm": 8,
+}
+# Discord's limit on requests per second across every bucket
+GLOBAL_LIMIT = (50, 1.0)
+
+
+class Priority(IntEnum):
+    # Replies to whoever used a command
+    REPLY = 0
+    # Updates to messages people are looking at
+    EDIT = 1
+    # Work somebody started but isn't watching item by item, like an atsub's DMs
+    BULK = 2
+    # Things nobody is waiting for: reaction seeding, presence
+    COSMETIC = 3
+
+
+class _Window:
+    """
+    Sliding-window count of the requests made in the last per seconds.
+    """
+
+    __slots__ = ("limit", "per", "sent")
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.sent: Deque[float] = deque()
+
+    def available_at(self, now: float) -> float:
+        while self.sent and self.sent[0] <= now - self.per:
+            self.sent.popleft()
+        return now if len(self.sent) < self.limit else self.sent[0] + self.per
+
+    def record(self, now: float):
+        self.sent.append(now)
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "run", "future", "key", "queued_at")
+
+    def __init__(self, priority: int, seq: int, run: Callable[[], Awaitable], future: asyncio.Future,
+                 key: Optional[Hashable], queued_at: float):
+        self.priority = priority
+        self.seq = seq
+        self.run = run
+        self.future = future
+        self.key = key
+        self.queued_at = queued_at
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Bucket:
+    __slots__ = ("window", "jobs", "running", "concurrency")
+
+    def __init__(self, limit: int, per: float, concurrency: int = 1):
+        self.window = _Window(limit, per)
+        self.jobs: List[_Job] = []
+        self.running = 0
+        self.concurrency = concurrency
+
+
+class OutboundDispatcher:
+    """
+    Single way out for the REST work the cogs do. Requests are queued per rate limit bucket (kind of request and
+    channel) and a scheduler starts the most urgent one whose bucket, by local bookkeeping of Discord's limits, has
+    room, so replies go out ahead of edits and edits ahead of cosmetic work instead of racing them for the same bucket.
+    A bucket runs one request at a time, which keeps messages in order, unless BUCKET_CONCURRENCY lets it run more. An
+    edit or presence change queued while an older one of the same fields of the same target is still waiting replaces
+    it, and both callers get the one result.
+    Queue depth, waiting time and coalescing are recorded in the metrics.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]] = None, global_limit: Tuple[int, float] = GLOBAL_LIMIT):
+        self._buckets: Dict[Tuple[str, int], _Bucket] = {}
+        self.set_limits(limits or BUCKET_LIMITS, global_limit)
+        self._pending: Dict[Hashable, _Job] = {}
+        self._depth = {priority: 0 for priority in Priority}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def set_limits(self, limits: Dict[str, Tuple[int, float]], global_limit: Tuple[int, float] = GLOBAL_LIMIT):
+        """
+        Replaces the limits the buckets are paced to. Buckets already in use keep their old ones.
+        """
+        self.limits = limits
+        self._global = _Window(*global_limit)
+
+    async def send(self, destination: discord.abc.Messageable, content=None, *, priority: Priority = Priority.REPLY,
+                   **kwargs) -> discord.Message:
+        channel = getattr(destination, "channel", destination)
+        return await self.submit("send", channel.id, priority, lambda: destination.send(content, **kwargs))
+
+    async def send_dm(self, user: discord.abc.User, content=None, *, priority: Priority = Priority.BULK,
+                      **kwargs) -> discord.Message:
+        return await self.submit("dm", 0, priority, lambda: user.send(content, **kwargs))
+
+    async def edit(self, message: Union[discord.Message, discord.PartialMessage], *,
+                   priority: Priority = Priority.EDIT, **fields):
+        # Only edits of the same fields replace each other, so an edit of the embed doesn't swallow one of the content
+        key = ("edit", message.id, tuple(sorted(fields)))
+        return await self.submit("edit", message.channel.id, priority, lambda: message.edit(**fields), key=key)
+
+    async def add_reaction(self, message: Union[discord.Message, discord.PartialMessage], emoji,
+                           priority: Priority = Priority.COSMETIC):
+        return await self.submit("reaction", message.channel.id, priority, lambda: message.add_reaction(emoji))
+
+    async def change_presence(self, client: discord.Client, priority: Priority = Priority.COSMETIC, **kwargs):
+        # Like edits, only changes of the same fields replace each other, so an activity change doesn't swallow a queued
+        # status change
+        key = ("presence", tuple(sorted(kwargs)))
+        return await self.submit("presence", 0, priority, lambda: client.change_presence(**kwargs), key=key)
+
+    def submit(self, kind: str, channel_id: int, priority: Priority, run: Callable[[], Awaitable],
+               key: Optional[Hashable] = None) -> asyncio.Future:
+        """
+        Queues run (a function returning the request's awaitable) in the bucket of kind and channel_id. Returns a
+        future of its result. If key is given and a job with the same key is still queued, that job runs this
+        request instead and its future is returned.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._schedule())
+
+        if key is not None:
+            queued = self._pending.get(key)
+            if queued is not None:
+                queued.run = run
+                metrics.inc("bananabot_outbound_coalesced_total", kind=kind)
+                return queued.future
+
+        bucket = self._buckets.get((kind, channel_id))
+        if bucket is None:
+            bucket = self._buckets[(kind, channel_id)] = _Bucket(
+                *self.limits[kind], BUCKET_CONCURRENCY.get(kind, 1)
+            )
+        job = _Job(priority, next(self._seq), run, loop.create_future(), key, loop.time())
+        heapq.heappush(bucket.jobs, job)
+        if key is not None:
+            self._pending[key] = job
+        self._set_depth(priority, 1)
+        self._wakeup.set()
+        return job.future
+
+    def _set_depth(self, priority: Priority, change: int):
+        self._depth[priority] += change
+        metrics.set("bananabot_outbound_queue_depth", self._depth[priority], priority=priority.name.lower())
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            best: Optional[Tuple[_Job, Tuple[str, int]]] = None
+            retry_at = None
+            for bucket_key, bucket in list(self._buckets.items()):
+                if not bucket.jobs:
+                    # Forgotten once nothing it sent still counts against its limit; available_at prunes the window
+                    bucket.window.available_at(now)
+                    if not bucket.running and not bucket.window.sent:
+                        del self._buckets[bucket_key]
+                    continue
+                if bucket.running >= bucket.concurrency:
+                    continue
+                available = bucket.window.available_at(now)
+                if available > now:
+                    retry_at = available if retry_at is None else min(retry_at, available)
+                elif best is None or bucket.jobs[0] < best[0]:
+                    best = (bucket.jobs[0], bucket_key)
+
+            if best is not None:
+                available = self._global.available_at(now)
+                if available <= now:
+                    self._start(self._buckets[best[1]], now)
+                    continue
+                retry_at = available if retry_at is None else min(retry_at, available)
+
+            if retry_at is None and self._buckets:
+                # Idle buckets are dropped on a later pass, once their windows have emptied
+                retry_at = now + max(bucket.window.per for bucket in self._buckets.values())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if retry_at is None else retry_at - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, bucket: _Bucket, now: float):
+        job = heapq.heappop(bucket.jobs)
+        if job.key is not None:
+            self._pending.pop(job.key, None)
+        self._set_depth(job.priority, -1)
+        if job.future.done():
+            # Its caller gave up waiting
+            return
+        bucket.running += 1
+        bucket.window.record(now)
+        self._global.record(now)
+        metrics.observe("bananabot_outbound_wait_seconds", now - job.queued_at, priority=job.priority.name.lower())
+        asyncio.get_running_loop().create_task(self._run(bucket, job))
+
+    async def _run(self, bucket: _Bucket, job: _Job):
+        try:
+            result = await job.run()
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            bucket.running -= 1
+            self._wakeup.set()
+
+
+outbound = OutboundDispatcher()
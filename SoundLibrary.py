@@ -0,0 +1,240 @@
+import os
+import threading
+from typing import *
+
+from Utilities import PrefixIndex, TrigramIndex
+
+SOUND_ROOT = "./cogs/soundboard/"
+SOUND_EXTENSION = ".mp3"
+# Discord's limit on the length of a message's content, less some room for a page footer
+PAGE_LIMIT = 1900
+# Most sounds suggested when a name is ambiguous
+SUGGESTION_LIMIT = 5
+# A fuzzy match is only played without asking if it scores at least this, and beats the runner-up by FUZZY_MARGIN
+FUZZY_PLAY_SCORE = 0.5
+FUZZY_MARGIN = 0.15
+
+
+class _Directory:
+    __slots__ = ("mtime", "entries")
+
+    def __init__(self, mtime: int, entries: List[Tuple[str, bool]]):
+        self.mtime = mtime
+        # (name, is_directory), sorted by name
+        self.entries = entries
+
+
+class SoundLibrary:
+    """
+    In-memory index of the sound directory. build() and refresh() touch the filesystem and are meant to run in an
+    executor; everything else only reads the index and is safe to call from the event loop. A refresh only rescans
+    the directories whose mtime changed, and swaps in the new index in one assignment so readers never see a
+    half-updated tree.
+    Paths are relative to the root, "/"-separated and without the sound extension, e.g. "memes/bruh".
+    Every sound can also be found by its name alone ("bruh"), by prefix and by fuzzy match through a prefix index and
+    a trigram index. Those are patched with just the sounds that were added or removed on each refresh.
+    """
+
+    def __init__(self, root: str = SOUND_ROOT):
+        self.root = root
+        self._dirs: Dict[str, _Directory] = {}
+        self._sounds: Dict[str, str] = {}
+        self._pages: Dict[str, List[str]] = {}
+        self._refresh_lock = threading.Lock()
+        # Held only while the name indexes are patched or searched, never during a scan
+        self._index_lock = threading.Lock()
+        # Path or name -> paths of the sounds it refers to
+        self._aliases: Dict[str, Set[str]] = {}
+        self._prefixes = PrefixIndex()
+        self._trigrams = TrigramIndex()
+
+    def __len__(self):
+        return len(self._sounds)
+
+    def build(self):
+        """
+        Scans the whole sound directory, replacing the current index.
+        """
+        self._refresh(rescan=True)
+
+    def refresh(self) -> bool:
+        """
+        Brings the index up to date with the filesystem. Returns True iff anything changed.
+        :return: bool
+        """
+        return self._refresh(rescan=False)
+
+    def _refresh(self, rescan: bool) -> bool:
+        with self._refresh_lock:
+            dirs = {} if rescan else dict(self._dirs)
+            sounds = {} if rescan else dict(self._sounds)
+            changed = self._sync("", dirs, sounds)
+            if changed:
+                with self._index_lock:
+                    for path in self._sounds.keys() - sounds.keys():
+                        self._unindex(path)
+                    for path in sounds.keys() - self._sounds.keys():
+                        self._index(path)
+                    self._dirs, self._sounds, self._pages = dirs, sounds, {}
+            return changed
+
+    def _sync(self, rel: str, dirs: Dict[str, _Directory], sounds: Dict[str, str]) -> bool:
+        full = os.path.join(self.root, rel)
+        try:
+            mtime = os.stat(full).st_mtime_ns
+        except FileNotFoundError:
+            return self._forget(rel, dirs, sounds)
+
+        known = dirs.get(rel)
+        changed = False
+        if known is None or known.mtime != mtime:
+            entries = sorted((entry.name, entry.is_dir()) for entry in os.scandir(full))
+            old_entries = set(known.entries) if known is not None else set()
+            for name, is_dir in old_entries - set(entries):
+                if is_dir:
+                    self._forget(self._join(rel, name), dirs, sounds)
+                else:
+                    sounds.pop(self._sound_key(rel, name), None)
+            for name, is_dir in entries:
+                if not is_dir and name.endswith(SOUND_EXTENSION):
+                    sounds[self._sound_key(rel, name)] = os.path.join(full, name)
+            dirs[rel] = _Directory(mtime, entries)
+            changed = True
+
+        # Subdirectories have their own mtimes, so they are checked even if this one is unchanged
+        for name, is_dir in dirs[rel].entries:
+            if is_dir:
+                changed |= self._sync(self._join(rel, name), dirs, sounds)
+        return changed
+
+    def _forget(self, rel: str, dirs: Dict[str, _Directory], sounds: Dict[str, str]) -> bool:
+        known = dirs.pop(rel, None)
+        if known is None:
+            return False
+        for name, is_dir in known.entries:
+            if is_dir:
+                self._forget(self._join(rel, name), dirs, sounds)
+            else:
+                sounds.pop(self._sound_key(rel, name), None)
+        return True
+
+    @staticmethod
+    def _aliases_of(path: str) -> Set[str]:
+        return {path, path.rsplit("/", 1)[-1]}
+
+    def _index(self, path: str):
+        for alias in self._aliases_of(path):
+            paths = self._aliases.setdefault(alias, set())
+            if not paths:
+                self._prefixes.add(alias)
+                self._trigrams.add(alias)
+            paths.add(path)
+
+    def _unindex(self, path: str):
+        for alias in self._aliases_of(path):
+            paths = self._aliases.get(alias)
+            if paths is None:
+                continue
+            paths.discard(path)
+            if not paths:
+                del self._aliases[alias]
+                self._prefixes.remove(alias)
+                self._trigrams.remove(alias)
+
+    @staticmethod
+    def _join(rel: str, name: str) -> str:
+        return f"{rel}/{name}" if rel else name
+
+    @classmethod
+    def _sound_key(cls, rel: str, name: str) -> str:
+        return cls._join(rel, name[:-len(SOUND_EXTENSION)] if name.endswith(SOUND_EXTENSION) else name)
+
+    def lookup(self, path: str) -> Optional[str]:
+        """
+        Returns the filesystem path of the sound at path, or None if there isn't one.
+        :param path: str
+        :return: Optional[str]
+        """
+        return self._sounds.get(path.strip("/"))
+
+    def resolve(self, query: str, limit: int = SUGGESTION_LIMIT) -> Tuple[Optional[str], List[str]]:
+        """
+        Finds the sound query refers to, which may be a path, a name, the start of either (with the same MIN_MATCH
+        rules as subscriptions) or a misspelling of either. Returns its path, or None and up to limit suggestions,
+        best first, if query is ambiguous or doesn't match anything.
+        :param query: str
+        :param limit: int
+        :return: Tuple[Optional[str], List[str]]
+        """
+        query = query.strip("/")
+        if query in self._sounds:
+            return query, []
+        with self._index_lock:
+            aliases = self._prefixes.match(query)
+            if aliases is not None:
+                paths = sorted({path for alias in aliases for path in self._aliases[alias]}, key=lambda p: (len(p), p))
+                return (paths[0], []) if len(paths) == 1 else (None, paths[:limit])
+            if len(query) < self._prefixes.min_match:
+                return None, []
+
+            # A sound reachable through several aliases keeps its best score
+            scores: Dict[str, float] = {}
+            for alias, score in self._trigrams.search(query, limit * 2):
+                for path in sorted(self._aliases[alias]):
+                    scores.setdefault(path, score)
+        ranked = list(scores)
+        if ranked and scores[ranked[0]] >= FUZZY_PLAY_SCORE and (
+            len(ranked) == 1 or scores[ranked[0]] - scores[ranked[1]] >= FUZZY_MARGIN
+        ):
+            return ranked[0], []
+        return None, ranked[:limit]
+
+    def paths(self) -> List[str]:
+        """
+        Returns the filesystem path of every sound.
+        :return: List[str]
+        """
+        return list(self._sounds.values())
+
+    def listing(self, path: str) -> Optional[List[str]]:
+        """
+        Returns the recursive listing of the directory at path split into pages that fit in a message, or None if
+        the directory doesn't exist. Pages are rendered once per directory and kept until the index changes.
+        :param path: str
+        :return: Optional[List[str]]
+        """
+        path = path.strip("/")
+        # A refresh may swap the index out from under us, so work from the current one throughout
+        dirs, cache = self._dirs, self._pages
+        pages = cache.get(path)
+        if pages is None:
+            if path not in dirs:
+                return None
+            lines = []
+            self._render(dirs, path, 0, lines)
+            pages = self._paginate(lines)
+            cache[path] = pages
+        return pages
+
+    def _render(self, dirs: Dict[str, _Directory], rel: str, depth: int, lines: List[str]):
+        for name, is_dir in dirs[rel].entries:
+            if is_dir:
+                lines.append(f"{'  ' * depth}/{name}\n")
+                self._render(dirs, self._join(rel, name), depth + 1, lines)
+            else:
+                lines.append(f"{'  ' * depth}-{name.split('.', 1)[0]}\n")
+
+    @staticmethod
+    def _paginate(lines: List[str]) -> List[str]:
+        pages = []
+        current = []
+        length = 0
+        for line in lines:
+            if current and length + len(line) > PAGE_LIMIT:
+                pages.append("".join(current))
+                current = []
+                length = 0
+            current.append(line)
+            length += len(line)
+        pages.append("".join(current) or "There are no sounds here.")
+        return pages
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import *
+
+import discord
+import numpy as np
+
+from ClipCache import OpusClip
+from config import SOUND_MAX_OVERLAP, SOUND_QUEUE_SIZE
+
+log = logging.getLogger(__name__)
+
+# Interleaved stereo samples in one 20ms frame
+FRAME_SAMPLES = discord.opus.Encoder.SAMPLES_PER_FRAME * discord.opus.Encoder.CHANNELS
+
+
+class MixerStream:
+    """
+    One clip playing through an AudioMixer, with its own gain. Packets are only decoded when the stream has to be
+    mixed with others.
+    """
+
+    __slots__ = ("clip", "gain", "_position", "_decoder")
+
+    def __init__(self, clip: OpusClip, gain: float = 1.0):
+        self.clip = clip
+        self.gain = gain
+        self._position = 0
+        self._decoder: Optional[discord.opus.Decoder] = None
+
+    def next_packet(self) -> Optional[bytes]:
+        if self._position >= len(self.clip.packets):
+            return None
+        packet = self.clip.packets[self._position]
+        self._position += 1
+        return packet
+
+    def next_pcm(self) -> Optional[np.ndarray]:
+        packet = self.next_packet()
+        if packet is None:
+            return None
+        # A decoder that starts mid-clip (after passthrough) settles within a frame or two
+        if self._decoder is None:
+            self._decoder = discord.opus.Decoder()
+        return np.frombuffer(self._decoder.decode(packet), dtype="<i2")
+
+
+class AudioMixer(discord.AudioSource):
+    """
+    Sums every active stream into one 20ms frame per read. A lone stream at unit gain is passed through as Opus
+    untouched; otherwise the decoded frames are stacked and mixed in one matrix product with per-stream gain, then
+    clipped to 16 bits, into buffers allocated once for max_streams. read() runs on the audio thread, so the stream
+    list is guarded by a lock and on_stream_end is called from that thread.
+    """
+
+    def __init__(self, max_streams: int, on_stream_end: Callable[[MixerStream], None]):
+        self.max_streams = max_streams
+        self.on_stream_end = on_stream_end
+        self._streams: List[MixerStream] = []
+        self._lock = threading.Lock()
+        self._opus = False
+        self._frames = np.zeros((max_streams, FRAME_SAMPLES), dtype=np.float32)
+        self._gains = np.zeros(max_streams, dtype=np.float32)
+        self._mixed = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+
+    def __len__(self):
+        return len(self._streams)
+
+    def add(self, stream: MixerStream) -> bool:
+        """
+        Starts mixing in stream. Returns False if the mixer already has max_streams streams.
+        """
+        with self._lock:
+            if len(self._streams) >= self.max_streams:
+                return False
+            self._streams.append(stream)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._streams.clear()
+
+    def read(self) -> bytes:
+        with self._lock:
+            streams = list(self._streams)
+
+        if len(streams) == 1 and streams[0].gain == 1.0:
+            packet = streams[0].next_packet()
+            if packet is not None:
+                self._opus = True
+                return packet
+            self._finish(streams[0])
+            return b""
+
+        count = 0
+        for stream in streams:
+            pcm = stream.next_pcm()
+            if pcm is None:
+                self._finish(stream)
+                continue
+            self._frames[count, :len(pcm)] = pcm
+            self._frames[count, len(pcm):] = 0
+            self._gains[count] = stream.gain
+            count += 1
+        if count == 0:
+            return b""
+
+        np.matmul(self._gains[:count], self._frames[:count], out=self._mixed)
+        np.clip(self._mixed, -32768, 32767, out=self._mixed)
+        self._opus = False
+        return self._mixed.astype("<i2").tobytes()
+
+    def _finish(self, stream: MixerStream):
+        with self._lock:
+            self._streams.remove(stream)
+        self.on_stream_end(stream)
+
+    def is_opus(self) -> bool:
+        # The voice client asks after each read, so this describes the frame that was just returned
+        return self._opus
+
+    def cleanup(self):
+        self.clear()
+
+
+class GuildPlayer:
+    """
+    Plays clips in one guild through an AudioMixer, so up to max_overlap clips play at once and the rest wait in a
+    bounded queue. Everything is event driven: a clip ending makes room for the next queued one, and the mixer running
+    dry ends playback through the voice client's after= callback, which calls on_idle once nothing is left to play.
+    The connection itself belongs to the caller.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        on_idle: Callable[[], None],
+        max_queue: int = SOUND_QUEUE_SIZE,
+        max_overlap: int = SOUND_MAX_OVERLAP,
+    ):
+        self.loop = loop
+        self.on_idle = on_idle
+        self.max_queue = max_queue
+        self.max_overlap = max_overlap
+        self.voice: Optional[discord.VoiceClient] = None
+        self.mixer: Optional[AudioMixer] = None
+        self.queue: Deque[OpusClip] = deque()
+
+    def enqueue(self, voice: discord.VoiceClient, clip: OpusClip) -> int:
+        """
+        Mixes clip in right away if there is room, otherwise queues it. Returns the number of clips ahead of it.
+        Raises asyncio.QueueFull if the queue is full.
+        :param voice: discord.VoiceClient
+        :param clip: OpusClip
+        :return: int
+        """
+        self.voice = voice
+        if self._is_mixing():
+            if not self.queue and self.mixer.add(MixerStream(clip)):
+                return 0
+            if len(self.queue) >= self.max_queue:
+                raise asyncio.QueueFull
+            self.queue.append(clip)
+            return len(self.queue)
+        self._start(clip)
+        return 0
+
+    def skip(self) -> bool:
+        """
+        Stops everything that is playing, which moves on to the queued clips. Returns True iff something was playing.
+        """
+        if self.voice is None or not self.voice.is_playing():
+            return False
+        self.voice.stop()
+        return True
+
+    def clear(self) -> int:
+        """
+        Empties the queue without touching the clips that are playing. Returns the number of clips removed.
+        """
+        removed = len(self.queue)
+        self.queue.clear()
+        return removed
+
+    def close(self):
+        self.clear()
+
+    def _is_mixing(self) -> bool:
+        return self.mixer is not None and self.voice.is_playing() and self.voice.source is self.mixer
+
+    def _start(self, clip: OpusClip):
+        self.mixer = AudioMixer(self.max_overlap, self._stream_ended)
+        self.mixer.add(MixerStream(clip))
+        self.voice.play(self.mixer, after=self._after)
+
+    def _stream_ended(self, stream: MixerStream):
+        # Runs on the audio thread
+        self.loop.call_soon_threadsafe(self._fill)
+
+    def _fill(self):
+        while self.queue and self._is_mixing() and self.mixer.add(MixerStream(self.queue[0])):
+            self.queue.popleft()
+
+    def _after(self, error: Optional[Exception]):
+        # Runs on the audio thread
+        if error is not None:
+            log.error("Playback failed", exc_info=error)
+        self.loop.call_soon_threadsafe(self._advance)
+
+    def _advance(self):
+        if self.voice is None or not self.voice.is_connected():
+            self.close()
+            return
+        if self.voice.is_playing():
+            return
+        if self.queue:
+            self._start(self.queue.popleft())
+            self._fill()
+        else:
+            self.on_idle()
@@ -0,0 +1,1126 @@
+import asyncio
+import bisect
+import contextlib
+import csv
+import io
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+from json.encoder import encode_basestring_ascii
+from typing import *
+
+from config import SUB_BACKEND, SUB_DB_PATH
+
+log = logging.getLogger(__name__)
+
+SUB_DATA_PATH = "./cogs/subscription/subscriptions.json"
+# Once the journal grows past this many bytes it is folded into a new snapshot
+JOURNAL_COMPACT_BYTES = 1 << 20
+# Attendance is only kept for this many of the most recent atsub calls
+MAX_ATSUB_CALLS = 1000
+# Version of the snapshot layout JsonSubscriptionStore writes; snapshots without a version are the original layout
+SNAPSHOT_FORMAT = 2
+# How atsub reaches a sub's subscribers: mentions in the channel, or a DM to each; the first is the default
+DELIVERY_MODES = ("channel", "dm")
+# Formats subscriptions are imported from and exported to, one (sub, user id) row per line
+TRANSFER_FORMATS = ("csv", "jsonl")
+CSV_HEADER = ["sub", "user_id"]
+# User ids are stored as 64-bit signed integers by SQLite and as unsigned ones in the id arrays; both hold these
+USER_ID_LIMIT = 2 ** 63
+# Ids sorted or encoded per call off the event loop; the loop only gets the GIL back between two calls, so one call
+# over a whole import would stall it just the same
+ID_CHUNK = 10000
+
+
+class AtsubCall:
+    """
+    An atsub message and the ids of the users attending it, keyed by the message's id.
+    """
+
+    __slots__ = ("message_id", "guild_id", "channel_id", "sub_name", "author_id", "attending")
+
+    def __init__(
+        self,
+        message_id: int,
+        guild_id: int,
+        channel_id: int,
+        sub_name: str,
+        author_id: int,
+        attending: Optional[Set[int]] = None,
+    ):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.sub_name = sub_name
+        self.author_id = author_id
+        self.attending = attending if attending is not None else {author_id}
+
+    def to_dict(self) -> Dict:
+        return {
+            "guild": self.guild_id,
+            "channel": self.channel_id,
+            "sub": self.sub_name,
+            "author": self.author_id,
+            "attending": sorted(self.attending),
+        }
+
+    @classmethod
+    def from_dict(cls, message_id: int, data: Dict) -> "AtsubCall":
+        return cls(
+            message_id, data["guild"], data["channel"], data["sub"], data["author"], set(data["attending"])
+        )
+
+
+class SubscriptionStore:
+    """
+    Storage backend for the Subscription cog. Guild and user ids are passed in as ints, all methods are called from
+    the event loop and must return quickly.
+    """
+
+    def load(self):
+        """
+        Prepares the backend for use. Called once before any other method.
+        """
+        raise NotImplementedError
+
+    def sub_names(self, guild_id: int) -> List[str]:
+        """
+        Returns the names of every subscription in a guild.
+        :param guild_id: int
+        :return: List[str]
+        """
+        raise NotImplementedError
+
+    def has_guild(self, guild_id: int) -> bool:
+        raise NotImplementedError
+
+    def sub_exists(self, guild_id: int, sub_name: str) -> bool:
+        raise NotImplementedError
+
+    def subscribers(self, guild_id: int, sub_name: str) -> List[int]:
+        raise NotImplementedError
+
+    def subs_of(self, guild_id: int, user_id: int) -> List[str]:
+        """
+        Returns the names of the subscriptions in a guild that user_id is subscribed to.
+        :param guild_id: int
+        :param user_id: int
+        :return: List[str]
+        """
+        raise NotImplementedError
+
+    def ensure_guild(self, guild_id: int) -> bool:
+        """
+        Creates an empty entry for a guild. Returns True iff the guild was not already present.
+        :param guild_id: int
+        :return: bool
+        """
+        raise NotImplementedError
+
+    def create_sub(self, guild_id: int, sub_name: str) -> bool:
+        raise NotImplementedError
+
+    def delete_sub(self, guild_id: int, sub_name: str) -> bool:
+        raise NotImplementedError
+
+    def add_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        """
+        Subscribes user_id to sub_name. Returns True iff the user wasn't already subscribed.
+        :param guild_id: int
+        :param sub_name: str
+        :param user_id: int
+        :return: bool
+        """
+        raise NotImplementedError
+
+    def add_subscribers(self, guild_id: int, sub_name: str, user_ids: Iterable[int]) -> int:
+        """
+        Subscribes every user in user_ids to sub_name at once, all or nothing. Returns how many weren't already
+        subscribed, or 0 if the sub doesn't exist.
+        :param guild_id: int
+        :param sub_name: str
+        :param user_ids: Iterable[int]
+        :return: int
+        """
+        raise NotImplementedError
+
+    def remove_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        """
+        Unsubscribes user_id from sub_name. Returns True iff the user was subscribed.
+        :param guild_id: int
+        :param sub_name: str
+        :param user_id: int
+        :return: bool
+        """
+        raise NotImplementedError
+
+    def sub_mode(self, guild_id: int, sub_name: str) -> str:
+        """
+        Returns how atsub delivers sub_name, one of DELIVERY_MODES.
+        :param guild_id: int
+        :param sub_name: str
+        :return: str
+        """
+        raise NotImplementedError
+
+    def set_sub_mode(self, guild_id: int, sub_name: str, mode: str) -> bool:
+        """
+        Sets how atsub delivers sub_name. Returns True iff that changed anything.
+        :param guild_id: int
+        :param sub_name: str
+        :param mode: str
+        :return: bool
+        """
+        raise NotImplementedError
+
+    def subscriptions(self, guild_id: int) -> Dict[str, List[int]]:
+        """
+        Returns every subscription in a guild with its subscribers, for exporting.
+        :param guild_id: int
+        :return: Dict[str, List[int]]
+        """
+        raise NotImplementedError
+
+    async def import_subscriptions(self, guild_id: int, subs: Dict[str, Set[int]]) -> Tuple[int, int]:
+        """
+        Subscribes the users in subs to each sub, creating the subs that don't exist, in one transaction that
+        doesn't block the event loop. Returns the number of subs created and of subscriptions added.
+        :param guild_id: int
+        :param subs: Dict[str, Set[int]]
+        :return: Tuple[int, int]
+        """
+        raise NotImplementedError
+
+    def record_call(self, call: AtsubCall):
+        """
+        Starts tracking attendance for an atsub message. Only the most recent MAX_ATSUB_CALLS calls are kept.
+        :param call: AtsubCall
+        """
+        raise NotImplementedError
+
+    def atsub_call(self, message_id: int) -> Optional[AtsubCall]:
+        """
+        Returns the atsub call sent as message_id, or None if it isn't tracked. The result is a copy.
+        :param message_id: int
+        :return: Optional[AtsubCall]
+        """
+        raise NotImplementedError
+
+    def set_attending(self, message_id: int, user_id: int, attending: bool) -> bool:
+        """
+        Marks user_id as attending or not attending an atsub call. Returns True iff that changed anything.
+        :param message_id: int
+        :param user_id: int
+        :param attending: bool
+        :return: bool
+        """
+        raise NotImplementedError
+
+    async def flush(self):
+        """
+        Persists outstanding changes without blocking the event loop.
+        """
+
+    def close(self):
+        """
+        Synchronously persists outstanding changes and releases the backend.
+        """
+        raise NotImplementedError
+
+
+def _id_array(ids: Iterable) -> array:
+    return array("Q", sorted(set(map(int, ids))))
+
+
+def _contains(users: array, user_id: int) -> bool:
+    i = bisect.bisect_left(users, user_id)
+    return i < len(users) and users[i] == user_id
+
+
+def _insert(users: array, user_id: int) -> bool:
+    i = bisect.bisect_left(users, user_id)
+    if i < len(users) and users[i] == user_id:
+        return False
+    users.insert(i, user_id)
+    return True
+
+
+def _discard(users: array, user_id: int) -> bool:
+    i = bisect.bisect_left(users, user_id)
+    if i == len(users) or users[i] != user_id:
+        return False
+    del users[i]
+    return True
+
+
+def _merge(users: array, user_ids: Iterable) -> int:
+    """
+    Adds user_ids to the sorted array users in one pass. Returns how many were new.
+    """
+    new_users = [user for user in sorted(set(map(int, user_ids))) if not _contains(users, user)]
+    if new_users:
+        users[:] = array("Q", heapq.merge(users, new_users))
+    return len(new_users)
+
+
+def _sorted_ids(user_ids: Iterable[int]) -> Iterator[int]:
+    """
+    Yields user_ids in order without duplicates, sorting them ID_CHUNK at a time.
+    """
+    user_ids = list(user_ids)
+    runs = [sorted(user_ids[i:i + ID_CHUNK]) for i in range(0, len(user_ids), ID_CHUNK)]
+    last = None
+    for user_id in heapq.merge(*runs):
+        if user_id != last:
+            yield user_id
+            last = user_id
+
+
+def _sort_subs(subs: Dict[str, Set[int]]) -> Dict[str, List[int]]:
+    """
+    Sorts each sub's users with _sorted_ids, for an executor.
+    """
+    return {sub_name: list(_sorted_ids(user_ids)) for sub_name, user_ids in subs.items()}
+
+
+def _encode_subs(subs: Dict[str, Sequence[int]]) -> str:
+    """
+    Encodes a sub -> ids mapping the way json.dumps does, ID_CHUNK ids at a time.
+    """
+    return "{" + ", ".join(
+        f"{encode_basestring_ascii(sub_name)}: [{_encode_ids(ids)}]" for sub_name, ids in subs.items()
+    ) + "}"
+
+
+def _encode_ids(ids: Sequence[int]) -> str:
+    # Most subs fit in one chunk, and skipping the slicing keeps encoding every guild at load time cheap
+    if len(ids) <= ID_CHUNK:
+        return ", ".join(map(str, ids))
+    return ", ".join(", ".join(map(str, ids[i:i + ID_CHUNK])) for i in range(0, len(ids), ID_CHUNK))
+
+
+def _merge_import(guild_id: int, subs: Dict[str, Set[int]], merged: Dict[str, array]) -> Tuple[Dict, str]:
+    """
+    Merges each sub's users in subs into its sorted array in merged, in place, and returns the import's journal entry,
+    which lists only the users that were new, along with its encoding. Meant for an executor: no single call works
+    on more than ID_CHUNK ids, so the event loop keeps running alongside.
+    """
+    new_subs = {}
+    for sub_name, user_ids in subs.items():
+        users = merged[sub_name]
+        new_users = [user for user in _sorted_ids(user_ids) if not _contains(users, user)]
+        if new_users:
+            # Filled a chunk at a time, since a merge drained by array() in one call never gives up the GIL
+            result = array("Q")
+            merged_users = heapq.merge(users, new_users)
+            while len(result) < len(users) + len(new_users):
+                result.extend(itertools.islice(merged_users, ID_CHUNK))
+            users[:] = result
+        new_subs[sub_name] = new_users
+    entry = {"op": "import", "guild": guild_id, "subs": new_subs}
+    return entry, f'{{"op": "import", "guild": {guild_id}, "subs": {_encode_subs(new_subs)}}}\n'
+
+
+class JsonSubscriptionStore(SubscriptionStore):
+    """
+    In-memory view of the subscription data. The snapshot file is read once and the journal next to it replayed
+    on top, every read is served from memory and each mutation becomes a small journal entry. Entries are appended
+    in batches from an executor with one fsync per batch, and the journal is compacted into a fresh snapshot by
+    atomic rename once it grows past compact_bytes.
+    Each sub's subscribers are kept as a sorted array of 64-bit ids, 8 bytes per subscriber, and looked up by
+    bisection. Snapshots are written as {"format": 2, "modes": {guild: {sub: mode}}, "guilds": {guild: {sub: [ids]}}}
+    with the ids as numbers, where modes only lists the subs not delivered in the default mode. The original
+    unversioned layout, with ids as strings, is still read and is migrated by the next compaction.
+    """
+
+    def __init__(
+        self,
+        path: str = SUB_DATA_PATH,
+        flush_delay: float = 1.0,
+        compact_bytes: int = JOURNAL_COMPACT_BYTES,
+    ):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.attendance_path = os.path.join(os.path.dirname(path), "attendance.json")
+        self.flush_delay = flush_delay
+        self.compact_bytes = compact_bytes
+        self._data: Dict[int, Dict[str, array]] = {}
+        # Delivery modes of the subs that don't use the default
+        self._modes: Dict[int, Dict[str, str]] = {}
+        # Tracked atsub calls, oldest first
+        self._calls: Dict[int, AtsubCall] = {}
+        # Serialized form of each guild, so a compaction only re-encodes the guilds that changed
+        self._encoded: Dict[int, str] = {}
+        self._dirty: Set[int] = set()
+        # For each guild with imports being merged, one list per import of the changes made to the guild meanwhile
+        self._imports: Dict[int, List[List[Dict]]] = {}
+        # Entries recorded on the event loop and not yet handed to the writer
+        self._pending: List[str] = []
+        # Entries handed to the writer thread, in mutation order; guarded by _write_lock
+        self._queue: List[str] = []
+        self._journal_bytes = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._write_lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the snapshot into memory and replays the journal on top of it, replacing whatever was loaded before.
+        A torn entry at the end of the journal (from a crash mid-append) is dropped and truncated away. Blocks, so the
+        bot runs it in an executor.
+        """
+        with open(self.path, mode="r") as file:
+            snapshot = json.load(file)
+        if snapshot.get("format") == SNAPSHOT_FORMAT:
+            guilds = snapshot["guilds"]
+            modes = snapshot.get("modes", {})
+        elif "format" in snapshot:
+            raise ValueError(f"Unknown subscription snapshot format {snapshot['format']!r} in {self.path}")
+        else:
+            guilds = snapshot
+            modes = {}
+        self._data = {
+            int(guild_key): {sub_name: _id_array(users) for sub_name, users in subs.items()}
+            for guild_key, subs in guilds.items()
+        }
+        self._modes = {int(guild_key): dict(subs) for guild_key, subs in modes.items()}
+        self._calls = {}
+        if os.path.exists(self.attendance_path):
+            with open(self.attendance_path, mode="r") as file:
+                for message_key, data in json.load(file).items():
+                    self._calls[int(message_key)] = AtsubCall.from_dict(int(message_key), data)
+        self._pending = []
+        self._queue = []
+        self._journal_bytes = 0
+        if os.path.exists(self.journal_path):
+            self._replay()
+        # Encoded here, off the event loop, so the first compaction only has to copy the guilds changed since
+        self._encoded = {guild_id: _encode_subs(subs) for guild_id, subs in self._data.items()}
+        self._dirty = set()
+
+    def _replay(self):
+        good_bytes = 0
+        with open(self.journal_path, mode="rb") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning("Dropping torn journal entry at byte %d of %s", good_bytes, self.journal_path)
+                    break
+                self._apply(entry)
+                good_bytes += len(line)
+        if good_bytes != os.path.getsize(self.journal_path):
+            os.truncate(self.journal_path, good_bytes)
+        self._journal_bytes = good_bytes
+
+    def guild_data(self) -> Dict[int, Dict[str, array]]:
+        """
+        Returns the raw guild -> sub -> sorted subscriber ids mapping. It is owned by the store and must not be
+        mutated.
+        """
+        return self._data
+
+    def sub_names(self, guild_id: int) -> List[str]:
+        return list(self._data.get(guild_id, {}))
+
+    def has_guild(self, guild_id: int) -> bool:
+        return guild_id in self._data
+
+    def sub_exists(self, guild_id: int, sub_name: str) -> bool:
+        return sub_name in self._data.get(guild_id, {})
+
+    def subscribers(self, guild_id: int, sub_name: str) -> List[int]:
+        return self._data[guild_id][sub_name].tolist()
+
+    def subs_of(self, guild_id: int, user_id: int) -> List[str]:
+        return [sub for sub, users in self._data.get(guild_id, {}).items() if _contains(users, user_id)]
+
+    def ensure_guild(self, guild_id: int) -> bool:
+        return self._record({"op": "guild", "guild": guild_id})
+
+    def create_sub(self, guild_id: int, sub_name: str) -> bool:
+        return self._record({"op": "create", "guild": guild_id, "sub": sub_name})
+
+    def delete_sub(self, guild_id: int, sub_name: str) -> bool:
+        return self._record({"op": "delete", "guild": guild_id, "sub": sub_name})
+
+    def add_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        return self._record({"op": "add", "guild": guild_id, "sub": sub_name, "user": user_id})
+
+    def add_subscribers(self, guild_id: int, sub_name: str, user_ids: Iterable[int]) -> int:
+        users = self._data.get(guild_id, {}).get(sub_name)
+        if users is None:
+            return 0
+        new_users = [user for user in sorted(set(user_ids)) if not _contains(users, user)]
+        if new_users:
+            self._record({"op": "addmany", "guild": guild_id, "sub": sub_name, "users": new_users})
+        return len(new_users)
+
+    def remove_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        return self._record({"op": "remove", "guild": guild_id, "sub": sub_name, "user": user_id})
+
+    def sub_mode(self, guild_id: int, sub_name: str) -> str:
+        return self._modes.get(guild_id, {}).get(sub_name, DELIVERY_MODES[0])
+
+    def set_sub_mode(self, guild_id: int, sub_name: str, mode: str) -> bool:
+        if mode not in DELIVERY_MODES:
+            raise ValueError(f"Unknown delivery mode {mode!r}")
+        return self._record({"op": "mode", "guild": guild_id, "sub": sub_name, "mode": mode})
+
+    def subscriptions(self, guild_id: int) -> Dict[str, List[int]]:
+        return {sub: users.tolist() for sub, users in self._data.get(guild_id, {}).items()}
+
+    async def import_subscriptions(self, guild_id: int, subs: Dict[str, Set[int]]) -> Tuple[int, int]:
+        """
+        The whole import is one journal entry, so a crash either keeps all of it or none of it. The merge and the
+        encoding of the entry run in an executor on copies of the subs involved, which are swapped in afterwards.
+        Changes made to the guild in the meantime are then applied again on top, and journaled again after the import
+        so that replaying the journal ends up the same; every operation sets state, so the second time changes
+        nothing else.
+        """
+        existing_subs = self._data.get(guild_id, {})
+        created = sum(sub_name not in existing_subs for sub_name in subs)
+        merged = {
+            sub_name: existing_subs[sub_name][:] if sub_name in existing_subs else array("Q") for sub_name in subs
+        }
+        changes = []
+        self._imports.setdefault(guild_id, []).append(changes)
+        try:
+            entry, line = await asyncio.get_running_loop().run_in_executor(
+                None, _merge_import, guild_id, subs, merged
+            )
+        finally:
+            # By identity: another import's list of changes can be equal to this one
+            others = [other for other in self._imports[guild_id] if other is not changes]
+            if others:
+                self._imports[guild_id] = others
+            else:
+                del self._imports[guild_id]
+        self._data.setdefault(guild_id, {}).update(merged)
+        self._dirty.add(guild_id)
+        self._enqueue(line)
+        self._note_change(entry)
+        for change in changes:
+            self._record(change)
+        return created, sum(map(len, entry["subs"].values()))
+
+    def atsub_calls(self) -> List[AtsubCall]:
+        """
+        Returns every tracked atsub call, oldest first. The calls are owned by the store and must not be mutated.
+        """
+        return list(self._calls.values())
+
+    def record_call(self, call: AtsubCall):
+        entry = {"op": "call", "message": call.message_id}
+        entry.update(call.to_dict())
+        self._record(entry)
+
+    def atsub_call(self, message_id: int) -> Optional[AtsubCall]:
+        call = self._calls.get(message_id)
+        if call is None:
+            return None
+        return AtsubCall.from_dict(message_id, call.to_dict())
+
+    def set_attending(self, message_id: int, user_id: int, attending: bool) -> bool:
+        return self._record({"op": "attend" if attending else "unattend", "message": message_id, "user": user_id})
+
+    def _apply_attendance(self, entry: Dict) -> bool:
+        op = entry["op"]
+        message_id = entry["message"]
+        if op == "call":
+            if message_id in self._calls:
+                return False
+            self._calls[message_id] = AtsubCall.from_dict(message_id, entry)
+            while len(self._calls) > MAX_ATSUB_CALLS:
+                del self._calls[next(iter(self._calls))]
+            return True
+        call = self._calls.get(message_id)
+        if call is None:
+            return False
+        if op == "attend":
+            if entry["user"] in call.attending:
+                return False
+            call.attending.add(entry["user"])
+        else:
+            if entry["user"] not in call.attending:
+                return False
+            call.attending.remove(entry["user"])
+        return True
+
+    def _apply(self, entry: Dict) -> bool:
+        """
+        Applies a journal entry to the in-memory data. Returns True iff it changed anything.
+        Every operation sets rather than toggles state and tolerates a missing sub, so replaying entries that already
+        made it into the snapshot (a crash between the rename and the journal truncation) is harmless.
+        """
+        op = entry["op"]
+        if op in ("call", "attend", "unattend"):
+            return self._apply_attendance(entry)
+        # Journals written before SNAPSHOT_FORMAT 2 hold the ids as strings
+        guild_id = int(entry["guild"])
+        if op == "guild":
+            if guild_id in self._data:
+                return False
+            self._data[guild_id] = {}
+        elif op == "create":
+            subs = self._data.setdefault(guild_id, {})
+            if entry["sub"] in subs:
+                return False
+            subs[entry["sub"]] = array("Q")
+        elif op == "delete":
+            subs = self._data.get(guild_id, {})
+            if entry["sub"] not in subs:
+                return False
+            subs.pop(entry["sub"])
+            self._modes.get(guild_id, {}).pop(entry["sub"], None)
+        elif op == "mode":
+            if entry["sub"] not in self._data.get(guild_id, {}):
+                return False
+            if self.sub_mode(guild_id, entry["sub"]) == entry["mode"]:
+                return False
+            modes = self._modes.setdefault(guild_id, {})
+            if entry["mode"] == DELIVERY_MODES[0]:
+                modes.pop(entry["sub"])
+            else:
+                modes[entry["sub"]] = entry["mode"]
+        elif op == "add":
+            users = self._data.get(guild_id, {}).get(entry["sub"])
+            if users is None or not _insert(users, int(entry["user"])):
+                return False
+        elif op == "remove":
+            users = self._data.get(guild_id, {}).get(entry["sub"])
+            if users is None or not _discard(users, int(entry["user"])):
+                return False
+        elif op == "addmany":
+            users = self._data.get(guild_id, {}).get(entry["sub"])
+            if users is None or not _merge(users, entry["users"]):
+                return False
+        elif op == "import":
+            subs = self._data.setdefault(guild_id, {})
+            for sub_name, new_users in entry["subs"].items():
+                _merge(subs.setdefault(sub_name, array("Q")), new_users)
+        else:
+            raise ValueError(f"Unknown journal operation {op!r}")
+        self._dirty.add(guild_id)
+        return True
+
+    def _record(self, entry: Dict) -> bool:
+        if not self._apply(entry):
+            return False
+        self._enqueue(json.dumps(entry) + "\n")
+        self._note_change(entry)
+        return True
+
+    def _note_change(self, entry: Dict):
+        """
+        Hands an applied entry to the imports being merged into its guild, if any.
+        """
+        for changes in self._imports.get(entry.get("guild"), ()):
+            changes.append(entry)
+
+    def _enqueue(self, line: str):
+        """
+        Queues an encoded entry, already applied, for the journal and schedules a flush.
+        """
+        self._pending.append(line)
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop yet (e.g. during extension setup); close() or the next mutation will write it out
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _take_snapshot(self) -> Tuple[List[int], Dict[int, Optional[Dict[str, array]]], str]:
+        """
+        Copies what the next snapshot needs: the order of the guilds, the subs of the dirty guilds (None for ones
+        that are gone) and the encoded modes. Must run on the thread that mutates the data; copying the arrays is
+        far cheaper than encoding them, which _encode_snapshot does in the writer.
+        """
+        dirty = {
+            guild_id: {sub_name: users[:] for sub_name, users in self._data[guild_id].items()}
+            if guild_id in self._data else None
+            for guild_id in self._dirty
+        }
+        self._dirty.clear()
+        modes = json.dumps({str(guild_id): subs for guild_id, subs in self._modes.items() if subs})
+        return list(self._data), dirty, modes
+
+    def _encode_snapshot(self, guild_ids: List[int], dirty: Dict[int, Optional[Dict[str, array]]], modes: str) -> str:
+        """
+        Re-encodes the dirty guilds and assembles the whole snapshot. Only the writer uses _encoded.
+        """
+        for guild_id, subs in dirty.items():
+            if subs is not None:
+                self._encoded[guild_id] = _encode_subs(subs)
+            else:
+                self._encoded.pop(guild_id, None)
+        lines = [f'    "{guild_id}": {self._encoded[guild_id]}' for guild_id in guild_ids]
+        return f'{{"format": {SNAPSHOT_FORMAT}, "modes": {modes}, "guilds": {{\n' + ",\n".join(lines) + "\n}}\n"
+
+    def _encode_attendance(self) -> str:
+        return json.dumps({str(message_id): call.to_dict() for message_id, call in self._calls.items()})
+
+    def _drain(self):
+        """
+        Appends every queued entry to the journal and fsyncs once. Caller must hold _write_lock.
+        """
+        if not self._queue:
+            return
+        batch = "".join(self._queue).encode()
+        with open(self.journal_path, mode="ab") as journal:
+            journal.write(batch)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._queue.clear()
+        self._journal_bytes += len(batch)
+
+    def _append(self, entries: List[str]):
+        with self._write_lock:
+            self._queue.extend(entries)
+            self._drain()
+
+    def _compact(self, entries: List[str], snapshot: Tuple, attendance: str):
+        snapshots = {self.path: self._encode_snapshot(*snapshot), self.attendance_path: attendance}
+        with self._write_lock:
+            # The journal has to hold everything before the snapshots are swapped in, or a crash in between loses it
+            self._queue.extend(entries)
+            self._drain()
+            for path, snapshot in snapshots.items():
+                tmp_path = path + ".tmp"
+                with open(tmp_path, mode="w") as file:
+                    file.write(snapshot)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, path)
+            with open(self.journal_path, mode="wb") as journal:
+                os.fsync(journal.fileno())
+            self._journal_bytes = 0
+
+    async def flush(self):
+        """
+        Hands the pending entries to an executor, either appending them to the journal or, once the journal has
+        outgrown compact_bytes, folding everything into a new snapshot.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            entries, self._pending = self._pending, []
+            loop = asyncio.get_running_loop()
+            try:
+                if self._journal_bytes >= self.compact_bytes:
+                    # Taken together with the entries so the snapshots cover exactly what was handed over
+                    snapshot = self._take_snapshot()
+                    await loop.run_in_executor(None, self._compact, entries, snapshot, self._encode_attendance())
+                else:
+                    await loop.run_in_executor(None, self._append, entries)
+            except OSError:
+                log.exception("Failed to write subscription data to %s", self.journal_path)
+
+    def close(self):
+        """
+        Cancels any pending background flush and synchronously journals outstanding changes.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        entries, self._pending = self._pending, []
+        self._append(entries)
+
+
+class SqliteSubscriptionStore(SubscriptionStore):
+    """
+    SQLite backed store. Nothing is cached in memory; every lookup is an indexed query, including the reverse
+    user -> subscriptions lookup. On first use an existing JSON snapshot (and its journal) is imported.
+    Several processes can share the database: WAL lets readers run alongside the single writer, writers wait for
+    each other for up to busy_timeout seconds, and only one of them ever does the import.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS subs (
+            sub_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL REFERENCES guilds (guild_id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            mode TEXT NOT NULL DEFAULT 'channel',
+            UNIQUE (guild_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS subscribers (
+            sub_id INTEGER NOT NULL REFERENCES subs (sub_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            PRIMARY KEY (sub_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS subscribers_by_user ON subscribers (guild_id, user_id);
+        CREATE TABLE IF NOT EXISTS atsub_calls (
+            message_id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            sub_name TEXT NOT NULL,
+            author_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS attendance (
+            message_id INTEGER NOT NULL REFERENCES atsub_calls (message_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str = SUB_DB_PATH, import_path: Optional[str] = SUB_DATA_PATH, busy_timeout: float = 10):
+        self.path = path
+        self.import_path = import_path
+        self.busy_timeout = busy_timeout
+        self._db: Optional[sqlite3.Connection] = None
+
+    def load(self):
+        # Autocommit mode; multi-statement writes open their own transaction. The store may be loaded in an executor
+        # and then used from the event loop, but never from two threads at once
+        self._db = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(self.SCHEMA)
+        if not self._has_mode_column():
+            with self._transaction():
+                # Databases made before delivery modes existed; another process may have just added it
+                if not self._has_mode_column():
+                    self._db.execute("ALTER TABLE subs ADD COLUMN mode TEXT NOT NULL DEFAULT 'channel'")
+        if self.import_path is not None and os.path.exists(self.import_path) and self._is_empty():
+            with self._transaction():
+                # Checked again under the write lock, since another process sharing the database may have won
+                if self._is_empty():
+                    self._copy_json(self.import_path)
+
+    def _has_mode_column(self) -> bool:
+        return any(column[1] == "mode" for column in self._db.execute("PRAGMA table_info(subs)"))
+
+    def _is_empty(self) -> bool:
+        return self._db.execute("SELECT 1 FROM guilds LIMIT 1").fetchone() is None
+
+    def import_json(self, path: str):
+        """
+        Copies the contents of a JSON store (snapshot plus journal) into the database in one transaction.
+        :param path: str
+        """
+        with self._transaction():
+            self._copy_json(path)
+
+    def _copy_json(self, path: str):
+        source = JsonSubscriptionStore(path)
+        source.load()
+        for guild_id, subs in source.guild_data().items():
+            self._db.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (guild_id,))
+            for sub_name, users in subs.items():
+                sub_id = self._db.execute(
+                    "INSERT INTO subs (guild_id, name, mode) VALUES (?, ?, ?)",
+                    (guild_id, sub_name, source.sub_mode(guild_id, sub_name)),
+                ).lastrowid
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO subscribers (sub_id, user_id, guild_id) VALUES (?, ?, ?)",
+                    ((sub_id, user_id, guild_id) for user_id in users),
+                )
+        for call in source.atsub_calls():
+            self._db.execute(
+                "INSERT INTO atsub_calls (message_id, guild_id, channel_id, sub_name, author_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (call.message_id, call.guild_id, call.channel_id, call.sub_name, call.author_id),
+            )
+            self._db.executemany(
+                "INSERT INTO attendance (message_id, user_id) VALUES (?, ?)",
+                ((call.message_id, user_id) for user_id in call.attending),
+            )
+        log.info("Imported subscription data from %s into %s", path, self.path)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _sub_id(self, guild_id: int, sub_name: str) -> Optional[int]:
+        row = self._db.execute(
+            "SELECT sub_id FROM subs WHERE guild_id = ? AND name = ?", (guild_id, sub_name)
+        ).fetchone()
+        return row[0] if row else None
+
+    def sub_names(self, guild_id: int) -> List[str]:
+        rows = self._db.execute("SELECT name FROM subs WHERE guild_id = ? ORDER BY sub_id", (guild_id,))
+        return [name for name, in rows]
+
+    def has_guild(self, guild_id: int) -> bool:
+        return self._db.execute("SELECT 1 FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone() is not None
+
+    def sub_exists(self, guild_id: int, sub_name: str) -> bool:
+        return self._sub_id(guild_id, sub_name) is not None
+
+    def subscribers(self, guild_id: int, sub_name: str) -> List[int]:
+        rows = self._db.execute(
+            "SELECT user_id FROM subscribers JOIN subs USING (sub_id) WHERE subs.guild_id = ? AND subs.name = ?",
+            (guild_id, sub_name),
+        )
+        return [user_id for user_id, in rows]
+
+    def subs_of(self, guild_id: int, user_id: int) -> List[str]:
+        rows = self._db.execute(
+            "SELECT name FROM subscribers JOIN subs USING (sub_id) "
+            "WHERE subscribers.guild_id = ? AND subscribers.user_id = ? ORDER BY sub_id",
+            (guild_id, user_id),
+        )
+        return [name for name, in rows]
+
+    def ensure_guild(self, guild_id: int) -> bool:
+        return self._db.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (guild_id,)).rowcount > 0
+
+    def create_sub(self, guild_id: int, sub_name: str) -> bool:
+        with self._transaction():
+            self._db.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (guild_id,))
+            return self._db.execute(
+                "INSERT OR IGNORE INTO subs (guild_id, name) VALUES (?, ?)", (guild_id, sub_name)
+            ).rowcount > 0
+
+    def delete_sub(self, guild_id: int, sub_name: str) -> bool:
+        return self._db.execute(
+            "DELETE FROM subs WHERE guild_id = ? AND name = ?", (guild_id, sub_name)
+        ).rowcount > 0
+
+    def add_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        sub_id = self._sub_id(guild_id, sub_name)
+        if sub_id is None:
+            return False
+        return self._db.execute(
+            "INSERT OR IGNORE INTO subscribers (sub_id, user_id, guild_id) VALUES (?, ?, ?)",
+            (sub_id, user_id, guild_id),
+        ).rowcount > 0
+
+    def add_subscribers(self, guild_id: int, sub_name: str, user_ids: Iterable[int]) -> int:
+        with self._transaction():
+            sub_id = self._sub_id(guild_id, sub_name)
+            if sub_id is None:
+                return 0
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO subscribers (sub_id, user_id, guild_id) VALUES (?, ?, ?)",
+                ((sub_id, user_id, guild_id) for user_id in user_ids),
+            )
+            return self._db.total_changes - before
+
+    def remove_subscriber(self, guild_id: int, sub_name: str, user_id: int) -> bool:
+        sub_id = self._sub_id(guild_id, sub_name)
+        if sub_id is None:
+            return False
+        return self._db.execute(
+            "DELETE FROM subscribers WHERE sub_id = ? AND user_id = ?", (sub_id, user_id)
+        ).rowcount > 0
+
+    def sub_mode(self, guild_id: int, sub_name: str) -> str:
+        row = self._db.execute(
+            "SELECT mode FROM subs WHERE guild_id = ? AND name = ?", (guild_id, sub_name)
+        ).fetchone()
+        return row[0] if row else DELIVERY_MODES[0]
+
+    def set_sub_mode(self, guild_id: int, sub_name: str, mode: str) -> bool:
+        if mode not in DELIVERY_MODES:
+            raise ValueError(f"Unknown delivery mode {mode!r}")
+        return self._db.execute(
+            "UPDATE subs SET mode = ? WHERE guild_id = ? AND name = ? AND mode != ?", (mode, guild_id, sub_name, mode)
+        ).rowcount > 0
+
+    def subscriptions(self, guild_id: int) -> Dict[str, List[int]]:
+        subs = {name: [] for name in self.sub_names(guild_id)}
+        rows = self._db.execute(
+            "SELECT name, user_id FROM subscribers JOIN subs USING (sub_id) WHERE subs.guild_id = ?", (guild_id,)
+        )
+        for name, user_id in rows:
+            subs[name].append(user_id)
+        return subs
+
+    async def import_subscriptions(self, guild_id: int, subs: Dict[str, Set[int]]) -> Tuple[int, int]:
+        """
+        Runs in an executor on a connection of its own, so the event loop's connection stays free. The rows are first
+        sorted and staged in a temporary table, which takes no lock on the database, and then merged in one short
+        transaction, so other writers only ever wait for the merge.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._import, guild_id, subs)
+
+    def _import(self, guild_id: int, subs: Dict[str, Set[int]]) -> Tuple[int, int]:
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        try:
+            db.execute("PRAGMA foreign_keys = ON")
+            db.execute("CREATE TEMP TABLE staged (name TEXT NOT NULL, user_id INTEGER, PRIMARY KEY (name, user_id))")
+            # In key order the rows mostly land next to each other in the indexes, which is several times faster than
+            # inserting them at random once the table outgrows the page cache
+            db.executemany(
+                "INSERT INTO staged (name, user_id) VALUES (?, ?)",
+                ((sub_name, user_id) for sub_name, user_ids in _sort_subs(subs).items() for user_id in user_ids),
+            )
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)", (guild_id,))
+                created = db.executemany(
+                    "INSERT OR IGNORE INTO subs (guild_id, name) VALUES (?, ?)", ((guild_id, name) for name in subs)
+                ).rowcount
+                added = db.execute(
+                    "INSERT OR IGNORE INTO subscribers (sub_id, user_id, guild_id) "
+                    "SELECT sub_id, user_id, guild_id FROM subs JOIN staged USING (name) WHERE subs.guild_id = ?",
+                    (guild_id,),
+                ).rowcount
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return created, added
+        finally:
+            db.close()
+
+    def record_call(self, call: AtsubCall):
+        with self._transaction():
+            self._db.execute(
+                "INSERT OR IGNORE INTO atsub_calls (message_id, guild_id, channel_id, sub_name, author_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (call.message_id, call.guild_id, call.channel_id, call.sub_name, call.author_id),
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO attendance (message_id, user_id) VALUES (?, ?)",
+                ((call.message_id, user_id) for user_id in call.attending),
+            )
+            # Message ids are snowflakes, so they order calls by age
+            self._db.execute(
+                "DELETE FROM atsub_calls WHERE message_id <= "
+                "(SELECT message_id FROM atsub_calls ORDER BY message_id DESC LIMIT 1 OFFSET ?)",
+                (MAX_ATSUB_CALLS,),
+            )
+
+    def atsub_call(self, message_id: int) -> Optional[AtsubCall]:
+        row = self._db.execute(
+            "SELECT guild_id, channel_id, sub_name, author_id FROM atsub_calls WHERE message_id = ?", (message_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        rows = self._db.execute("SELECT user_id FROM attendance WHERE message_id = ?", (message_id,))
+        return AtsubCall(message_id, *row, attending={user_id for user_id, in rows})
+
+    def set_attending(self, message_id: int, user_id: int, attending: bool) -> bool:
+        if attending:
+            query = (
+                "INSERT OR IGNORE INTO attendance (message_id, user_id) "
+                "SELECT message_id, ? FROM atsub_calls WHERE message_id = ?"
+            )
+        else:
+            query = "DELETE FROM attendance WHERE user_id = ? AND message_id = ?"
+        return self._db.execute(query, (user_id, message_id)).rowcount > 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def open_subscription_store(backend: str = SUB_BACKEND) -> SubscriptionStore:
+    """
+    Creates and loads the store selected by config.SUB_BACKEND ("json" or "sqlite").
+    :param backend: str
+    :return: SubscriptionStore
+    """
+    if backend == "json":
+        store = JsonSubscriptionStore()
+    elif backend == "sqlite":
+        store = SqliteSubscriptionStore()
+    else:
+        raise ValueError(f"Unknown subscription backend {backend!r}")
+    store.load()
+    return store
+
+
+def read_subscriptions(file: BinaryIO, fmt: str) -> Tuple[Dict[str, Set[int]], int]:
+    """
+    Reads an export in one of TRANSFER_FORMATS a row at a time: CSV rows of sub,user_id (the header is optional) or
+    JSON lines of {"sub": ..., "user": ...}. A row without a user stands for an empty sub. User ids must be whole
+    numbers from 1 to USER_ID_LIMIT - 1, written as digits or, in JSON, as numbers; other rows are skipped. A byte
+    order mark, as spreadsheet programs write, is ignored. Returns the subscribers of each sub, de-duplicated, and
+    the number of rows that couldn't be read.
+    :param file: BinaryIO
+    :param fmt: str
+    :return: Tuple[Dict[str, Set[int]], int]
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        rows = csv.reader(text)
+    else:
+        rows = (_json_row(line) for line in text if line.strip())
+    subs: Dict[str, Set[int]] = {}
+    skipped = 0
+    for row in rows:
+        if row == [] or row == CSV_HEADER:
+            continue
+        try:
+            sub_name, user_id = row
+            user_id = None if user_id in ("", None) else _user_id(user_id)
+        except (TypeError, ValueError):
+            skipped += 1
+            continue
+        if not isinstance(sub_name, str) or not sub_name:
+            skipped += 1
+            continue
+        users = subs.setdefault(sub_name, set())
+        if user_id is not None:
+            users.add(user_id)
+    return subs, skipped
+
+
+def _user_id(value: Union[str, int]) -> int:
+    # bool is an int, and int() would truncate floats
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError(f"Not a user id: {value!r}")
+    user_id = int(value)
+    if not 0 < user_id < USER_ID_LIMIT:
+        raise ValueError(f"User id out of range: {user_id}")
+    return user_id
+
+
+def _json_row(line: str) -> Optional[Tuple]:
+    try:
+        entry = json.loads(line)
+        return entry["sub"], entry.get("user")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def write_subscriptions(subs: Dict[str, List[int]], fmt: str) -> bytes:
+    """
+    Encodes subs in one of TRANSFER_FORMATS, the inverse of read_subscriptions.
+    :param subs: Dict[str, List[int]]
+    :param fmt: str
+    :return: bytes
+    """
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_HEADER)
+        for sub_name, user_ids in subs.items():
+            writer.writerows([(sub_name, user_id) for user_id in user_ids] or [(sub_name, "")])
+    else:
+        for sub_name, user_ids in subs.items():
+            for user_id in user_ids or [None]:
+                buffer.write(json.dumps({"sub": sub_name, "user": user_id}) + "\n")
+    return buffer.getvalue().encode()
@@ -1,5 +1,12 @@
+import bisect
+import heapq
+from collections import Counter, OrderedDict
+from typing import *
+
 import discord
 
+from config import MIN_MATCH
+
 def retrieve_embed_field_index(field_name: str, embed: discord.Embed):
     """
     Retrieves the index of a embed field, or -1 if it doesn't exist.
@@ -11,3 +18,126 @@ def retrieve_embed_field_index(field_name: str, embed: discord.Embed):
         if field.name == field_name:
             return i
     return -1
+
+
+class PrefixIndex:
+    """
+    Case-insensitive prefix index over a set of names, kept as a sorted array searched with bisect.
+    A query shorter than min_match only matches names equal to it, a longer one matches every name it is a prefix
+    of, and exact matches win over prefix matches. Recent query results are kept in a small LRU that is dropped
+    whenever the index changes.
+    """
+
+    def __init__(self, names: Iterable[str] = (), min_match: int = MIN_MATCH, cache_size: int = 128):
+        self.min_match = min_match
+        self.cache_size = cache_size
+        self._keys: List[Tuple[str, str]] = sorted((name.casefold(), name) for name in names)
+        self._cache: "OrderedDict[str, Optional[List[str]]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, name: str):
+        key = (name.casefold(), name)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return
+        self._keys.insert(index, key)
+        self._cache.clear()
+
+    def remove(self, name: str):
+        key = (name.casefold(), name)
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+            self._cache.clear()
+
+    def match(self, query: str) -> Optional[List[str]]:
+        """
+        Returns the names matching query, or None if there are none.
+        :param query: str
+        :return: Optional[List[str]]
+        """
+        query = query.casefold()
+        if query in self._cache:
+            self._cache.move_to_end(query)
+            result = self._cache[query]
+        else:
+            result = self._match(query)
+            self._cache[query] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return None if result is None else list(result)
+
+    def _match(self, query: str) -> Optional[List[str]]:
+        # Every name that folds to exactly query sorts first in the range of names starting with it
+        index = bisect.bisect_left(self._keys, (query,))
+        exact = []
+        prefixed = []
+        for folded, name in (self._keys[i] for i in range(index, len(self._keys))):
+            if folded == query:
+                exact.append(name)
+            elif len(query) >= self.min_match and folded.startswith(query):
+                prefixed.append(name)
+            else:
+                break
+        return exact or prefixed or None
+
+
+class TrigramIndex:
+    """
+    Case-insensitive fuzzy index over a set of names. Every name is split into the trigrams of its padded, casefolded
+    form and filed under each of them, so a search only scores the names that share a trigram with the query. Names
+    are ranked by the Dice coefficient of their trigram sets, which forgives typos and missing or extra letters.
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._postings: Dict[str, Set[str]] = {}
+        # name -> number of distinct trigrams in it
+        self._sizes: Dict[str, int] = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @staticmethod
+    def trigrams(text: str) -> Set[str]:
+        padded = f"  {text.casefold()} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, name: str):
+        if name in self._sizes:
+            return
+        grams = self.trigrams(name)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(name)
+        self._sizes[name] = len(grams)
+
+    def remove(self, name: str):
+        if self._sizes.pop(name, None) is None:
+            return
+        for gram in self.trigrams(name):
+            names = self._postings[gram]
+            names.discard(name)
+            if not names:
+                del self._postings[gram]
+
+    def search(self, query: str, limit: int = 5, threshold: float = 0.3) -> List[Tuple[str, float]]:
+        """
+        Returns up to limit (name, score) pairs scoring at least threshold against query, best first.
+        :param query: str
+        :param limit: int
+        :param threshold: float
+        :return: List[Tuple[str, float]]
+        """
+        grams = self.trigrams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        scored = ((name, 2 * count / (len(grams) + self._sizes[name])) for name, count in shared.items())
+        return heapq.nsmallest(
+            limit,
+            ((name, score) for name, score in scored if score >= threshold),
+            key=lambda pair: (-pair[1], pair[0]),
+        )
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import *
+
+import discord
+
+from config import VOICE_IDLE_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+VOICE_CONNECT_TIMEOUT = 30
+# Background reconnects back off 1, 2, 4... seconds and give up after this many tries
+RECONNECT_ATTEMPTS = 4
+# Latency samples kept per kind of connect
+LATENCY_SAMPLES = 100
+
+
+class VoiceManager:
+    """
+    Owns the bot's voice connection in each guild. A guild that already has a connection has it moved to the
+    requested channel rather than reconnected, connections stay warm for warm_window seconds after the last use so
+    the next sound skips the voice handshake, and a connection that drops while it is still wanted is re-established
+    in the background. The time taken by every connect and move is kept for stats().
+    """
+
+    def __init__(
+        self,
+        client: discord.Client,
+        warm_window: float = VOICE_IDLE_TIMEOUT,
+        connect_timeout: float = VOICE_CONNECT_TIMEOUT,
+    ):
+        self.client = client
+        self.warm_window = warm_window
+        self.connect_timeout = connect_timeout
+        # guild id -> id of the channel we want to be in, for as long as the connection is wanted
+        self._wanted: Dict[int, int] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._warm_handles: Dict[int, asyncio.TimerHandle] = {}
+        self._reconnects: Dict[int, asyncio.Task] = {}
+        self._latencies: Dict[str, Deque[float]] = {
+            "connect": deque(maxlen=LATENCY_SAMPLES),
+            "move": deque(maxlen=LATENCY_SAMPLES),
+            "reconnect": deque(maxlen=LATENCY_SAMPLES),
+        }
+
+    async def connect(self, channel: discord.VoiceChannel) -> discord.VoiceClient:
+        """
+        Returns a connection to channel, reusing the guild's connection if it has one. The connection is kept until
+        release() lets it go cold or disconnect() is called.
+        Raises asyncio.TimeoutError if the connection couldn't be made in time and discord.ClientException on failure.
+        :param channel: discord.VoiceChannel
+        :return: discord.VoiceClient
+        """
+        guild = channel.guild
+        self._cancel_warm(guild.id)
+        self._wanted[guild.id] = channel.id
+        async with self._lock(guild.id):
+            voice = guild.voice_client
+            if voice is not None and voice.is_connected():
+                if voice.channel != channel:
+                    start = time.perf_counter()
+                    await voice.move_to(channel)
+                    self._record("move", start)
+                return voice
+            return await self._connect(channel, "connect")
+
+    def touch(self, guild_id: int):
+        """
+        Marks the guild's connection as in use, so it doesn't go cold while sounds are playing.
+        """
+        self._cancel_warm(guild_id)
+
+    def release(self, guild_id: int):
+        """
+        Marks the guild's connection as idle. It stays connected for warm_window seconds in case it's needed again.
+        """
+        self._cancel_warm(guild_id)
+        self._warm_handles[guild_id] = self.client.loop.call_later(self.warm_window, self._cool, guild_id)
+
+    async def disconnect(self, guild: discord.Guild):
+        """
+        Disconnects from voice in guild, without reconnecting.
+        """
+        self._forget(guild.id)
+        if guild.voice_client is not None:
+            await guild.voice_client.disconnect()
+
+    def close(self):
+        for guild_id in list(self._wanted):
+            self._forget(guild_id)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the count, median, 95th percentile and maximum in milliseconds of each kind of connect that has
+        happened recently.
+        :return: Dict[str, Dict[str, float]]
+        """
+        stats = {}
+        for kind, samples in self._latencies.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            stats[kind] = {
+                "count": len(ordered),
+                "p50": ordered[len(ordered) // 2] * 1000,
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                "max": ordered[-1] * 1000,
+            }
+        return stats
+
+    def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        """
+        Follows the bot's own voice state. Being moved updates the channel to reconnect to; being dropped from a
+        channel we still want starts a background reconnect.
+        """
+        if member.id != self.client.user.id:
+            return
+        guild_id = member.guild.id
+        if guild_id not in self._wanted:
+            return
+        if after.channel is not None:
+            self._wanted[guild_id] = after.channel.id
+        elif guild_id not in self._reconnects:
+            task = self.client.loop.create_task(self._reconnect(member.guild))
+            self._reconnects[guild_id] = task
+            task.add_done_callback(lambda _: self._reconnects.pop(guild_id, None))
+
+    async def _connect(self, channel: discord.VoiceChannel, kind: str) -> discord.VoiceClient:
+        stale = channel.guild.voice_client
+        if stale is not None:
+            # Left over from a dropped connection, and in the way of a new one
+            await stale.disconnect(force=True)
+        start = time.perf_counter()
+        voice = await channel.connect(timeout=self.connect_timeout, reconnect=True)
+        self._record(kind, start)
+        return voice
+
+    async def _reconnect(self, guild: discord.Guild):
+        for attempt in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(2 ** attempt)
+            channel_id = self._wanted.get(guild.id)
+            if channel_id is None:
+                return
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                break
+            async with self._lock(guild.id):
+                if guild.voice_client is not None and guild.voice_client.is_connected():
+                    return
+                try:
+                    await self._connect(channel, "reconnect")
+                    log.info("Reconnected to voice in guild %s", guild.id)
+                    return
+                except (asyncio.TimeoutError, discord.ClientException) as e:
+                    log.warning("Voice reconnect %d in guild %s failed: %s", attempt + 1, guild.id, e)
+        log.warning("Giving up on voice in guild %s", guild.id)
+        # Drop this task first so forgetting the guild doesn't cancel it
+        self._reconnects.pop(guild.id, None)
+        self._forget(guild.id)
+
+    def _cool(self, guild_id: int):
+        self._warm_handles.pop(guild_id, None)
+        guild = self.client.get_guild(guild_id)
+        voice = guild.voice_client if guild is not None else None
+        if voice is not None and voice.is_playing():
+            return
+        self._forget(guild_id)
+        if voice is not None:
+            self.client.loop.create_task(voice.disconnect())
+
+    def _forget(self, guild_id: int):
+        self._wanted.pop(guild_id, None)
+        self._cancel_warm(guild_id)
+        task = self._reconnects.pop(guild_id, None)
+        if task is not None:
+            task.cancel()
+
+    def _cancel_warm(self, guild_id: int):
+        handle = self._warm_handles.pop(guild_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _lock(self, guild_id: int) -> asyncio.Lock:
+        lock = self._locks.get(guild_id)
+        if lock is None:
+            lock = self._locks[guild_id] = asyncio.Lock()
+        return lock
+
+    def _record(self, kind: str, start: float):
+        elapsed = time.perf_counter() - start
+        self._latencies[kind].append(elapsed)
+        log.debug("Voice %s took %.0fms", kind, elapsed * 1000)
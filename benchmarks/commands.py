@@ -0,0 +1,344 @@
+"""
+Drives the Subscription and SoundBoard cogs' commands against a synthetic dataset, with the stand-ins in
+benchmarks/fakes.py in place of Discord. For every benchmark it reports p50/p99 latency, the memory allocated per
+call (peak, measured with tracemalloc in a separate pass so it doesn't skew the timings), the bytes written to disk
+per call and the REST calls made per call.
+
+Everything is seeded, so two runs with the same arguments do the same work. Save a run with --output and pass it to
+--compare on a later run to see what changed.
+
+The defaults keep a run to several seconds; the full-size dataset is
+    --guilds 10000 --subs 500 --users 100000 --sounds 5000
+
+Run from the repository root: python -m benchmarks.commands
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.fakes import FakeBot, FakeRest
+
+# Glued together into subscription, directory and sound names, so names share prefixes like real ones do
+SYLLABLES = [
+    "ba", "na", "mon", "ke", "val", "or", "ant", "league", "dota", "mine",
+    "craft", "apex", "raid", "night", "chess", "movie", "anime", "gym", "study", "music",
+]
+# Guild ids start here so they never collide with user ids
+GUILD_ID_BASE = 10 ** 9
+
+
+def make_names(rng: random.Random, count: int, min_length: int = 4) -> List[str]:
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+        if len(name) < min_length:
+            continue
+        if name in seen:
+            name += str(len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def misspell(rng: random.Random, name: str) -> str:
+    if len(name) < 4:
+        return name
+    i = rng.randrange(len(name) - 1)
+    if rng.random() < 0.5:
+        return name[:i] + name[i + 1:]
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def write_subscriptions(path: str, rng: random.Random, args) -> Dict[int, List[str]]:
+    """
+    Writes a subscriptions.json snapshot for the dataset and returns each guild's sub names.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sub_names = {}
+    with open(path, mode="w") as file:
+        file.write("{\n")
+        for g in range(args.guilds):
+            guild_id = GUILD_ID_BASE + g
+            names = make_names(rng, args.subs)
+            sub_names[guild_id] = names
+            guild = {
+                name: [str(user_id) for user_id in rng.sample(range(2, args.users + 1), args.subscribers)]
+                for name in names
+            }
+            file.write(f"{json.dumps(str(guild_id))}: {json.dumps(guild)}")
+            file.write(",\n" if g < args.guilds - 1 else "\n")
+        file.write("}\n")
+    return sub_names
+
+
+def write_sounds(root: str, rng: random.Random, count: int) -> Tuple[List[str], List[str]]:
+    """
+    Creates count empty sounds spread over directories of about a hundred, two levels deep. Returns the directories
+    and the sound names.
+    """
+    directories = []
+    sounds = []
+    top = make_names(rng, max(1, count // 1000))
+    for name in top:
+        os.makedirs(os.path.join(root, name))
+        directories.append(name)
+    while len(sounds) < count:
+        directory = f"{rng.choice(top)}/{make_names(rng, 1)[0]}{len(directories)}"
+        os.makedirs(os.path.join(root, directory))
+        directories.append(directory)
+        for name in make_names(rng, min(100, count - len(sounds))):
+            open(os.path.join(root, directory, name + ".mp3"), "wb").close()
+            sounds.append(f"{directory}/{name}")
+    return directories, sounds
+
+
+def bytes_written() -> Optional[int]:
+    # Every byte this process has passed to write(), including from executor threads; Linux only
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def measure(op: Callable[..., Awaitable], inputs: List[tuple], alloc_inputs: List[tuple], store, rest) -> Dict:
+    calls_before = sum(rest.calls.values())
+    written_before = bytes_written()
+    timings = []
+    for args in inputs:
+        start = time.perf_counter_ns()
+        await op(*args)
+        timings.append((time.perf_counter_ns() - start) / 1000)
+    # Anything the store buffered is part of the cost
+    await store.flush()
+    written_after = bytes_written()
+    calls = sum(rest.calls.values()) - calls_before
+
+    peaks = []
+    tracemalloc.start()
+    for args in alloc_inputs:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await op(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    await store.flush()
+
+    timings.sort()
+    return {
+        "p50_us": percentile(timings, 0.5),
+        "p99_us": percentile(timings, 0.99),
+        "alloc_kib": sum(peaks) / len(peaks) / 1024 if peaks else 0.0,
+        "disk_bytes": (written_after - written_before) / len(inputs) if written_before is not None else None,
+        "rest_calls": calls / len(inputs),
+    }
+
+
+async def run(args) -> Dict[str, Dict]:
+    rng = random.Random(args.seed)
+    rest = FakeRest(latency=args.latency / 1000, jitter=args.jitter, seed=args.seed)
+    bot = FakeBot(rest, args.users, cached_percent=args.cached_percent)
+
+    setup = {}
+    start = time.perf_counter()
+    sub_names = write_subscriptions("./cogs/subscription/subscriptions.json", rng, args)
+    directories, sounds = write_sounds("./cogs/soundboard/", rng, args.sounds)
+    setup["dataset_s"] = time.perf_counter() - start
+
+    # The cogs are imported here, inside the running loop, so their task loops bind to it
+    from SubscriptionStore import open_subscription_store
+    from cogs.Soundboard import SoundBoard
+    from cogs.Subscriptions import Subscription
+    from Outbound import outbound
+
+    # FakeRest stands in for Discord's latency but not its rate limits, so the dispatcher shouldn't pace for them
+    outbound.set_limits({kind: (math.inf, 1.0) for kind in outbound.limits}, (math.inf, 1.0))
+
+    start = time.perf_counter()
+    subscriptions = Subscription(bot)
+    await subscriptions.store_ready.wait()
+    if args.backend != "json":
+        subscriptions.store.close()
+        subscriptions.store = open_subscription_store(args.backend)
+    setup["store_load_s"] = time.perf_counter() - start
+
+    soundboard = SoundBoard(bot)
+    # The library is built by hand: the refresh loop would also start measuring loudness with ffmpeg
+    soundboard.refresh_library.cancel()
+    start = time.perf_counter()
+    soundboard.library.build()
+    soundboard.library_ready.set()
+    setup["library_build_s"] = time.perf_counter() - start
+
+    guild_ids = list(sub_names)
+    store = subscriptions.store
+    n = args.iterations + args.alloc_iterations
+
+    def guild_and_sub():
+        guild_id = rng.choice(guild_ids)
+        return guild_id, rng.choice(sub_names[guild_id])
+
+    def user():
+        return rng.randint(2, args.users)
+
+    def split(inputs):
+        return inputs[:args.iterations], inputs[args.iterations:]
+
+    async def match_sub(guild_id, query):
+        subscriptions._match_sub(guild_id, query)
+
+    def match_query():
+        guild_id, name = guild_and_sub()
+        kind = rng.random()
+        if kind < 0.4:
+            return guild_id, name
+        if kind < 0.8:
+            return guild_id, name[:rng.randint(3, len(name))]
+        return guild_id, misspell(rng, name)
+
+    async def subscribe(guild_id, user_id, sub_name):
+        await subscriptions.subscribe.callback(subscriptions, bot.context(guild_id, user_id), sub_name)
+
+    async def listsubs(guild_id, user_id, *options):
+        await subscriptions.listsubs.callback(subscriptions, bot.context(guild_id, user_id), *options)
+
+    async def atsub(guild_id, user_id, query):
+        await subscriptions.atsub.callback(subscriptions, bot.context(guild_id, user_id), query)
+
+    async def rlist_sounds(path):
+        soundboard._rlistSounds(path)
+
+    async def resolve_sound(query):
+        soundboard.library.resolve(query)
+
+    def sound_query():
+        name = rng.choice(sounds)
+        kind = rng.random()
+        if kind < 0.3:
+            return name,
+        base = name.rsplit("/", 1)[-1]
+        if kind < 0.6:
+            return base,
+        if kind < 0.8:
+            return base[:rng.randint(3, len(base))],
+        return misspell(rng, base),
+
+    def member_and_sub():
+        guild_id, sub_name = guild_and_sub()
+        return guild_id, user(), sub_name
+
+    benchmarks = [
+        ("match_sub", match_sub, match_query),
+        ("subscribe", subscribe, member_and_sub),
+        ("listsubs_all", listsubs, lambda: (rng.choice(guild_ids), user(), "all")),
+        ("listsubs_me", listsubs, lambda: (rng.choice(guild_ids), user(), "me")),
+        ("atsub", atsub, member_and_sub),
+        ("rlist_sounds", rlist_sounds, lambda: (rng.choice([""] + directories),)),
+        ("resolve_sound", resolve_sound, sound_query),
+    ]
+
+    results = {}
+    for name, op, make_input in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        inputs = [make_input() for _ in range(n)]
+        results[name] = await measure(op, *split(inputs), store, rest)
+
+    subscriptions.cog_unload()
+    soundboard.cog_unload()
+    return {"setup": setup, "results": results}
+
+
+def report(run_result: Dict, baseline: Optional[Dict]):
+    for name, seconds in run_result["setup"].items():
+        print(f"{name}: {seconds:.2f}s")
+    print()
+    print(f"{'benchmark':<14} {'p50 us':>10} {'p99 us':>10} {'alloc KiB':>10} {'disk B':>10} {'rest':>6}")
+    for name, result in run_result["results"].items():
+        disk = f"{result['disk_bytes']:.0f}" if result["disk_bytes"] is not None else "n/a"
+        print(
+            f"{name:<14} {result['p50_us']:>10.1f} {result['p99_us']:>10.1f} {result['alloc_kib']:>10.1f} "
+            f"{disk:>10} {result['rest_calls']:>6.2f}"
+        )
+        old = (baseline or {}).get("results", {}).get(name)
+        if old is not None:
+            changes = [
+                f"{metric} {100 * (result[metric] - old[metric]) / old[metric]:+.1f}%"
+                for metric in ("p50_us", "p99_us", "alloc_kib", "disk_bytes")
+                if result[metric] is not None and old.get(metric)
+            ]
+            print(f"{'':<14} vs baseline: {', '.join(changes)}")
+
+
+def dataset_config(args) -> Dict:
+    # Everything that changes the work done, and so has to match for two runs to be comparable
+    return {key: value for key, value in vars(args).items() if key not in ("only", "output", "compare")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--subs", type=int, default=500, help="subscriptions per guild")
+    parser.add_argument("--subscribers", type=int, default=20, help="subscribers per subscription")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--sounds", type=int, default=5000)
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds each REST call takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="REST latency jitter, as a fraction of --latency")
+    parser.add_argument("--cached-percent", type=int, default=80, help="share of members in the member cache")
+    parser.add_argument("--iterations", type=int, default=500, help="timed calls per benchmark")
+    parser.add_argument("--alloc-iterations", type=int, default=50, help="calls per benchmark traced for memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if any(baseline["config"].get(key) != value for key, value in dataset_config(args).items()):
+            print("warning: the baseline was run on a different dataset or seed", file=sys.stderr)
+
+    # The cogs use paths relative to the working directory, so a scratch one keeps the real data untouched
+    cwd = os.getcwd()
+    workspace = tempfile.mkdtemp(prefix="bananabot-bench-")
+    os.chdir(workspace)
+    try:
+        run_result = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    run_result["config"] = dataset_config(args)
+    report(run_result, baseline)
+    if args.output:
+        with open(args.output, mode="w") as file:
+            json.dump(run_result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Offline stand-ins for the parts of discord.py the cogs touch: a bot, guilds, members, channels, messages and command
+contexts. Everything that would be a REST or gateway round-trip goes through FakeRest, which counts the calls and
+sleeps for a configurable latency, so the cogs can be driven without a connection to Discord.
+"""
+import asyncio
+import contextlib
+import itertools
+import random
+from collections import Counter
+from types import SimpleNamespace
+from typing import *
+
+BOT_ID = 1
+
+
+class FakeRest:
+    """
+    Counts requests by route and makes each one take latency seconds, give or take jitter (a fraction of latency).
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1 << 40)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    async def request(self, route: str):
+        self.calls[route] += 1
+        delay = self.latency * (1 + self.jitter * self._rng.uniform(-1, 1)) if self.latency else 0
+        await asyncio.sleep(delay)
+
+
+class FakeMember:
+    def __init__(self, user_id: int, guild: "FakeGuild" = None, administrator: bool = False):
+        self.id = user_id
+        self.guild = guild
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.avatar_url = ""
+        self.bot = user_id == BOT_ID
+        self.roles = []
+        self.guild_permissions = SimpleNamespace(administrator=administrator)
+
+
+class FakeMessage:
+    def __init__(self, rest: FakeRest, channel: "FakeChannel", content: Optional[str] = None, embed=None):
+        self.rest = rest
+        self.id = rest.next_id()
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def add_reaction(self, emoji: str):
+        await self.rest.request("PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me")
+
+    async def edit(self, content: Optional[str] = None, embed=None):
+        await self.rest.request("PATCH /channels/{channel_id}/messages/{message_id}")
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+
+
+class FakeChannel:
+    def __init__(self, rest: FakeRest, guild: "FakeGuild"):
+        self.rest = rest
+        self.id = rest.next_id()
+        self.guild = guild
+
+    async def send(self, content: Optional[str] = None, embed=None) -> FakeMessage:
+        await self.rest.request("POST /channels/{channel_id}/messages")
+        return FakeMessage(self.rest, self, content, embed)
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        message = FakeMessage(self.rest, self)
+        message.id = message_id
+        return message
+
+
+class FakeGuild:
+    """
+    A guild whose members are user ids 1..users, except every leave_every-th one, who has left. Only cached_percent of
+    the members are in the local member cache; the rest have to be looked up with query_members like a large guild
+    without the members intent.
+    """
+
+    def __init__(self, rest: FakeRest, guild_id: int, users: int, cached_percent: int = 80, leave_every: int = 50):
+        self.rest = rest
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.users = users
+        self.cached_percent = cached_percent
+        self.leave_every = leave_every
+        self.voice_client = None
+        self.channel = FakeChannel(rest, self)
+        self._members: Dict[int, FakeMember] = {}
+
+    def _is_member(self, user_id: int) -> bool:
+        return 1 < user_id <= self.users and user_id % self.leave_every != 0
+
+    def _member(self, user_id: int) -> FakeMember:
+        member = self._members.get(user_id)
+        if member is None:
+            member = self._members[user_id] = FakeMember(user_id, self)
+        return member
+
+    def get_member(self, user_id: int) -> Optional[FakeMember]:
+        if self._is_member(user_id) and user_id % 100 < self.cached_percent:
+            return self._member(user_id)
+        return None
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channel if channel_id == self.channel.id else None
+
+    async def query_members(self, user_ids: List[int], limit: int = 5, cache: bool = True) -> List[FakeMember]:
+        await self.rest.request("GATEWAY REQUEST_GUILD_MEMBERS")
+        return [self._member(user_id) for user_id in user_ids[:limit] if self._is_member(user_id)]
+
+    async def fetch_member(self, user_id: int) -> FakeMember:
+        await self.rest.request("GET /guilds/{guild_id}/members/{user_id}")
+        return self._member(user_id)
+
+
+class FakeContext:
+    def __init__(self, bot: "FakeBot", guild: FakeGuild, author: FakeMember, mentions: List[FakeMember] = ()):
+        self.bot = bot
+        self.guild = guild
+        self.channel = guild.channel
+        self.author = author
+        self.message = SimpleNamespace(author=author, mentions=list(mentions), guild=guild, channel=guild.channel)
+
+    async def send(self, content: Optional[str] = None, embed=None) -> FakeMessage:
+        return await self.channel.send(content, embed=embed)
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        await self.guild.rest.request("POST /channels/{channel_id}/typing")
+        yield
+
+
+class FakeBot:
+    """
+    Hands out FakeGuilds on demand, so a dataset of any number of guilds costs nothing until a guild is used.
+    """
+
+    def __init__(self, rest: FakeRest, users: int, cached_percent: int = 80):
+        self.rest = rest
+        self.users = users
+        self.cached_percent = cached_percent
+        self.user = FakeMember(BOT_ID)
+        self.loop = asyncio.get_event_loop()
+        self._guilds: Dict[int, FakeGuild] = {}
+
+    def get_guild(self, guild_id: int) -> FakeGuild:
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = FakeGuild(self.rest, guild_id, self.users, self.cached_percent)
+        return guild
+
+    @property
+    def guilds(self) -> List[FakeGuild]:
+        return list(self._guilds.values())
+
+    def context(self, guild_id: int, author_id: int, mentions: Iterable[int] = ()) -> FakeContext:
+        guild = self.get_guild(guild_id)
+        return FakeContext(self, guild, guild._member(author_id), [guild._member(user_id) for user_id in mentions])
@@ -0,0 +1,98 @@
+"""
+Measures the memory JsonSubscriptionStore holds per subscriber, against the lists of decimal strings that the store
+kept before subscribers became sorted id arrays (which is what json.load of an unversioned snapshot gives). Both are
+measured with tracemalloc as the memory still allocated once loading is done, on the same synthetic snapshot.
+
+The default dataset is a million subscriptions.
+
+Run from the repository root: python -m benchmarks.memory
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from SubscriptionStore import JsonSubscriptionStore
+
+# User ids are snowflakes of 17 to 19 digits; this range gives the 18 digits of most current accounts
+USER_IDS = (10 ** 17, 10 ** 18)
+GUILD_ID_BASE = 10 ** 9
+
+
+def write_snapshot(path: str, rng: random.Random, args) -> int:
+    """
+    Writes an unversioned snapshot with args.subscriptions subscriptions spread evenly over the subs, and returns
+    how many it wrote.
+    """
+    users = [rng.randrange(*USER_IDS) for _ in range(args.users)]
+    per_sub = args.subscriptions // (args.guilds * args.subs)
+    with open(path, mode="w") as file:
+        file.write("{\n")
+        for g in range(args.guilds):
+            guild = {f"sub{s}": [str(user_id) for user_id in rng.sample(users, per_sub)] for s in range(args.subs)}
+            file.write(f"{json.dumps(str(GUILD_ID_BASE + g))}: {json.dumps(guild)}")
+            file.write(",\n" if g < args.guilds - 1 else "\n")
+        file.write("}\n")
+    return per_sub * args.guilds * args.subs
+
+
+def retained(load: Callable[[], Any]) -> Tuple[Any, int]:
+    """
+    Calls load and returns its result and the bytes still allocated afterwards.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def load_legacy(path: str) -> Dict[str, Dict[str, List[str]]]:
+    with open(path) as file:
+        return json.load(file)
+
+
+def load_store(path: str) -> JsonSubscriptionStore:
+    store = JsonSubscriptionStore(path)
+    store.load()
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=1_000_000, help="total subscriptions")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--subs", type=int, default=50, help="subscriptions per guild")
+    parser.add_argument("--users", type=int, default=200_000, help="distinct users to draw subscribers from")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix="bananabot-bench-")
+    try:
+        path = os.path.join(workspace, "subscriptions.json")
+        subscriptions = write_snapshot(path, random.Random(args.seed), args)
+
+        print(f"{subscriptions} subscriptions in {args.guilds * args.subs} subs")
+        print(f"{'representation':<24} {'MiB':>8} {'B/subscriber':>13}")
+        for name, load in (("lists of str (before)", load_legacy), ("sorted array('Q')", load_store)):
+            # Kept alive until measured, then dropped before the next one
+            data, size = retained(lambda: load(path))
+            print(f"{name:<24} {size / 2 ** 20:>8.1f} {size / subscriptions:>13.1f}")
+            del data
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures how long AudioMixer takes to produce one 20ms frame with 1, 4 and 16 streams playing at once.
+Each stream is a real MixerStream playing an Opus clip encoded up front with discord's Encoder, so the timings cover
+decoding every stream's packet as well as mixing the results. Streams play below unit gain, so even a single stream
+is decoded and mixed rather than passed through.
+
+Needs libopus, like voice itself.
+
+Run from the repository root: python -m benchmarks.mixer
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import discord
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from ClipCache import OpusClip
+from SoundPlayer import FRAME_SAMPLES, AudioMixer, MixerStream
+
+# Voice sends a frame every 20ms; decoding and mixing have to fit comfortably inside that
+FRAME_BUDGET_US = 20_000
+
+
+def encode_clip(rng: np.random.Generator, frames: int) -> OpusClip:
+    """
+    Encodes frames 20ms frames of a few tones over noise, which keeps the decoder about as busy as a real sound.
+    """
+    samples = frames * discord.opus.Encoder.SAMPLES_PER_FRAME
+    seconds = np.arange(samples) / discord.opus.Encoder.SAMPLING_RATE
+    signal = sum(np.sin(2 * np.pi * rng.uniform(100, 2000) * seconds) for _ in range(3)) * 6000
+    signal = signal + rng.normal(0, 2000, size=(discord.opus.Encoder.CHANNELS, samples))
+    # tobytes() writes the samples out interleaved, left then right
+    pcm = np.clip(signal.T, -32768, 32767).astype("<i2").tobytes()
+
+    encoder = discord.opus.Encoder()
+    frame_bytes = FRAME_SAMPLES * 2
+    return OpusClip([
+        encoder.encode(pcm[i:i + frame_bytes], discord.opus.Encoder.SAMPLES_PER_FRAME)
+        for i in range(0, len(pcm), frame_bytes)
+    ])
+
+
+def run(clip: OpusClip, streams: int, frames: int):
+    mixer = AudioMixer(max_streams=streams, on_stream_end=lambda stream: None)
+    for _ in range(streams):
+        mixer.add(MixerStream(clip, gain=0.8))
+
+    timings = []
+    for _ in range(frames):
+        start = time.perf_counter_ns()
+        data = mixer.read()
+        timings.append((time.perf_counter_ns() - start) / 1000)
+        assert len(data) == FRAME_SAMPLES * 2
+    timings.sort()
+    return {
+        "mean": statistics.fmean(timings),
+        "p50": timings[len(timings) // 2],
+        "p99": timings[int(len(timings) * 0.99)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=5000, help="frames to generate per stream count")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Every stream gets its own decoder, so they can all play the same clip
+    clip = encode_clip(np.random.default_rng(args.seed), args.frames)
+
+    print(f"{'streams':>7} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'% budget':>9}")
+    for streams in (1, 4, 16):
+        result = run(clip, streams, args.frames)
+        budget = 100 * result["p99"] / FRAME_BUDGET_US
+        print(f"{streams:>7} {result['mean']:>9.1f} {result['p50']:>9.1f} {result['p99']:>9.1f} {budget:>8.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
 #!/usr/bin/python
 
+import time
+
+# Taken before the other imports so the startup breakdown includes them
+STARTED = time.perf_counter()
+
+import logging
 import os
+import sys
 
 import discord
 from discord.ext import commands
 from pretty_help import PrettyHelp
 
 import config
+from CogLoader import CogLoader
+from Diagnostics import LoopWatchdog, SamplingProfiler
+from Metrics import command_finished, command_started, instrument_http, serve_metrics, summary, watch_loop
+from Outbound import outbound
 
 with open('./token') as token_file:
     token = token_file.readline()
@@ -14,41 +25,116 @@ with open('./token') as token_file:
 intents = discord.Intents.default()
 intents.members = True
 intents.reactions = True
-client = commands.Bot(command_prefix=config.PREFIX, help_command=PrettyHelp(), intents=intents)
+# launcher.py tells each worker process which shards it owns
+worker = int(os.environ.get('BANANABOT_WORKER', '0'))
+workers = int(os.environ.get('BANANABOT_WORKERS', '1'))
+if 'BANANABOT_SHARD_IDS' in os.environ:
+    client = commands.AutoShardedBot(command_prefix=config.PREFIX, help_command=PrettyHelp(), intents=intents,
+                                     shard_ids=[int(i) for i in os.environ['BANANABOT_SHARD_IDS'].split(',')],
+                                     shard_count=int(os.environ['BANANABOT_SHARD_COUNT']))
+elif config.SHARD_COUNT is not None:
+    client = commands.AutoShardedBot(command_prefix=config.PREFIX, help_command=PrettyHelp(), intents=intents,
+                                     shard_count=config.SHARD_COUNT or None)
+else:
+    client = commands.Bot(command_prefix=config.PREFIX, help_command=PrettyHelp(), intents=intents)
+profiler = SamplingProfiler(client.loop)
+owner_only = commands.check(lambda ctx: ctx.message.author.id == config.OWNER_ID)
+cogs = CogLoader(client, lazy=config.LAZY_COGS)
+log = logging.getLogger('bot')
+startup = {'imports': time.perf_counter() - STARTED}
 
 
 # Gives debug feedback that the bot has successfully launched.
 @client.event
 async def on_ready():
     print(f'Logged in as\n{client.user.name}\n{client.user.id}\n------')
-    await client.change_presence(status=discord.Status.online)
+    # on_ready fires again on every reconnect; the breakdown is only about the first one
+    if 'ready' not in startup:
+        startup['ready'] = time.perf_counter() - STARTED
+        loaded = ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in cogs.timings.items())
+        log.info('Ready %.2fs after start: imports %.2fs, cogs %.2fs (%s), login and gateway %.2fs',
+                 startup['ready'], startup['imports'], startup.get('cogs', 0), loaded,
+                 startup['ready'] - startup['imports'] - startup.get('cogs', 0))
+    await outbound.change_presence(client, status=discord.Status.online)
+
+
+@client.event
+async def on_command(ctx):
+    command_started(ctx)
+
+
+@client.event
+async def on_command_completion(ctx):
+    command_finished(ctx)
 
 
 @client.event
 async def on_command_error(ctx, error):
+    command_finished(ctx, error)
     if isinstance(error, commands.CommandNotFound):
         await ctx.send('Invalid command used.')
 
 
-# Loading cogs from the subdirectory
+# Loading cogs from the subdirectory, leaving the lazy ones until one of their commands is used
 def loadCogs():
-    for filename in os.listdir('./cogs'):
-        if filename.endswith('.py'):
-            client.load_extension(f'cogs.{filename[:-3]}')
+    start = time.perf_counter()
+    cogs.load_all()
+    startup['cogs'] = time.perf_counter() - start
 
 
 @client.command(aliases=['rel', 'rl'], hidden=True)
-@commands.check(lambda ctx: ctx.message.author.id == 166989171456606208)
+@owner_only
 async def reload(ctx, extension):
     try:
-        client.unload_extension(f'cogs.{extension}')
-        client.load_extension(f'cogs.{extension}')
-        await ctx.send(f'{extension} reloaded.')
+        seconds = await cogs.reload(extension)
+        await ctx.send(f'{extension} reloaded in {seconds * 1000:.0f}ms.')
     except Exception as e:
         await ctx.send(e)
 
+
+@client.command(hidden=True)
+@owner_only
+async def stats(ctx):
+    await ctx.send(f'```\n{summary()}\n```')
+
+
+# Samples every thread's stack for a while and saves them as folded stacks, ready for flamegraph.pl or speedscope
+@client.command(hidden=True)
+@owner_only
+async def profile(ctx, seconds='30'):
+    if seconds == 'stop':
+        if not profiler.running:
+            await ctx.send("The profiler isn't running.")
+            return
+        profiler.stop()
+        return
+    if profiler.running:
+        await ctx.send(f'The profiler is already running, `{config.PREFIX}profile stop` stops it.')
+        return
+    try:
+        duration = min(float(seconds), 600)
+    except ValueError:
+        await ctx.send(f'Usage: {config.PREFIX}profile SECONDS|stop')
+        return
+    await ctx.send(f'Profiling for {duration:g}s.')
+    try:
+        path, samples = await profiler.run(duration)
+    except OSError as e:
+        await ctx.send(f"Couldn't save the profile: {e}")
+        return
+    await ctx.send(f'Wrote {samples} samples to {path}.')
+
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s worker {worker} %(levelname)s %(name)s: %(message)s')
+    if workers > 1 and config.SUB_BACKEND != 'sqlite':
+        sys.exit('Running in several processes needs SUB_BACKEND = "sqlite" in config.py')
     loadCogs()
+    instrument_http(client.http)
+    client.loop.create_task(watch_loop(client))
+    LoopWatchdog(client.loop).start()
+    if config.METRICS_PORT is not None:
+        # Each worker gets its own port, next to the first one
+        client.loop.create_task(serve_metrics(config.METRICS_HOST, config.METRICS_PORT + worker))
     client.run(token)
 
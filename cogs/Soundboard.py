@@ -1,61 +1,179 @@
 import discord
 from discord.ext import commands, tasks
 import asyncio
-import os
-import re
+import functools
+import logging
+from typing import *
 
+from ClipCache import ClipCache
+from Outbound import outbound
+from SoundLibrary import SoundLibrary
+from SoundPlayer import GuildPlayer
+from VoiceManager import VoiceManager
 from config import PREFIX
 
+# How often the sound directory is checked for changes
+LIBRARY_REFRESH_SECONDS = 30
+
+log = logging.getLogger(__name__)
+
+
 # TODO: test
 class SoundBoard(commands.Cog):
 
     def __init__(self, client):
         self.client = client
         self.description = "A soundboard"
+        self.library = SoundLibrary()
+        self.library_ready = asyncio.Event()
+        self.clips = ClipCache()
+        self.players: Dict[int, GuildPlayer] = {}
+        self.voices = VoiceManager(client)
+        # Set while a reload hands this instance's state to its replacement
+        self.handing_off = False
+        self._loudness_pass: Optional[asyncio.Task] = None
+        # Set when a refresh ran since the running loudness pass took its list of sounds
+        self._loudness_stale = False
+        # Set when sounds were added or removed, so the next loudness pass prunes the clip cache once it's done
+        self._prune_clips = False
+        self.refresh_library.start()
+
+    def cog_unload(self):
+        self.refresh_library.cancel()
+        if self.handing_off:
+            # A loudness pass that's running finishes on its own; the index it fills is handed over
+            return
+        self.clips.loudness.stop()
+        if self._loudness_pass is not None:
+            self._loudness_pass.cancel()
+        for player in self.players.values():
+            player.close()
+        self.voices.close()
+
+    async def export_state(self) -> Dict:
+        """
+        Hands the sound index, the clip cache, the voice connections and the players, queues and all, to the instance
+        replacing this one on a reload. The loudness index goes along with the clip cache and saves itself.
+        """
+        return {
+            "library": self.library,
+            "library_ready": self.library_ready.is_set(),
+            "clips": self.clips,
+            "voices": self.voices,
+            "players": self.players,
+        }
+
+    def import_state(self, state: Dict):
+        self.library = state["library"]
+        if state["library_ready"]:
+            self.library_ready.set()
+        self.clips = state["clips"]
+        self.voices = state["voices"]
+        self.players = state["players"]
+        for guild_id, player in self.players.items():
+            # The old callback would go through the old instance
+            player.on_idle = functools.partial(self.voices.release, guild_id)
+
+    def _player(self, guild) -> GuildPlayer:
+        player = self.players.get(guild.id)
+        if player is None:
+            player = GuildPlayer(self.client.loop, lambda: self.voices.release(guild.id))
+            self.players[guild.id] = player
+        return player
 
     @commands.Cog.listener()
     async def on_ready(self):
         print('SoundBoard activated.')
 
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        self.voices.on_voice_state_update(member, before, after)
+
+    """
+    Keeps the sound index in sync with ./cogs/soundboard/. The first run builds it; later runs only rescan
+    directories whose mtime changed. Each run also checks every sound's size and mtime, and new or edited sounds get
+    their loudness measured so their next transcode is normalized, in a pass of its own that later refreshes don't
+    wait for. Clips cached for sounds that have since been removed or edited are deleted after the pass. All of it
+    happens in an executor so the event loop never touches the disk.
+    """
+    @tasks.loop(seconds=LIBRARY_REFRESH_SECONDS)
+    async def refresh_library(self):
+        loop = asyncio.get_running_loop()
+        try:
+            if not self.library_ready.is_set():
+                await loop.run_in_executor(None, self.library.build)
+                self._prune_clips = True
+            elif await loop.run_in_executor(None, self.library.refresh):
+                self._prune_clips = True
+        except OSError:
+            log.exception("Couldn't index the sound directory")
+        # Commands go ahead with whatever was indexed rather than waiting forever
+        self.library_ready.set()
+
+        # Runs whether or not the index changed: a sound overwritten in place leaves its directory's mtime alone, so
+        # only the loudness index's own check of each sound's size and mtime notices it
+        self._loudness_stale = True
+        # A pass that's already running goes round again once it's done rather than racing a second one
+        if self._loudness_pass is None or self._loudness_pass.done():
+            self._loudness_pass = loop.create_task(self._measure_loudness())
+
+    async def _measure_loudness(self):
+        loop = asyncio.get_running_loop()
+        while self._loudness_stale:
+            self._loudness_stale = False
+            try:
+                measured = await loop.run_in_executor(None, self.clips.loudness.update, self.library.paths())
+            except OSError:
+                log.exception("Couldn't update the loudness index")
+                continue
+            if measured:
+                log.info("Measured the loudness of %d sounds", measured)
+            # A sound that was measured is new or edited, so its old clip, if any, is now unused
+            if measured or self._prune_clips:
+                self._prune_clips = False
+                try:
+                    pruned = await self.clips.prune(self.library.paths())
+                except OSError:
+                    log.exception("Couldn't prune the clip cache")
+                else:
+                    if pruned:
+                        log.info("Removed %d unused clips from the cache", pruned)
+
     @commands.command(aliases=['lsb'],
                       brief="Lists sounds",
                       description="List sounds",
                       usage=f"{PREFIX}lsb PATH")
     @commands.guild_only()
     async def listSounds(self, ctx, *args):
-        # this gives a wonky path if args is like "path/to/directory" rather than "path to directory", need check
-        path = '/'.join(args)
-        msg = self._rlistSounds(path)
-        if msg is None:
-            await ctx.send("Sorry, I couldn't find your path")
+        await self.library_ready.wait()
+        # A trailing number picks the page, unless it's actually the name of a directory
+        page = 1
+        if args and args[-1].isdigit() and self.library.listing('/'.join(args)) is None:
+            page = int(args[-1])
+            args = args[:-1]
+        pages = self._rlistSounds('/'.join(args))
+        if pages is None:
+            await outbound.send(ctx, "Sorry, I couldn't find your path")
+            return
+        if not 1 <= page <= len(pages):
+            await outbound.send(ctx, f"There are only {len(pages)} pages")
             return
-        await ctx.send(msg)
+        msg = pages[page - 1]
+        if len(pages) > 1:
+            next_page = ' '.join([*args, str(page % len(pages) + 1)])
+            msg += f"(page {page}/{len(pages)}, `{PREFIX}lsb {next_page}` for the next)"
+        await outbound.send(ctx, msg)
 
     """
-    Given a path relative to ./cogs/soundboard/, return a formatted message displaying all subdirectories and files
-    recursively
+    Given a path relative to ./cogs/soundboard/, return pages of a formatted message displaying all subdirectories
+    and files recursively
     """
-    def _rlistSounds(self, path, depth=0):
-        root = './cogs/soundboard/'
-        rel = os.path.join(root, path)
-        if not os.path.exists(rel):
-            return None
-        msg = ''
-        for item in os.listdir(rel):
-            rel_item_path = os.path.join(rel, item)
-            if os.path.isdir(rel_item_path):
-                msg += f"{'  ' * depth}/{item}\n"
-                msg += self._rlistSounds(os.path.join(path, item), depth=depth + 1)
-            else:
-                regex = '([^.]*).[^.]*'
-                basename = os.path.basename(rel_item_path)
-                match = re.search(regex, basename)
-                if match is not None:
-                    msg += f"{'  ' * depth}-{match.group(1)}\n"
-        return msg
+    def _rlistSounds(self, path):
+        return self.library.listing(path)
 
     """
-    Takes in a space separated path to a sound and plays it.
+    Takes in a space separated path to a sound, or just its name, and plays it. Partial and misspelled names are
+    resolved through the library's indexes, with suggestions when more than one sound fits.
     """
     @commands.command(aliases=['sb', 'sound'],
                       brief="Plays a sound",
@@ -63,46 +181,65 @@ class SoundBoard(commands.Cog):
                       usage=f"{PREFIX}sb path to sound")
     @commands.guild_only()
     async def soundboard(self, ctx, *args):
-        path = '/'.join(args)
-        root = './cogs/soundboard/'
-        relpath = os.path.join(root, f'{path}.mp3')
-        if not os.path.exists(relpath):
-            await ctx.send("Couldn't find the sound.")
+        await self.library_ready.wait()
+        match, suggestions = self.library.resolve('/'.join(args))
+        relpath = self.library.lookup(match) if match is not None else None
+        if relpath is None:
+            if suggestions:
+                names = ", ".join(f"`{suggestion.replace('/', ' ')}`" for suggestion in suggestions)
+                await outbound.send(ctx, f"Did you mean {names}?")
+            else:
+                await outbound.send(ctx, "Couldn't find the sound.")
+            return
+
+        # Clips are transcoded to Opus once and cached, so repeat plays skip ffmpeg entirely
+        try:
+            clip = await self.clips.get(relpath)
+        except (RuntimeError, OSError):
+            log.exception("Couldn't load %s", relpath)
+            await outbound.send(ctx, "Couldn't play the sound.")
             return
 
+        # Banana follows the author between channels, moving its connection instead of making a new one
         voice = ctx.guild.voice_client
         author = ctx.author
+        if author.voice is not None and author.voice.channel is not None:
+            try:
+                voice = await self.voices.connect(author.voice.channel)
+            except (asyncio.TimeoutError, discord.ClientException):
+                log.exception("Couldn't join voice in guild %s", ctx.guild.id)
+                await outbound.send(ctx, "Couldn't join your voice channel.")
+                return
+        elif not (voice and voice.is_connected()):
+            await outbound.send(ctx, "You need to be in a voice channel.")
+            return
 
-        def leave(err):
-            # asyncio.run_coroutine_threadsafe(voice.disconnect(), self.client.loop)
-            pass
-
-        if voice and voice.channel and not voice.is_playing():
-            voice.play(discord.FFmpegPCMAudio(relpath), after=None)
-            voice.source = discord.PCMVolumeTransformer(voice.source)
-            voice.source.volume = 1
-        elif author.voice is not None and author.voice.channel is not None:
-            voice = await author.voice.channel.connect(timeout=30, reconnect=True)
-            voice.play(discord.FFmpegPCMAudio(relpath), after=None)
-            voice.source = discord.PCMVolumeTransformer(voice.source)
-            voice.source.volume = 1
+        self.voices.touch(ctx.guild.id)
+        try:
+            ahead = self._player(ctx.guild).enqueue(voice, clip)
+        except asyncio.QueueFull:
+            await outbound.send(ctx, "There are too many sounds queued, try again in a bit.")
+            return
+        if ahead:
+            await outbound.send(ctx, f"Queued, {ahead} sound{'s' if ahead > 1 else ''} ahead.")
 
-        await self.timeoutleave(voice)
+    @commands.command(aliases=['sbskip'],
+                      brief="Skips the current sound",
+                      description="Skips the current sound and plays the next queued one",
+                      usage=f"{PREFIX}skip")
+    @commands.guild_only()
+    async def skip(self, ctx):
+        if not self._player(ctx.guild).skip():
+            await outbound.send(ctx, "Nothing is playing!")
 
-    """
-    Waits timeout amount of seconds before leaving the voice channel
-    """
-    async def timeoutleave(self, voice, timeout=300):
-        if not voice:
-            return
-        while voice.is_playing():
-            await asyncio.sleep(1)
-        else:
-            await asyncio.sleep(timeout)
-            while voice.is_playing():
-                break
-            else:
-                await voice.disconnect()
+    @commands.command(aliases=['sbclear'],
+                      brief="Clears the sound queue",
+                      description="Removes every queued sound, letting the current one finish",
+                      usage=f"{PREFIX}clearsounds")
+    @commands.guild_only()
+    async def clearsounds(self, ctx):
+        removed = self._player(ctx.guild).clear()
+        await outbound.send(ctx, f"Removed {removed} queued sound{'' if removed == 1 else 's'}.")
 
     @commands.command(brief="Makes Banana disconnect from the channel",
                       description="Makes Banana disconnect from the channel",
@@ -111,10 +248,23 @@ class SoundBoard(commands.Cog):
     async def leave(self, ctx):
         voice = ctx.guild.voice_client
         if voice is None:
-            await ctx.send("I'm not in a channel!")
+            await outbound.send(ctx, "I'm not in a channel!")
             return
         # maybe have it play a cute sound before leaving or something idk lol
-        await voice.disconnect()
+        self._player(ctx.guild).close()
+        await self.voices.disconnect(ctx.guild)
+
+    @commands.command(brief="Shows voice connection times",
+                      description="Shows how long joining and moving between voice channels has been taking",
+                      usage=f"{PREFIX}voicestats")
+    async def voicestats(self, ctx):
+        stats = self.voices.stats()
+        if not stats:
+            await outbound.send(ctx, "I haven't connected to voice yet.")
+            return
+        lines = [f"{kind}: {s['count']} times, p50 {s['p50']:.0f}ms, p95 {s['p95']:.0f}ms, max {s['max']:.0f}ms"
+                 for kind, s in stats.items()]
+        await outbound.send(ctx, "\n".join(lines))
 
 
 def setup(client):
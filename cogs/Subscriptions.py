@@ -2,122 +2,276 @@
 import discord
 from discord.ext import commands
 
-import json
+import asyncio
+import io
+import logging
+import os
+import time
 from typing import *
 
-from Utilities import retrieve_embed_field_index
+from DmFanout import DmFanout, FanoutProgress
+from MemberResolver import MemberResolver
+from Outbound import Priority, outbound
+from SubscriptionStore import (
+    DELIVERY_MODES,
+    TRANSFER_FORMATS,
+    AtsubCall,
+    SubscriptionStore,
+    open_subscription_store,
+    read_subscriptions,
+    write_subscriptions,
+)
+from Utilities import PrefixIndex
 from config import PREFIX, MIN_MATCH
 
 ATTENDING_STRING = "Attending"
 NOT_ATTENDING_STRING = "Not attending"
 DELIMITER = ", "
 BANANAWHISPERER = "Banana whisperer"
+# Discord's limits on the length of a message's content and of an embed field's value
+MESSAGE_LIMIT = 2000
+FIELD_LIMIT = 1024
+SPOILER = "||"
+# How long attendance changes to an atsub message are collected before they are applied in a single edit
+EDIT_WINDOW = 1.5
 
+log = logging.getLogger(__name__)
 
-def add_user_to_embed_field(
-    embed: discord.Embed, field: str, user: discord.User, options: Optional[Dict] = None
-) -> bool:
+
+def chunk_mentions(mentions: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Packs mentions into as few spoilered messages as possible, each at most limit characters long.
+    :param mentions: List[str]
+    :param limit: int
+    :return: List[str]
     """
-    Adds user to an embed field for a Banana atsub message. Returns True iff successful.
-    Precondition: The desired field has value of the form "User1{DELIMITER}User2, ..."
-    :param embed: discord.Embed
-    :param field: str
-    :param user: discord.User
-    :param options: Dict
-    :return: bool
+    room = limit - 2 * len(SPOILER)
+    chunks = []
+    current = []
+    current_length = 0
+    for mention in mentions:
+        if current and current_length + len(mention) > room:
+            chunks.append(SPOILER + "".join(current) + SPOILER)
+            current = []
+            current_length = 0
+        current.append(mention)
+        current_length += len(mention)
+    if current:
+        chunks.append(SPOILER + "".join(current) + SPOILER)
+    return chunks
+
+
+def render_atsub_embed(guild: discord.Guild, call: AtsubCall) -> discord.Embed:
     """
-    # Currently no use of options in this function, but I imagine there might be uses in the future
-    if not options:
-        options = {}
-    user_name = user.display_name
-    index = retrieve_embed_field_index(field, embed)
-    if index == -1:
-        return False
-    going_field = embed.fields[index]
-    going_field_value_array = going_field.value.split(DELIMITER)
-    if user_name in going_field_value_array:
-        return False
-    going_field_value_array.append(user_name)
-    going_field_value_formatted = DELIMITER.join(going_field_value_array)
-    embed.set_field_at(index=index, name=field, value=going_field_value_formatted)
-    return True
-
-
-def remove_user_from_embed_field(
-    embed: discord.Embed, field: str, user: discord.User, options: Optional[Dict] = None
-):
+    Builds the embed of an atsub message from its attendance.
+    :param guild: discord.Guild
+    :param call: AtsubCall
+    :return: discord.Embed
     """
-    Removes a user to an embed field for a Banana atsub message. Returns True iff successful.
-    Precondition: The desired field has value of the form "User1{DELIMITER}User2, ..."
-    :param embed: discord.Embed
-    :param field: str
-    :param user: discord.User
-    :param options: Dict
-    :return: bool
+    embed = discord.Embed(
+        title=f"**Calling all {call.sub_name} members!**",
+        description=f"If you don't want to be mentioned in this, call `{PREFIX}unsub "
+        f"{call.sub_name}`. \nNote that unsub is case sensitive!",
+        color=0xFFFF00,
+    )
+    author = guild.get_member(call.author_id)
+    if author is not None:
+        embed.set_author(name=author.display_name, icon_url=author.avatar_url)
+
+    # The author always attends, so they are listed first
+    attending = [call.author_id] + sorted(call.attending - {call.author_id})
+    # Leave room for the "and N more" tail in case the names don't fit in the field
+    room = FIELD_LIMIT - len(f"{DELIMITER}and {len(attending)} more")
+    names = []
+    length = 0
+    for user_id in attending:
+        member = guild.get_member(user_id)
+        name = member.display_name if member is not None else f"<@{user_id}>"
+        length += len(name) + len(DELIMITER)
+        if length > room:
+            names.append(f"and {len(attending) - len(names)} more")
+            break
+        names.append(name)
+    embed.add_field(name=ATTENDING_STRING, value=DELIMITER.join(names))
+    return embed
+
+
+class EditBatcher:
     """
-    if not options:
-        options = {}
-    ignores = options.pop("ignores", [])
-    user_name = user.display_name
-    if user_name in ignores:
-        return False
-    index = retrieve_embed_field_index(field, embed)
-    if index == -1:
-        return False
-    going_field = embed.fields[index]
-    user_name = user.display_name
-    going_field_value_array = going_field.value.split(DELIMITER)
-    if user_name not in going_field_value_array:
-        return False
-    going_field_value_array.remove(user_name)
-    going_field_value_formatted = DELIMITER.join(going_field_value_array)
-    embed.set_field_at(index=index, name=field, value=going_field_value_formatted)
-    return True
+    Coalesces requests to re-render a message into one edit per window. When the window closes, render builds the
+    edit from the current state (or returns None to skip it) and send applies it, so the latest state always wins.
+    Rendering is synchronous, so flush_all has read all the state it needs by the time it returns.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[int], Optional[Any]],
+        send: Callable[[Any], Awaitable[None]],
+        window: float = EDIT_WINDOW,
+    ):
+        self.render = render
+        self.send = send
+        self.window = window
+        self._handles: Dict[int, asyncio.TimerHandle] = {}
+
+    def mark(self, message_id: int):
+        """
+        Schedules an edit of message_id unless one is already pending.
+        """
+        if message_id not in self._handles:
+            loop = asyncio.get_running_loop()
+            self._handles[message_id] = loop.call_later(self.window, lambda: self._flush(message_id))
+
+    def _flush(self, message_id: int):
+        self._handles.pop(message_id, None)
+        edit = self.render(message_id)
+        if edit is not None:
+            asyncio.get_running_loop().create_task(self._send(message_id, edit))
+
+    async def _send(self, message_id: int, edit):
+        try:
+            await self.send(edit)
+        except discord.HTTPException as e:
+            log.warning("Couldn't edit message %s: %s", message_id, e)
+
+    def flush_all(self):
+        """
+        Renders every pending edit now and sends them in the background.
+        """
+        for message_id, handle in list(self._handles.items()):
+            handle.cancel()
+            self._flush(message_id)
 
 
 class Subscription(commands.Cog):
     def __init__(self, client):
         self.client = client
         self.description = "A way to mention a group of people without extra roles"
-
-    # Adds BananaBot's server ids to subscriptions.json
+        # Loaded in the background so startup doesn't wait on it; commands and listeners wait for store_ready
+        self.store: Optional[SubscriptionStore] = None
+        self.store_ready = asyncio.Event()
+        self._guilds_initialized = False
+        # Per-guild name indexes for _match_sub, built on first use and updated by makesub/removesub
+        self._sub_indexes: Dict[int, PrefixIndex] = {}
+        self.members = MemberResolver()
+        self.attendance_edits = EditBatcher(self._render_attendance, self._send_attendance)
+        # DM fan-outs still running; they outlive the atsub that started them
+        self._fanouts: Set[asyncio.Task] = set()
+        self._loading = client.loop.create_task(self._load_store())
+        # Set while a reload hands this instance's state to its replacement
+        self.handing_off = False
+
+    def cog_unload(self):
+        self._loading.cancel()
+        if self.handing_off:
+            return
+        for fanout in self._fanouts:
+            fanout.cancel()
+        # Reads what the edits show from the store before it's closed; the edits themselves go out afterwards
+        self.attendance_edits.flush_all()
+        if self.store is not None:
+            self.store.close()
+
+    async def export_state(self) -> Dict:
+        """
+        Hands the store and everything built on it to the instance replacing this one on a reload, after sending
+        pending attendance edits and writing out pending changes.
+        """
+        await self.store_ready.wait()
+        if self.store is None:
+            # The load failed, so there's nothing to keep; the new instance tries loading again
+            return {"store": None}
+        self.attendance_edits.flush_all()
+        await self.store.flush()
+        return {
+            "store": self.store,
+            "sub_indexes": self._sub_indexes,
+            "members": self.members,
+            "fanouts": self._fanouts,
+            "guilds_initialized": self._guilds_initialized,
+        }
+
+    def import_state(self, state: Dict):
+        if state["store"] is None:
+            return
+        # The load scheduled in __init__ hasn't started yet, so cancelling it means the store is never read again
+        self._loading.cancel()
+        self.store = state["store"]
+        self._sub_indexes = state["sub_indexes"]
+        self.members = state["members"]
+        self._fanouts = state["fanouts"]
+        self._guilds_initialized = state["guilds_initialized"]
+        self.store_ready.set()
+
+    async def _load_store(self):
+        start = time.perf_counter()
+        try:
+            self.store = await asyncio.get_running_loop().run_in_executor(None, open_subscription_store)
+        except Exception:
+            log.exception("Couldn't load subscriptions; subscription commands are off until the cog is reloaded")
+        else:
+            log.info("Loaded subscriptions in %.3fs", time.perf_counter() - start)
+        # Set either way so nothing waits forever; a store of None means the load failed
+        self.store_ready.set()
+
+    async def _wait_for_store(self) -> bool:
+        """
+        Waits until the store is loaded and returns whether it loaded.
+        :return: bool
+        """
+        await self.store_ready.wait()
+        return self.store is not None
+
+    async def cog_before_invoke(self, ctx):
+        if not await self._wait_for_store():
+            await outbound.send(ctx, "Subscriptions couldn't be loaded, so this command is unavailable right now.")
+            raise commands.CommandError("The subscription store failed to load")
+
+    # Adds BananaBot's server ids to the store, once; on_ready fires again after every reconnect
     @commands.Cog.listener()
     async def on_ready(self):
-        self._initialize_sub_data()
+        if not self._guilds_initialized:
+            self._guilds_initialized = True
+            if await self._wait_for_store():
+                self._initialize_sub_data()
         print("Subscriptions activated.")
 
+    # Raw reaction events arrive whether or not the message is cached, so calls stay live across restarts
     @commands.Cog.listener()
-    async def on_reaction_add(self, reaction: discord.Reaction, user: discord.User):
-        message = reaction.message
-        # Check it's not Banana reacting
-        if user == self.client.user or message.author != self.client.user:
-            return
-        # Check if the message sent is an atsub message
-        if "Calling all" in message.embeds[0].title:
-            embed = message.embeds[0]
-            if reaction.emoji == "✅":
-                # Nesting the if for code clarity in case future handlers continue the if block
-                if add_user_to_embed_field(embed, ATTENDING_STRING, user):
-                    await message.edit(embed=embed)
-            elif reaction.emoji == "❌":
-                pass
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if await self._wait_for_store():
+            self._update_attendance(payload, attending=True)
 
     @commands.Cog.listener()
-    async def on_reaction_remove(self, reaction, user):
-        message = reaction.message
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if await self._wait_for_store():
+            self._update_attendance(payload, attending=False)
+
+    def _update_attendance(self, payload: discord.RawReactionActionEvent, attending: bool):
         # Check it's not Banana reacting
-        if user == self.client.user or message.author != self.client.user:
+        if payload.user_id == self.client.user.id or str(payload.emoji) != "✅":
+            return
+        # Check if the message is a tracked atsub message
+        call = self.store.atsub_call(payload.message_id)
+        if call is None:
             return
-        # Check if the message sent is an atsub message
-        if "Calling all" in message.embeds[0].title:
-            embed = message.embeds[0]
-            if reaction.emoji == "✅":
-                if remove_user_from_embed_field(
-                    embed, ATTENDING_STRING, user, options={"ignores": [embed.author]}
-                ):
-                    await message.edit(embed=embed)
-            elif reaction.emoji == "❌":
-                pass
+        # The caller stays on the list even if they remove their reaction
+        if not attending and payload.user_id == call.author_id:
+            return
+        if self.store.set_attending(payload.message_id, payload.user_id, attending):
+            self.attendance_edits.mark(payload.message_id)
+
+    def _render_attendance(self, message_id: int) -> Optional[Tuple[discord.PartialMessage, discord.Embed]]:
+        call = self.store.atsub_call(message_id)
+        guild = self.client.get_guild(call.guild_id) if call is not None else None
+        channel = guild.get_channel(call.channel_id) if guild is not None else None
+        if channel is None:
+            return None
+        return channel.get_partial_message(message_id), render_atsub_embed(guild, call)
+
+    async def _send_attendance(self, edit: Tuple[discord.PartialMessage, discord.Embed]):
+        message, embed = edit
+        await outbound.edit(message, embed=embed)
 
     async def _validate_user(self, ctx):
         is_banana_whisperer = any(
@@ -125,7 +279,7 @@ class Subscription(commands.Cog):
         )
         is_admin = ctx.message.author.guild_permissions.administrator
         if not is_banana_whisperer and not is_admin:
-            await ctx.send("Hey, you're not a Banana whisperer...")
+            await outbound.send(ctx, "Hey, you're not a Banana whisperer...")
             return False
         return True
 
@@ -137,30 +291,24 @@ class Subscription(commands.Cog):
     )
     @commands.guild_only()
     async def makesub(self, ctx, sub_name):
-        if not self._validate_user(ctx):
+        if not await self._validate_user(ctx):
             return
         if len(sub_name) <= MIN_MATCH:
-            await ctx.send(
+            await outbound.send(
+                ctx,
                 f"This name is too short! Please make this name at least {MIN_MATCH} characters long."
             )
             return
-        sub_data = self._load_sub_data()
-        server_id = str(ctx.guild.id)
-
-        if server_id in sub_data:
-            sub_dict = sub_data[server_id]
-            if self._match_sub(sub_dict, sub_name) is not None:
-                await ctx.send(
-                    f"Subscription '{sub_name}' already exists. Please choose a different name."
-                )
-                return
-            else:
-                sub_dict[sub_name] = []
-        else:
-            sub_data[server_id] = {sub_name: []}
+        if self._match_sub(ctx.guild.id, sub_name) is not None:
+            await outbound.send(
+                ctx,
+                f"Subscription '{sub_name}' already exists. Please choose a different name."
+            )
+            return
 
-        self._write_sub_data(sub_data)
-        await ctx.send(f"Subscription  '{sub_name}' successfully created.")
+        self.store.create_sub(ctx.guild.id, sub_name)
+        self._sub_index(ctx.guild.id).add(sub_name)
+        await outbound.send(ctx, f"Subscription  '{sub_name}' successfully created.")
 
     @commands.command(
         aliases=["rmsub"],
@@ -170,63 +318,60 @@ class Subscription(commands.Cog):
     )
     @commands.guild_only()
     async def removesub(self, ctx, sub_name):
-        if not self._validate_user(ctx):
+        if not await self._validate_user(ctx):
             return
-        sub_data = self._load_sub_data()
-        server_id = str(ctx.guild.id)
-        if not self._sub_exists(server_id, sub_name, match_exact=True):
-            await ctx.send(
+        if not self._sub_exists(ctx.guild.id, sub_name, match_exact=True):
+            await outbound.send(
+                ctx,
                 f"{sub_name} doesn't exist. Note this command is case sensitive!"
             )
             return
-        sub_dict = sub_data[server_id]
-        sub_dict.pop(sub_name)
 
-        self._write_sub_data(sub_data)
-        await ctx.send(f"Subscription  '{sub_name}' successfully removed.")
+        self.store.delete_sub(ctx.guild.id, sub_name)
+        self._sub_index(ctx.guild.id).remove(sub_name)
+        await outbound.send(ctx, f"Subscription  '{sub_name}' successfully removed.")
 
     """
     Takes in a subscription name and subscribes the message sender to sub_name. If there are additional arguments,
-    then it instead subscribes all of the mentioned user in the message to sub_name
+    then it instead subscribes all of the mentioned users and every member of the mentioned roles to sub_name
     """
 
     @commands.command(
         aliases=["sub"],
         brief="Subscribe",
         description="Subscribe",
-        usage=f"SUBSCRIPTION",
+        usage=f"SUBSCRIPTION [@USER|@ROLE...]",
     )
     @commands.guild_only()
     async def subscribe(self, ctx, sub_name, *args):
-        json_file = self._load_sub_data()
-        server_id = str(ctx.guild.id)
-        if not self._sub_exists(server_id, sub_name, match_exact=True):
-            await ctx.send(
+        if not self._sub_exists(ctx.guild.id, sub_name, match_exact=True):
+            await outbound.send(
+                ctx,
                 f"{sub_name} doesn't exist. You can check the subscriptions using `{PREFIX}lsub all`. "
                 f"Note this command is case sensitive!"
             )
             return
 
-        sub_dict = json_file[server_id]
         if len(args) > 0:
             if not ctx.author.guild_permissions.administrator:
-                await ctx.send("You must be an administrator to do this")
+                await outbound.send(ctx, "You must be an administrator to do this")
                 return
 
-            for user in ctx.message.mentions:
-                sub_dict[sub_name].append(str(user.id))
+            # A set, so someone mentioned directly and through a role (or in two roles) only counts once
+            user_ids = {user.id for user in ctx.message.mentions}
+            for role in ctx.message.role_mentions:
+                user_ids.update(member.id for member in role.members)
+            added = self.store.add_subscribers(ctx.guild.id, sub_name, user_ids)
 
-            await ctx.send(
-                f"Subscribed {len(ctx.message.mentions)} users to {sub_name}"
-            )
+            message = f"Subscribed {added} users to {sub_name}"
+            if added < len(user_ids):
+                message += f" ({len(user_ids) - added} already were)"
+            await outbound.send(ctx, message)
         else:
-            if str(ctx.author.id) in sub_dict[sub_name]:
-                await ctx.send(f"You've already subscribed to '{sub_name}'!")
+            if not self.store.add_subscriber(ctx.guild.id, sub_name, ctx.author.id):
+                await outbound.send(ctx, f"You've already subscribed to '{sub_name}'!")
             else:
-                sub_dict[sub_name].append(str(ctx.author.id))
-                await ctx.send(f"Subscribed to '{sub_name}' successfully")
-
-        self._write_sub_data(json_file)
+                await outbound.send(ctx, f"Subscribed to '{sub_name}' successfully")
 
     @commands.command(
         aliases=["unsub"],
@@ -236,42 +381,129 @@ class Subscription(commands.Cog):
     )
     @commands.guild_only()
     async def unsubscribe(self, ctx, sub_name, *args):
-        json_file = self._load_sub_data()
-        server_id = str(ctx.guild.id)
-        if not self._sub_exists(server_id, sub_name, match_exact=True):
-            await ctx.send(
+        if not self._sub_exists(ctx.guild.id, sub_name, match_exact=True):
+            await outbound.send(
+                ctx,
                 f"{sub_name} doesn't exist. Note this command is case sensitive!"
             )
             return
 
-        sub_dict = json_file[server_id]
         if len(args) > 0:
             if not ctx.author.guild_permissions.administrator:
-                await ctx.send("You must be an administrator to do this")
+                await outbound.send(ctx, "You must be an administrator to do this")
                 return
             missed_msg = "Couldn't remove:\n"
             missed_num = 0
             for user in ctx.message.mentions:
-                user_id = str(user.id)
-                if user_id in sub_dict[sub_name]:
-                    sub_dict[sub_name].remove(user_id)
-                else:
+                if not self.store.remove_subscriber(ctx.guild.id, sub_name, user.id):
                     missed_num += 1
                     missed_msg += f"{str(user.name)}\n"
             if missed_num > 0:
-                await ctx.send(missed_msg)
-            await ctx.send(
+                await outbound.send(ctx, missed_msg)
+            await outbound.send(
+                ctx,
                 f"Unsubscribed {len(ctx.message.mentions) - missed_num} users from {sub_name}"
             )
         else:
-            user_id = str(ctx.author.id)
-            if user_id not in sub_dict[sub_name]:
-                await ctx.send(f"You're not in {sub_name}")
+            if not self.store.remove_subscriber(ctx.guild.id, sub_name, ctx.author.id):
+                await outbound.send(ctx, f"You're not in {sub_name}")
                 return
-            sub_dict[sub_name].remove(user_id)
-            await ctx.send(f"Unsubscribed from {sub_name}")
+            await outbound.send(ctx, f"Unsubscribed from {sub_name}")
+
+    """
+    Exports the server's subscriptions as a file with a row per subscriber, in CSV or JSON lines, that importsubs can
+    read back.
+    """
+
+    @commands.command(
+        aliases=["expsub"],
+        brief="Export subscriptions to a file",
+        description="Export this server's subscriptions as CSV or JSON lines",
+        usage=f"[{'|'.join(TRANSFER_FORMATS)}]",
+    )
+    @commands.guild_only()
+    async def exportsubs(self, ctx, fmt="csv"):
+        if not await self._validate_user(ctx):
+            return
+        if fmt not in TRANSFER_FORMATS:
+            await outbound.send(ctx, f"The format must be one of {', '.join(TRANSFER_FORMATS)}")
+            return
+        subs = self.store.subscriptions(ctx.guild.id)
+        data = await asyncio.get_running_loop().run_in_executor(None, write_subscriptions, subs, fmt)
+        file = discord.File(io.BytesIO(data), filename=f"subscriptions-{ctx.guild.id}.{fmt}")
+        await outbound.send(ctx, f"Exported {len(subs)} subscriptions.", file=file)
+
+    """
+    Imports subscriptions from an attached file in the format exportsubs writes, creating the subscriptions that
+    don't exist yet. The file is parsed off the event loop and applied in one transaction.
+    """
+
+    @commands.command(
+        aliases=["impsub"],
+        brief="Import subscriptions from a file",
+        description="Import subscriptions from an attached CSV or JSON lines file, as written by exportsubs",
+        usage="(with a file attached)",
+    )
+    @commands.guild_only()
+    async def importsubs(self, ctx):
+        if not await self._validate_user(ctx):
+            return
+        attachment = ctx.message.attachments[0] if ctx.message.attachments else None
+        fmt = os.path.splitext(attachment.filename)[1][1:].lower() if attachment is not None else None
+        if fmt not in TRANSFER_FORMATS:
+            extensions = " or ".join(f".{fmt}" for fmt in TRANSFER_FORMATS)
+            await outbound.send(ctx, f"Attach a {extensions} file like the ones `{PREFIX}exportsubs` makes.")
+            return
 
-        self._write_sub_data(json_file)
+        start = time.perf_counter()
+        data = await attachment.read()
+        subs, skipped = await asyncio.get_running_loop().run_in_executor(
+            None, read_subscriptions, io.BytesIO(data), fmt
+        )
+        # Same rule as makesub
+        for sub_name in [sub_name for sub_name in subs if len(sub_name) <= MIN_MATCH]:
+            skipped += len(subs.pop(sub_name)) or 1
+        created, added = await self.store.import_subscriptions(ctx.guild.id, subs)
+        # Rebuilt from the store on next use
+        self._sub_indexes.pop(ctx.guild.id, None)
+        log.info(
+            "Imported %d subscriptions into %d subs (%d new) for guild %s in %.3fs",
+            added, len(subs), created, ctx.guild.id, time.perf_counter() - start,
+        )
+
+        message = f"Imported {added} subscriptions into {len(subs)} subs, {created} of them new."
+        if skipped:
+            message += f" Skipped {skipped} invalid rows."
+        await outbound.send(ctx, message)
+
+    """
+    Shows or sets how atsub reaches a subscription's subscribers: "channel" mentions them in the channel, "dm" sends
+    each of them a DM linking to the atsub message instead.
+    """
+
+    @commands.command(
+        brief="Show or set how a sub is delivered",
+        description="Show or set whether atsub mentions a sub's subscribers in the channel or DMs them",
+        usage=f"SUBSCRIPTION [{'|'.join(DELIVERY_MODES)}]",
+    )
+    @commands.guild_only()
+    async def submode(self, ctx, sub_name, mode=None):
+        if not self._sub_exists(ctx.guild.id, sub_name, match_exact=True):
+            await outbound.send(
+                ctx,
+                f"{sub_name} doesn't exist. Note this command is case sensitive!"
+            )
+            return
+        if mode is None:
+            await outbound.send(ctx, f"{sub_name} is delivered by {self.store.sub_mode(ctx.guild.id, sub_name)}.")
+            return
+        if not await self._validate_user(ctx):
+            return
+        if mode not in DELIVERY_MODES:
+            await outbound.send(ctx, f"The mode must be one of {', '.join(DELIVERY_MODES)}")
+            return
+        self.store.set_sub_mode(ctx.guild.id, sub_name, mode)
+        await outbound.send(ctx, f"{sub_name} is now delivered by {mode}.")
 
     """
     General command to list subscriptions. Formatting is as follows:
@@ -288,45 +520,40 @@ class Subscription(commands.Cog):
     )
     @commands.guild_only()
     async def listsubs(self, ctx, *args):
-        json_file = self._load_sub_data()
-        server_id = str(ctx.guild.id)
-        if server_id not in json_file:
-            await ctx.send("There are no subscriptions for this server.")
+        if not self.store.has_guild(ctx.guild.id):
+            await outbound.send(ctx, "There are no subscriptions for this server.")
             return
 
-        sub_dict = json_file[server_id]
         message = ""
         if "subscribers" in args:
             index = args.index("subscribers")
             sub_name = args[index + 1]
-            if not self._sub_exists(server_id, sub_name, match_exact=True):
-                await ctx.send(
+            if not self._sub_exists(ctx.guild.id, sub_name, match_exact=True):
+                await outbound.send(
+                    ctx,
                     f"Subscription '{sub_name}' does not exist. Note this command is case sensitive!"
                 )
                 return
 
-            user_ids = sub_dict[sub_name]
-            users = [await ctx.guild.fetch_member(i) for i in user_ids]
+            users = await self._resolve_subscribers(ctx.guild, sub_name)
             message = f"{sub_name} members:\n"
             for user in users:
                 message += f"    - {user.name}\n"
 
         if "me" in args:
             message += f"{ctx.author.name}, you are in:\n"
-            num_subs = 0
-            for sub in sub_dict:
-                if str(ctx.author.id) in sub_dict[sub]:
-                    message += f"    - {sub}\n"
-                    num_subs += 1
-            if num_subs == 0:
+            my_subs = self.store.subs_of(ctx.guild.id, ctx.author.id)
+            for sub in my_subs:
+                message += f"    - {sub}\n"
+            if len(my_subs) == 0:
                 message += f"No subs!\nCall `{PREFIX}sub sub_name` to subscribe.\n"
 
         if "all" in args or len(args) == 0:
             message += f"All {ctx.guild.name} subscriptions:\n"
-            for sub_name in sub_dict.keys():
+            for sub_name in self.store.sub_names(ctx.guild.id):
                 message += f"    - {sub_name}\n"
 
-        await ctx.send(message)
+        await outbound.send(ctx, message)
 
     @commands.command(
         brief="@'s users of a sub",
@@ -337,105 +564,141 @@ class Subscription(commands.Cog):
     @commands.guild_only()
     async def atsub(self, ctx, sub_name):
         async with ctx.typing():
-            sub_data = self._load_sub_data()
-            server_id = str(ctx.guild.id)
-
-            if not self._sub_exists(server_id, sub_name, match_exact=False):
-                await ctx.send(
+            matched_server_subs = self._match_sub(ctx.guild.id, sub_name)
+            if matched_server_subs is None:
+                await outbound.send(
+                    ctx,
                     f"{sub_name} doesn't exist, call `{PREFIX}mksub {sub_name}`"
                 )
                 return
 
-            server_subs = sub_data.get(server_id)
-            matched_server_subs = self._match_sub(server_subs, sub_name)
-
-            # Multiple matches? We already guaranteed at least 1 match in the _sub_exists call
+            # Multiple matches?
             if len(matched_server_subs) > 1:
                 message_text = (
                     "There were multiple subscriptions that matched your query:\n"
                 )
-                for sub in matched_server_subs.keys():
+                for sub in matched_server_subs:
                     message_text += f"    - {sub}\n"
                 message_text += f"Try sending a more specific query"
-                await ctx.send(message_text)
+                await outbound.send(ctx, message_text)
                 return
 
-            matched_sub_name = list(matched_server_subs.keys())[0]
-            user_ids = matched_server_subs[matched_sub_name]
+            matched_sub_name = matched_server_subs[0]
+            users = await self._resolve_subscribers(ctx.guild, matched_sub_name)
 
-            if not user_ids:
-                await ctx.send(
+            if not users:
+                await outbound.send(
+                    ctx,
                     f"There are no users in {matched_sub_name}, you can sub to it with "
                     f"`{PREFIX}sub {matched_sub_name}`!"
                 )
                 return
 
-            users = [await ctx.guild.fetch_member(user_id) for user_id in user_ids]
-            embed = discord.Embed(
-                title=f"**Calling all {matched_sub_name} members!**",
-                description=f"If you don't want to be mentioned in this, call `{PREFIX}unsub "
-                f"{matched_sub_name}`. \nNote that unsub is case sensitive!",
-                color=0xFFFF00,
-            )
-            embed.set_author(
-                name=ctx.author.display_name, icon_url=ctx.author.avatar_url
-            )
-            embed.add_field(name=ATTENDING_STRING, value=ctx.author.display_name)
-            message_text = "||"
-            for user in users:
-                message_text += f"{user.mention}"
-            message_text += "||"
-            message = await ctx.send(message_text, embed=embed)
-            await message.add_reaction("✅")
-            await message.add_reaction("❌")
+            call = AtsubCall(0, ctx.guild.id, ctx.channel.id, matched_sub_name, ctx.author.id)
+            if self.store.sub_mode(ctx.guild.id, matched_sub_name) == "dm":
+                await self._deliver_dms(ctx, users, call)
+            else:
+                await self._deliver_mentions(ctx, users, call)
+
+    async def _deliver_mentions(self, ctx, users: List[discord.Member], call: AtsubCall):
+        """
+        Sends the mentions for an atsub split into messages that fit Discord's limit. Only the first carries the embed
+        and the attendance reactions; the reactions and the remaining chunks go out concurrently since they use
+        different rate limit buckets, while the chunks themselves are sent in order on the channel's bucket. The
+        reactions are cosmetic, so other commands' replies go ahead of them.
+        The call starts being tracked as soon as the first message exists.
+        """
+        start = time.perf_counter()
+        chunks = chunk_mentions([user.mention for user in users])
+        message = await outbound.send(ctx, chunks[0], embed=render_atsub_embed(ctx.guild, call))
+        call.message_id = message.id
+        self.store.record_call(call)
+
+        async def add_reactions():
+            await outbound.add_reaction(message, "✅", Priority.COSMETIC)
+            await outbound.add_reaction(message, "❌", Priority.COSMETIC)
+
+        async def send_rest():
+            for chunk in chunks[1:]:
+                await outbound.send(ctx, chunk)
+
+        await asyncio.gather(add_reactions(), send_rest())
+        log.info(
+            "atsub fan-out to %d subscribers in %d messages took %.3fs",
+            len(users), len(chunks), time.perf_counter() - start,
+        )
+
+    async def _deliver_dms(self, ctx, users: List[discord.Member], call: AtsubCall):
+        """
+        Posts the atsub message, with the attendance embed and reactions as usual, then DMs every subscriber but the
+        caller a link to it. The DMs go out in the background; the message's content shows their progress and ends
+        with a summary.
+        """
+        users = [user for user in users if user.id != ctx.author.id]
+        message = await outbound.send(
+            ctx, f"Sending DMs to {len(users)} subscribers...", embed=render_atsub_embed(ctx.guild, call)
+        )
+        call.message_id = message.id
+        self.store.record_call(call)
+
+        content = (
+            f"**{ctx.author.display_name}** is calling all {call.sub_name} members in {ctx.guild.name}: "
+            f"{message.jump_url}"
+        )
+
+        async def report(progress: FanoutProgress):
+            await outbound.edit(message, content=f"{progress.describe()}...")
+
+        async def fan_out():
+            progress = await DmFanout(users, content, on_progress=report).run()
+            try:
+                await outbound.edit(message, content=f"{progress.describe()} in {progress.elapsed:.1f}s.")
+            except discord.HTTPException as e:
+                log.warning("Couldn't post the DM fan-out summary: %s", e)
+
+        fanout = asyncio.get_running_loop().create_task(fan_out())
+        self._fanouts.add(fanout)
+        fanout.add_done_callback(self._fanouts.discard)
+        await outbound.add_reaction(message, "✅", Priority.COSMETIC)
+        await outbound.add_reaction(message, "❌", Priority.COSMETIC)
 
     """
-    Given a dictionary of sub names to lists of users, match parameter sub_name and return the entries in the
-    dictionary that match or None if none was found
+    Given a guild id, match parameter sub_search against the guild's subscriptions and return the names that match or
+    None if none was found. See PrefixIndex for the matching rules.
     """
 
-    def _match_sub(self, subs, sub_search):
-        matched = {}
-        sub_search = sub_search.lower()
-        for sub, users in subs.items():
-            sub_lower = sub.lower()
-            match_length = max(MIN_MATCH, len(sub_search))
-            if sub_lower[:match_length] == sub_search:
-                matched[sub] = users
-                if sub_lower == sub_search:
-                    return matched
-        if len(matched) == 0:
-            return None
-        return matched
+    def _match_sub(self, server_id, sub_search):
+        return self._sub_index(server_id).match(sub_search)
+
+    def _sub_index(self, server_id) -> PrefixIndex:
+        index = self._sub_indexes.get(server_id)
+        if index is None:
+            index = PrefixIndex(self.store.sub_names(server_id), min_match=MIN_MATCH)
+            self._sub_indexes[server_id] = index
+        return index
+
+    async def _resolve_subscribers(self, guild, sub_name) -> List[discord.Member]:
+        """
+        Returns the members subscribed to sub_name, unsubscribing anyone who has left the guild.
+        """
+        user_ids = self.store.subscribers(guild.id, sub_name)
+        if not user_ids:
+            return []
+        users, gone = await self.members.resolve(guild, user_ids)
+        for user_id in gone:
+            self.store.remove_subscriber(guild.id, sub_name, user_id)
+        return users
 
     def _initialize_sub_data(self):
-        json_file = self._load_sub_data()
         for server in self.client.guilds:
-            server_id = str(server.id)
-            if server_id not in json_file:
-                json_file[server_id] = {}
-
-        self._write_sub_data(json_file)
-
-    def _load_sub_data(self):
-        file = open("./cogs/subscription/subscriptions.json", mode="r")
-        json_file = json.load(file)
-        file.close()
-        return json_file
-
-    def _write_sub_data(self, json_file):
-        file = open("./cogs/subscription/subscriptions.json", mode="w")
-        json.dump(json_file, file, indent=4)
-        file.close()
+            self.store.ensure_guild(server.id)
 
     def _sub_exists(self, server_id, sub_name, match_exact=True):
-        json_file = self._load_sub_data()
-        server_id = str(server_id)
         if match_exact:
-            return server_id in json_file and sub_name in json_file[server_id]
+            return self.store.sub_exists(server_id, sub_name)
         return (
-            server_id in json_file
-            and self._match_sub(json_file[server_id], sub_name) is not None
+            self.store.has_guild(server_id)
+            and self._match_sub(server_id, sub_name) is not None
         )
 
 
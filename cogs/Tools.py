@@ -5,6 +5,7 @@ from discord.ext import commands, tasks
 from discord.utils import get
 
 import config
+from Outbound import outbound
 from config import PREFIX
 
 
@@ -12,16 +13,25 @@ class Tools(commands.Cog):
     def __init__(self, client):
         self.client = client
         self.description = "Collection of utilities"
+        # Loaded after the bot is ready means reloaded, and on_ready won't fire to start the loop
+        if client.is_ready():
+            self.random_status.start()
+
+    def cog_unload(self):
+        # Otherwise the loop keeps running on the unloaded instance, next to the one a reload starts
+        self.random_status.cancel()
 
     @commands.Cog.listener()
     async def on_ready(self):
-        self.random_status.start()
+        # on_ready fires again after every reconnect, but the loop only needs starting once
+        if not self.random_status.is_running():
+            self.random_status.start()
         print('Tools activated.')
 
     @commands.command(brief="Ping Banana",
                       description="Ping Banana")
     async def ping(self, ctx):
-        await ctx.send(f'Pong! {round(self.client.latency * 1000)}')
+        await outbound.send(ctx, f'Pong! {round(self.client.latency * 1000)}')
 
     @commands.command(aliases=['mc', 'conch'],
                       brief="Ask a yes or no question to the magic conch",
@@ -29,12 +39,12 @@ class Tools(commands.Cog):
                       usage=",,mc QUESTION")
     async def magic_conch(self, ctx, *, question):
         responses = config.responses
-        await ctx.send(random.choice(responses))
+        await outbound.send(ctx, random.choice(responses))
 
     @magic_conch.error
     async def magic_conch_error(self, ctx, error):
         if isinstance(error, commands.MissingRequiredArgument):
-            await ctx.send('Usage: ",,mc <yes/no question>"')
+            await outbound.send(ctx, 'Usage: ",,mc <yes/no question>"')
 
     @commands.command(brief="Clear recent message",
                       description="Clear recent messages",
@@ -49,19 +59,19 @@ class Tools(commands.Cog):
     async def banana(self, ctx):
         banana = discord.Embed()
         banana.set_image(url='http://weknowyourdreams.com/images/banana/banana-02.jpg')
-        await ctx.send(embed=banana)
+        await outbound.send(ctx, embed=banana)
 
     @commands.command(aliases=['dice'],
                       brief="Roll a dice",
                       description="Roll a dice",
                       usage=f"{PREFIX}roll NUM")
     async def roll(self, ctx, lower=1, upper=6):
-        await ctx.send(random.randint(int(lower), int(upper)))
+        await outbound.send(ctx, random.randint(int(lower), int(upper)))
 
     @tasks.loop(seconds=20)
     async def random_status(self):
         status = f'{next(config.bot_statuses)} | {PREFIX}help'
-        await self.client.change_presence(activity=discord.Game(status))
+        await outbound.change_presence(self.client, activity=discord.Game(status))
 
 
 def setup(client):
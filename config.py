@@ -2,9 +2,39 @@ from itertools import cycle
 
 PREFIX = "~"
 
+# The user allowed to run owner commands like reload and stats
+OWNER_ID = 166989171456606208
+
+# Sharding for a single process: None runs one unsharded bot, 0 lets Discord choose the number of shards and any other
+# number is used as is. launcher.py overrides this to run shards across several processes, which requires
+# SUB_BACKEND = "sqlite" so they can share subscriptions
+SHARD_COUNT = None
+
+# Cogs imported on first use of one of their commands rather than at startup. Cogs with listeners that must run from
+# the start (Subscriptions' reaction tracking, Tools' status loop) have to stay eager
+LAZY_COGS = ["Soundboard"]
+
+# Where the Prometheus metrics endpoint listens; set METRICS_PORT to None to turn it off
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
 # The minimum number of characters to match a subscription
 MIN_MATCH = 3
 
+# Where subscriptions are stored: "json" keeps everything in memory backed by subscriptions.json and a journal,
+# "sqlite" uses an indexed database (imported from subscriptions.json the first time it is opened)
+SUB_BACKEND = "json"
+SUB_DB_PATH = "./cogs/subscription/subscriptions.db"
+
+# The most sounds that can be waiting to play in a guild
+SOUND_QUEUE_SIZE = 10
+# The most sounds that play over each other in a guild before new ones have to queue
+SOUND_MAX_OVERLAP = 8
+# Loudness every sound is normalized to, in LUFS
+SOUND_TARGET_LUFS = -18.0
+# Seconds Banana stays in a voice channel after the last sound finishes
+VOICE_IDLE_TIMEOUT = 300
+
 bot_statuses = cycle([
         'A healthy source of vitamin C.',
         'Remember to eat your daily banana!',
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Runs Banana as several processes, each an AutoShardedBot owning a contiguous range of the shards, so guilds are
+spread over as many cores as there are processes. Workers that die are restarted with a growing delay, and stopping
+the launcher stops them all.
+
+    python launcher.py --processes 4 --shards 16
+
+The workers share subscriptions through the SQLite store, so config.SUB_BACKEND has to be "sqlite". Each worker
+serves its metrics on config.METRICS_PORT plus its index.
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import *
+
+import config
+
+log = logging.getLogger('launcher')
+
+# Discord lets a bot identify one shard per this many seconds, so workers are started that far apart per shard
+IDENTIFY_INTERVAL = 5
+# A worker that dies is restarted after 1, 2, 4... seconds, up to this many
+MAX_RESTART_DELAY = 60
+# A worker that stays up this long has its restart delay reset
+STABLE_SECONDS = 300
+
+
+def shard_ranges(shards: int, processes: int) -> List[List[int]]:
+    """
+    Splits shards 0..shards-1 into processes contiguous ranges whose sizes differ by at most one.
+    """
+    return [list(range(i * shards // processes, (i + 1) * shards // processes)) for i in range(processes)]
+
+
+class Worker:
+    def __init__(self, index: int, workers: int, shard_ids: List[int], shard_count: int):
+        self.index = index
+        self.env = dict(
+            os.environ,
+            BANANABOT_WORKER=str(index),
+            BANANABOT_WORKERS=str(workers),
+            BANANABOT_SHARD_IDS=','.join(map(str, shard_ids)),
+            BANANABOT_SHARD_COUNT=str(shard_count),
+        )
+        self.shard_ids = shard_ids
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.restart_delay = 1
+        self.restart_at: Optional[float] = None
+
+    def start(self):
+        log.info('Starting worker %d with shards %s', self.index, self.env['BANANABOT_SHARD_IDS'])
+        self.process = subprocess.Popen([sys.executable, 'bot.py'], env=self.env)
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    def check(self):
+        """
+        Notices a worker that exited and schedules its restart.
+        """
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if time.monotonic() - self.started > STABLE_SECONDS:
+            self.restart_delay = 1
+        log.warning('Worker %d exited with %d, restarting in %ds', self.index, code, self.restart_delay)
+        self.restart_at = time.monotonic() + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shards', type=int, help='total shards, one per process by default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.processes > 1 and config.SUB_BACKEND != 'sqlite':
+        sys.exit('Running in several processes needs SUB_BACKEND = "sqlite" in config.py')
+    shards = args.shards or args.processes
+    if shards < args.processes:
+        sys.exit('There must be at least one shard per process')
+
+    workers = [Worker(i, args.processes, shard_ids, shards)
+               for i, shard_ids in enumerate(shard_ranges(shards, args.processes))]
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    for worker in workers:
+        worker.start()
+        # Staggered so the workers don't all try to identify at once
+        if stopping.wait(IDENTIFY_INTERVAL * len(worker.shard_ids)):
+            break
+
+    while not stopping.wait(1):
+        for worker in workers:
+            if worker.process is not None:
+                worker.check()
+
+    log.info('Stopping workers')
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        if worker.process is not None:
+            worker.process.wait()
+
+
+if __name__ == '__main__':
+    main()
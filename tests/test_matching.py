@@ -0,0 +1,173 @@
+"""
+Name matching for subscriptions and sounds: PrefixIndex, TrigramIndex, SoundLibrary.resolve and the per-guild
+indexes the Subscription cog keeps up to date.
+
+Run from the repository root: python -m pytest tests (or python -m unittest discover tests)
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from SoundLibrary import SoundLibrary
+from SubscriptionStore import SNAPSHOT_FORMAT, JsonSubscriptionStore
+from Utilities import PrefixIndex, TrigramIndex
+from cogs.Subscriptions import Subscription
+
+GUILD_ID = 123456789012345678
+USER_ID = 301234567890123456
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex(["raid", "raids", "Movies", "movienight", "dnd"], min_match=3)
+
+    def test_exact_match_wins_over_prefixes(self):
+        self.assertEqual(self.index.match("raid"), ["raid"])
+
+    def test_unique_prefix(self):
+        self.assertEqual(self.index.match("movien"), ["movienight"])
+
+    def test_ambiguous_prefix(self):
+        self.assertEqual(self.index.match("rai"), ["raid", "raids"])
+        self.assertEqual(self.index.match("MOV"), ["movienight", "Movies"])
+
+    def test_short_query_only_matches_exactly(self):
+        self.assertEqual(self.index.match("dnd"), ["dnd"])
+        self.assertIsNone(self.index.match("dn"))
+        self.assertIsNone(self.index.match("nothing"))
+
+    def test_changes_drop_cached_results(self):
+        self.assertEqual(self.index.match("movien"), ["movienight"])
+        self.index.add("movienights")
+        self.assertEqual(self.index.match("movien"), ["movienight", "movienights"])
+        self.index.remove("movienight")
+        self.index.remove("movienight")
+        self.assertEqual(self.index.match("movien"), ["movienights"])
+
+
+class TrigramIndexTest(unittest.TestCase):
+
+    def test_misspellings_rank_the_closest_name_first(self):
+        index = TrigramIndex(["airhorn", "airplane", "trombone"])
+        matches = index.search("airhron")
+        self.assertEqual(matches[0][0], "airhorn")
+        self.assertNotIn("trombone", [name for name, _ in matches])
+
+    def test_removed_names_are_not_found(self):
+        index = TrigramIndex(["airhorn"])
+        index.remove("airhorn")
+        self.assertEqual(index.search("airhorn"), [])
+        self.assertEqual(len(index), 0)
+
+
+class SoundLibraryResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="bananabot-test-")
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        for path in ("airhorn.mp3", "memes/bruh.mp3", "memes/bruhmoment.mp3", "sad/trombone.mp3"):
+            self.add_sound(path)
+        self.library = SoundLibrary(self.root)
+        self.library.build()
+
+    def add_sound(self, path: str):
+        os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+        open(os.path.join(self.root, path), mode="wb").close()
+
+    def test_exact(self):
+        self.assertEqual(self.library.resolve("memes/bruh"), ("memes/bruh", []))
+        # A name alone, even though it's also a prefix of another sound's
+        self.assertEqual(self.library.resolve("bruh"), ("memes/bruh", []))
+
+    def test_unique_prefix(self):
+        self.assertEqual(self.library.resolve("trom"), ("sad/trombone", []))
+
+    def test_ambiguous_prefix(self):
+        self.assertEqual(self.library.resolve("bru"), (None, ["memes/bruh", "memes/bruhmoment"]))
+
+    def test_fuzzy_fallback(self):
+        self.assertEqual(self.library.resolve("airhron"), ("airhorn", []))
+        self.assertEqual(self.library.resolve("zzzzzz"), (None, []))
+        # Too short to be a prefix, so too short to guess at
+        self.assertEqual(self.library.resolve("ai"), (None, []))
+
+    def test_refresh_updates_the_indexes(self):
+        self.add_sound("memes/sadtrombone.mp3")
+        os.remove(os.path.join(self.root, "sad/trombone.mp3"))
+        self.assertTrue(self.library.refresh())
+        self.assertEqual(self.library.resolve("sadt"), ("memes/sadtrombone", []))
+        self.assertEqual(self.library.resolve("trom"), (None, []))
+
+
+class SubIndexTest(unittest.IsolatedAsyncioTestCase):
+    """
+    makesub, removesub and importsubs have to keep the index _match_sub searches in step with the store.
+    """
+
+    async def asyncSetUp(self):
+        workspace = tempfile.mkdtemp(prefix="bananabot-test-")
+        self.addCleanup(shutil.rmtree, workspace, ignore_errors=True)
+        path = os.path.join(workspace, "subscriptions.json")
+        with open(path, mode="w") as file:
+            json.dump({"format": SNAPSHOT_FORMAT, "modes": {}, "guilds": {}}, file)
+        store = JsonSubscriptionStore(path)
+        store.load()
+
+        outbound = mock.patch("cogs.Subscriptions.outbound", new=mock.AsyncMock())
+        self.outbound = outbound.start()
+        self.addCleanup(outbound.stop)
+        with mock.patch("cogs.Subscriptions.open_subscription_store", return_value=store):
+            self.cog = Subscription(SimpleNamespace(loop=asyncio.get_running_loop(), guilds=[]))
+            await self.cog.store_ready.wait()
+        self.addCleanup(self.cog.cog_unload)
+
+        author = SimpleNamespace(roles=[], guild_permissions=SimpleNamespace(administrator=True))
+        self.ctx = SimpleNamespace(guild=SimpleNamespace(id=GUILD_ID), message=SimpleNamespace(author=author))
+
+    async def call(self, command, *args):
+        # The commands are called straight, past the checks and argument conversion
+        await command.callback(self.cog, *args)
+
+    async def test_makesub_and_removesub(self):
+        await self.call(self.cog.makesub, self.ctx, "movies")
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "mov"), ["movies"])
+        await self.call(self.cog.makesub, self.ctx, "movienight")
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "mov"), ["movienight", "movies"])
+
+        await self.call(self.cog.removesub, self.ctx, "movies")
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "mov"), ["movienight"])
+        self.assertFalse(self.cog.store.sub_exists(GUILD_ID, "movies"))
+
+    async def test_makesub_refuses_a_name_that_already_matches(self):
+        await self.call(self.cog.makesub, self.ctx, "movies")
+        await self.call(self.cog.makesub, self.ctx, "Movies")
+        self.assertEqual(self.cog.store.sub_names(GUILD_ID), ["movies"])
+
+    async def test_makesub_needs_permission(self):
+        self.ctx.message.author.guild_permissions.administrator = False
+        await self.call(self.cog.makesub, self.ctx, "movies")
+        self.assertIsNone(self.cog._match_sub(GUILD_ID, "movies"))
+        self.assertFalse(self.cog.store.sub_exists(GUILD_ID, "movies"))
+
+    async def test_importsubs(self):
+        await self.call(self.cog.makesub, self.ctx, "movies")
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "mov"), ["movies"])
+
+        data = f"sub,user_id\nmovienight,{USER_ID}\nraid,\n".encode()
+        attachment = SimpleNamespace(filename="subs.csv", read=mock.AsyncMock(return_value=data))
+        self.ctx.message.attachments = [attachment]
+        await self.call(self.cog.importsubs, self.ctx)
+
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "mov"), ["movienight", "movies"])
+        self.assertEqual(self.cog._match_sub(GUILD_ID, "rai"), ["raid"])
+        self.assertEqual(self.cog.store.subscribers(GUILD_ID, "movienight"), [USER_ID])
+
+
+if __name__ == "__main__":
+    unittest.main()
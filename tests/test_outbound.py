@@ -0,0 +1,38 @@
+"""
+Coalescing of queued requests in OutboundDispatcher.
+
+Run from the repository root: python -m pytest tests (or python -m unittest discover tests)
+"""
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from Outbound import OutboundDispatcher
+
+
+class CoalescingTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.dispatcher = OutboundDispatcher()
+        self.client = SimpleNamespace(change_presence=mock.AsyncMock())
+
+    async def test_presence_changes_of_the_same_fields_replace_each_other(self):
+        await asyncio.gather(
+            self.dispatcher.change_presence(self.client, activity="one"),
+            self.dispatcher.change_presence(self.client, activity="two"),
+        )
+        self.assertEqual(self.client.change_presence.await_args_list, [mock.call(activity="two")])
+
+    async def test_presence_changes_of_different_fields_both_run(self):
+        await asyncio.gather(
+            self.dispatcher.change_presence(self.client, status="idle"),
+            self.dispatcher.change_presence(self.client, activity="game"),
+        )
+        self.assertEqual(
+            self.client.change_presence.await_args_list, [mock.call(status="idle"), mock.call(activity="game")]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
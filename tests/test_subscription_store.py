@@ -0,0 +1,323 @@
+"""
+Behaviour of JsonSubscriptionStore's snapshot and journal across crashes and format changes, and of
+SqliteSubscriptionStore.
+
+Run from the repository root: python -m pytest tests (or python -m unittest discover tests)
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from typing import *
+
+from SubscriptionStore import SNAPSHOT_FORMAT, AtsubCall, JsonSubscriptionStore, SqliteSubscriptionStore
+
+GUILD_ID = 123456789012345678
+OTHER_GUILD_ID = 223456789012345678
+USER_IDS = [301234567890123456, 101234567890123456, 201234567890123456]
+CHANNEL_ID = 423456789012345678
+MESSAGE_ID = 523456789012345678
+
+
+class Crash(Exception):
+    """
+    Stands in for the process dying at the point it's raised.
+    """
+
+
+class JsonSubscriptionStoreTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix="bananabot-test-")
+        self.path = os.path.join(self.workspace, "subscriptions.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+    def write_snapshot(self, snapshot):
+        with open(self.path, mode="w") as file:
+            json.dump(snapshot, file)
+
+    def open_store(self, **kwargs) -> JsonSubscriptionStore:
+        store = JsonSubscriptionStore(self.path, **kwargs)
+        store.load()
+        return store
+
+    def populate(self, store: JsonSubscriptionStore):
+        store.ensure_guild(GUILD_ID)
+        store.create_sub(GUILD_ID, "raid")
+        store.create_sub(GUILD_ID, "movies")
+        for user_id in USER_IDS:
+            store.add_subscriber(GUILD_ID, "raid", user_id)
+        store.remove_subscriber(GUILD_ID, "raid", USER_IDS[1])
+        store.add_subscriber(GUILD_ID, "movies", USER_IDS[1])
+        store.set_sub_mode(GUILD_ID, "movies", "dm")
+        store.create_sub(GUILD_ID, "gone")
+        store.delete_sub(GUILD_ID, "gone")
+
+    def assert_populated(self, store: JsonSubscriptionStore):
+        self.assertEqual(store.sub_names(GUILD_ID), ["raid", "movies"])
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted([USER_IDS[0], USER_IDS[2]]))
+        self.assertEqual(store.subscribers(GUILD_ID, "movies"), [USER_IDS[1]])
+        self.assertEqual(store.sub_mode(GUILD_ID, "movies"), "dm")
+        self.assertEqual(store.sub_mode(GUILD_ID, "raid"), "channel")
+        self.assertEqual(store.subs_of(GUILD_ID, USER_IDS[1]), ["movies"])
+
+    def test_replay_drops_a_torn_append(self):
+        self.write_snapshot({"format": SNAPSHOT_FORMAT, "modes": {}, "guilds": {}})
+        store = self.open_store()
+        self.populate(store)
+        store.close()
+        journal_path = store.journal_path
+        good_bytes = os.path.getsize(journal_path)
+        # A crash part way through appending the next entry
+        with open(journal_path, mode="ab") as journal:
+            journal.write(b'{"op": "add", "guild": 1234, "sub": "ra')
+
+        store = self.open_store()
+        self.assert_populated(store)
+        self.assertEqual(os.path.getsize(journal_path), good_bytes)
+
+        # Entries appended after the truncation replay cleanly
+        store.add_subscriber(GUILD_ID, "raid", USER_IDS[1])
+        store.close()
+        store = self.open_store()
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+
+    async def test_crash_between_snapshot_rename_and_journal_truncate(self):
+        # Already subscribed, so only the removal is journaled and replaying it has to find the user gone
+        self.write_snapshot({
+            "format": SNAPSHOT_FORMAT,
+            "modes": {},
+            "guilds": {str(GUILD_ID): {"raid": [USER_IDS[1]]}},
+        })
+        store = self.open_store()
+        self.populate(store)
+        await store.flush()
+        # The next flush folds the whole journal into a snapshot
+        store.compact_bytes = 0
+        store.ensure_guild(OTHER_GUILD_ID)
+
+        replace = os.replace
+
+        def crash_after_snapshot(src, dst):
+            replace(src, dst)
+            if dst == self.path:
+                raise Crash
+
+        with mock.patch("os.replace", side_effect=crash_after_snapshot):
+            with self.assertRaises(Crash):
+                await store.flush()
+
+        with open(self.path) as file:
+            self.assertEqual(json.load(file)["format"], SNAPSHOT_FORMAT)
+        self.assertGreater(os.path.getsize(store.journal_path), 0)
+
+        # Every journal entry is already in the snapshot, so replaying them all again has to be harmless
+        store = self.open_store()
+        self.assert_populated(store)
+        self.assertTrue(store.has_guild(OTHER_GUILD_ID))
+        self.assertFalse(store.sub_exists(GUILD_ID, "gone"))
+
+    async def test_unversioned_snapshot_is_migrated(self):
+        # The original layout: guilds at the top level and every id a string, in a journal of the same era too
+        self.write_snapshot({str(GUILD_ID): {"raid": [str(USER_IDS[0]), str(USER_IDS[1])], "movies": []}})
+        with open(os.path.splitext(self.path)[0] + ".journal", mode="w") as journal:
+            journal.write(json.dumps({"op": "add", "guild": str(GUILD_ID), "sub": "raid", "user": str(USER_IDS[2])}))
+            journal.write("\n")
+
+        store = self.open_store(compact_bytes=0)
+        self.assertTrue(store.has_guild(GUILD_ID))
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+        self.assertEqual(store.sub_mode(GUILD_ID, "raid"), "channel")
+
+        # The next compaction writes the current format, with the ids as numbers
+        store.add_subscriber(GUILD_ID, "movies", USER_IDS[0])
+        await store.flush()
+        store.set_sub_mode(GUILD_ID, "movies", "dm")
+        await store.flush()
+        with open(self.path) as file:
+            snapshot = json.load(file)
+        self.assertEqual(snapshot["format"], SNAPSHOT_FORMAT)
+        self.assertEqual(snapshot["guilds"][str(GUILD_ID)]["raid"], sorted(USER_IDS))
+
+        store.close()
+        store = self.open_store()
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+        self.assertEqual(store.subscribers(GUILD_ID, "movies"), [USER_IDS[0]])
+        self.assertEqual(store.sub_mode(GUILD_ID, "movies"), "dm")
+
+    async def test_first_compaction_only_copies_changed_guilds(self):
+        self.write_snapshot({
+            "format": SNAPSHOT_FORMAT,
+            "modes": {},
+            "guilds": {str(GUILD_ID): {"raid": [USER_IDS[0]]}, str(OTHER_GUILD_ID): {"movies": [USER_IDS[1]]}},
+        })
+        store = self.open_store(compact_bytes=0)
+        store.add_subscriber(OTHER_GUILD_ID, "movies", USER_IDS[2])
+
+        snapshots = []
+        take_snapshot = store._take_snapshot
+
+        def record_snapshot():
+            snapshots.append(take_snapshot())
+            return snapshots[-1]
+
+        with mock.patch.object(store, "_take_snapshot", side_effect=record_snapshot):
+            await store.flush()
+        self.assertEqual([list(dirty) for _, dirty, _ in snapshots], [[OTHER_GUILD_ID]])
+
+        # The guilds encoded at load time are still written out
+        with open(self.path) as file:
+            guilds = json.load(file)["guilds"]
+        self.assertEqual(guilds, {
+            str(GUILD_ID): {"raid": [USER_IDS[0]]},
+            str(OTHER_GUILD_ID): {"movies": sorted(USER_IDS[1:])},
+        })
+
+
+class SqliteSubscriptionStoreTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp(prefix="bananabot-test-")
+        # Registered first so it runs last, after the stores opened by the test are closed
+        self.addCleanup(shutil.rmtree, self.workspace, ignore_errors=True)
+        self.path = os.path.join(self.workspace, "subscriptions.db")
+
+    def open_store(self, import_path=None) -> SqliteSubscriptionStore:
+        store = SqliteSubscriptionStore(self.path, import_path)
+        store.load()
+        self.addCleanup(store.close)
+        return store
+
+    def state(self, store) -> Dict:
+        guilds = {
+            guild_id: {sub_name: (store.subscribers(guild_id, sub_name), store.sub_mode(guild_id, sub_name))
+                       for sub_name in store.sub_names(guild_id)}
+            for guild_id in (GUILD_ID, OTHER_GUILD_ID) if store.has_guild(guild_id)
+        }
+        subs_of = {user_id: store.subs_of(GUILD_ID, user_id) for user_id in USER_IDS}
+        call = store.atsub_call(MESSAGE_ID)
+        return {"guilds": guilds, "subs_of": subs_of, "call": call and call.to_dict()}
+
+    def test_operations_match_json_store(self):
+        json_path = os.path.join(self.workspace, "subscriptions.json")
+        with open(json_path, mode="w") as file:
+            json.dump({"format": SNAPSHOT_FORMAT, "modes": {}, "guilds": {}}, file)
+        json_store = JsonSubscriptionStore(json_path)
+        json_store.load()
+        self.addCleanup(json_store.close)
+        sqlite_store = self.open_store()
+
+        operations = [
+            ("ensure_guild", GUILD_ID),
+            ("ensure_guild", GUILD_ID),
+            ("create_sub", GUILD_ID, "raid"),
+            ("create_sub", GUILD_ID, "raid"),
+            ("create_sub", GUILD_ID, "movies"),
+            ("create_sub", OTHER_GUILD_ID, "raid"),
+            ("add_subscriber", GUILD_ID, "raid", USER_IDS[0]),
+            ("add_subscriber", GUILD_ID, "raid", USER_IDS[0]),
+            ("add_subscriber", GUILD_ID, "nope", USER_IDS[0]),
+            ("add_subscribers", GUILD_ID, "movies", USER_IDS + USER_IDS),
+            ("add_subscribers", GUILD_ID, "movies", USER_IDS),
+            ("add_subscribers", GUILD_ID, "nope", USER_IDS),
+            ("remove_subscriber", GUILD_ID, "movies", USER_IDS[1]),
+            ("remove_subscriber", GUILD_ID, "movies", USER_IDS[1]),
+            ("remove_subscriber", GUILD_ID, "nope", USER_IDS[1]),
+            ("set_sub_mode", GUILD_ID, "movies", "dm"),
+            ("set_sub_mode", GUILD_ID, "movies", "dm"),
+            ("set_sub_mode", GUILD_ID, "raid", "channel"),
+            ("create_sub", GUILD_ID, "gone"),
+            ("add_subscriber", GUILD_ID, "gone", USER_IDS[2]),
+            ("delete_sub", GUILD_ID, "gone"),
+            ("delete_sub", GUILD_ID, "gone"),
+            ("record_call", AtsubCall(MESSAGE_ID, GUILD_ID, CHANNEL_ID, "raid", USER_IDS[0])),
+            ("set_attending", MESSAGE_ID, USER_IDS[1], True),
+            ("set_attending", MESSAGE_ID, USER_IDS[1], True),
+            ("set_attending", MESSAGE_ID, USER_IDS[0], False),
+            ("set_attending", MESSAGE_ID + 1, USER_IDS[0], True),
+        ]
+        for name, *args in operations:
+            with self.subTest(operation=name, args=args):
+                self.assertEqual(getattr(sqlite_store, name)(*args), getattr(json_store, name)(*args))
+        self.assertEqual(self.state(sqlite_store), self.state(json_store))
+        self.assertEqual(self.state(sqlite_store)["guilds"][GUILD_ID], {
+            "raid": ([USER_IDS[0]], "channel"),
+            "movies": (sorted([USER_IDS[0], USER_IDS[2]]), "dm"),
+        })
+        with self.assertRaises(ValueError):
+            sqlite_store.set_sub_mode(GUILD_ID, "raid", "carrier pigeon")
+
+    def test_json_store_is_imported_on_first_open(self):
+        json_path = os.path.join(self.workspace, "subscriptions.json")
+        with open(json_path, mode="w") as file:
+            json.dump({
+                "format": SNAPSHOT_FORMAT,
+                "modes": {str(GUILD_ID): {"movies": "dm"}},
+                "guilds": {str(GUILD_ID): {"raid": [USER_IDS[0]], "movies": [USER_IDS[1]]}},
+            }, file)
+        # Changes still only in the journal are imported too
+        with open(os.path.join(self.workspace, "subscriptions.journal"), mode="w") as journal:
+            journal.write(json.dumps({"op": "add", "guild": GUILD_ID, "sub": "raid", "user": USER_IDS[2]}) + "\n")
+        call = AtsubCall(MESSAGE_ID, GUILD_ID, CHANNEL_ID, "raid", USER_IDS[0])
+        with open(os.path.join(self.workspace, "attendance.json"), mode="w") as file:
+            json.dump({str(MESSAGE_ID): call.to_dict()}, file)
+
+        store = self.open_store(import_path=json_path)
+        self.assertEqual(store.sub_names(GUILD_ID), ["raid", "movies"])
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted([USER_IDS[0], USER_IDS[2]]))
+        self.assertEqual(store.sub_mode(GUILD_ID, "movies"), "dm")
+        self.assertEqual(store.subs_of(GUILD_ID, USER_IDS[1]), ["movies"])
+        self.assertEqual(store.atsub_call(MESSAGE_ID).attending, {USER_IDS[0]})
+        store.remove_subscriber(GUILD_ID, "raid", USER_IDS[0])
+        store.close()
+
+        # Only an empty database imports, so the JSON store doesn't overwrite later changes
+        store = self.open_store(import_path=json_path)
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), [USER_IDS[2]])
+
+    def test_reopen_keeps_data_in_wal_mode(self):
+        store = self.open_store()
+        store.create_sub(GUILD_ID, "raid")
+        store.add_subscribers(GUILD_ID, "raid", USER_IDS)
+        store.set_sub_mode(GUILD_ID, "raid", "dm")
+        self.assertEqual(store._db.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+
+        # A second store sees the writes while they're still only in the write-ahead log
+        self.assertTrue(os.path.exists(self.path + "-wal"))
+        other = self.open_store()
+        self.assertEqual(other.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+        other.close()
+
+        store.close()
+        store = self.open_store()
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+        self.assertEqual(store.sub_mode(GUILD_ID, "raid"), "dm")
+
+    async def test_import(self):
+        store = self.open_store()
+        store.ensure_guild(GUILD_ID)
+        store.create_sub(GUILD_ID, "raid")
+        store.add_subscriber(GUILD_ID, "raid", USER_IDS[0])
+
+        created, added = await store.import_subscriptions(GUILD_ID, {"raid": set(USER_IDS), "movies": set()})
+        self.assertEqual((created, added), (1, 2))
+        self.assertEqual(store.subscribers(GUILD_ID, "raid"), sorted(USER_IDS))
+        self.assertEqual(store.sub_names(GUILD_ID), ["raid", "movies"])
+
+    async def test_failed_import_changes_nothing(self):
+        store = self.open_store()
+        # Valid subs first, then an id SQLite can't store, which only fails once the rows are being written
+        subs = {"raid": set(USER_IDS), "movies": {USER_IDS[0]}, "broken": {2 ** 64}}
+        with self.assertRaises(OverflowError):
+            await store.import_subscriptions(GUILD_ID, subs)
+        self.assertEqual(store.sub_names(GUILD_ID), [])
+        self.assertEqual(store.subs_of(GUILD_ID, USER_IDS[0]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Parsing of the files importsubs reads and exportsubs writes.
+
+Run from the repository root: python -m pytest tests (or python -m unittest discover tests)
+"""
+import io
+import json
+import unittest
+
+from SubscriptionStore import USER_ID_LIMIT, read_subscriptions, write_subscriptions
+
+USER_ID = 101234567890123456
+
+
+def read(text: str, fmt: str):
+    return read_subscriptions(io.BytesIO(text.encode("utf-8")), fmt)
+
+
+class ReadSubscriptionsTest(unittest.TestCase):
+
+    def test_csv(self):
+        subs, skipped = read(f"sub,user_id\nraid,{USER_ID}\nraid,{USER_ID}\nraid,7\nmovies,\n", "csv")
+        self.assertEqual(subs, {"raid": {USER_ID, 7}, "movies": set()})
+        self.assertEqual(skipped, 0)
+
+    def test_csv_with_byte_order_mark(self):
+        subs, skipped = read(f"\ufeffsub,user_id\nraid,{USER_ID}\n", "csv")
+        self.assertEqual(subs, {"raid": {USER_ID}})
+        self.assertEqual(skipped, 0)
+
+    def test_csv_ids_out_of_range_are_skipped(self):
+        rows = ["raid,-5", "raid,0", f"raid,{USER_ID_LIMIT}", "raid,99999999999999999999999", "raid,1.5", "raid,abc"]
+        subs, skipped = read("\n".join(rows + [f"raid,{USER_ID_LIMIT - 1}"]) + "\n", "csv")
+        self.assertEqual(subs, {"raid": {USER_ID_LIMIT - 1}})
+        self.assertEqual(skipped, len(rows))
+
+    def test_csv_malformed_rows_are_skipped(self):
+        subs, skipped = read(f"raid\nraid,{USER_ID},extra\n,{USER_ID}\nraid,{USER_ID}\n", "csv")
+        self.assertEqual(subs, {"raid": {USER_ID}})
+        self.assertEqual(skipped, 3)
+
+    def test_jsonl(self):
+        lines = [{"sub": "raid", "user": USER_ID}, {"sub": "raid", "user": str(USER_ID + 1)}, {"sub": "movies"}]
+        subs, skipped = read("".join(json.dumps(line) + "\n" for line in lines) + "\n", "jsonl")
+        self.assertEqual(subs, {"raid": {USER_ID, USER_ID + 1}, "movies": set()})
+        self.assertEqual(skipped, 0)
+
+    def test_jsonl_rejects_values_that_are_not_ids(self):
+        users = [True, False, 1.5, 1.0, -5, 2 ** 64, [USER_ID], {"id": USER_ID}]
+        lines = [json.dumps({"sub": "raid", "user": user}) for user in users] + ["not json", '{"user": 5}']
+        subs, skipped = read("\n".join(lines + [json.dumps({"sub": "raid", "user": USER_ID})]) + "\n", "jsonl")
+        self.assertEqual(subs, {"raid": {USER_ID}})
+        self.assertEqual(skipped, len(lines))
+
+    def test_round_trip(self):
+        subs = {"raid": [7, USER_ID], "movies": [], "naïve, \"quoted\"": [USER_ID]}
+        for fmt in ("csv", "jsonl"):
+            with self.subTest(fmt=fmt):
+                read_back, skipped = read_subscriptions(io.BytesIO(write_subscriptions(subs, fmt)), fmt)
+                self.assertEqual(read_back, {sub_name: set(user_ids) for sub_name, user_ids in subs.items()})
+                self.assertEqual(skipped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()